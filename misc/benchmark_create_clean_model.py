@@ -0,0 +1,74 @@
+"""
+Timing of the spectral-index model write in `create_clean_model`: one
+putchunk per channel (the previous loop) against blocks of whole tiles
+(`create_clean_model.write_spectral_index_model`).
+
+A synthetic 2000-channel cube is created in a temporary directory and
+written both ways; the results are compared.  Run with
+``python benchmark_create_clean_model.py [npix] [nchan]`` from this directory
+in a python environment with casatools.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '../reduction'))
+
+from casatools import image
+from create_clean_model import image_tile_shape, write_spectral_index_model
+
+npix = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+nchan = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+rng = np.random.RandomState(42)
+tt0_pixvalues = rng.uniform(0, 1e-3, [npix, npix, 1, 1])
+tt1_pixvalues = rng.normal(0, 1e-4, [npix, npix, 1, 1])
+factors = np.linspace(-0.05, 0.05, nchan)
+
+
+def per_plane(line_im):
+    for plane in range(nchan):
+        plane_pixvalues = (tt0_pixvalues + factors[plane]*tt1_pixvalues)
+        line_im.putchunk(plane_pixvalues, blc=[0, 0, 0, plane], replicate=False)
+
+
+tmpdir = tempfile.mkdtemp()
+try:
+    results = {}
+    for label in ('per-plane', 'tile blocks'):
+        imagename = os.path.join(tmpdir, label.replace(' ', '_') + '.image')
+        ia = image()
+        ia.fromshape(outfile=imagename, shape=[npix, npix, 1, nchan], overwrite=True)
+        ia.close()
+
+        tileshape = image_tile_shape(imagename)
+        chans_per_block = max(tileshape[-1],
+                              (2**26 // npix**2) // tileshape[-1] * tileshape[-1])
+
+        ia.open(imagename)
+        t0 = time.time()
+        if label == 'per-plane':
+            per_plane(ia)
+        else:
+            write_spectral_index_model(ia, tt0_pixvalues, tt1_pixvalues,
+                                       factors, chans_per_block)
+        ia.close()
+        dt = time.time() - t0
+
+        ia.open(imagename)
+        results[label] = ia.getchunk(blc=[0, 0, 0, 0], trc=[npix-1, npix-1, 0, nchan-1],
+                                     inc=[7, 7, 1, 13])
+        ia.close()
+
+        print("{0:<12s} tile shape {1}, {2:>5d} channels per put: {3:8.2f} s"
+              .format(label, tileshape, 1 if label == 'per-plane' else chans_per_block, dt))
+        shutil.rmtree(imagename)
+
+    assert np.allclose(results['per-plane'], results['tile blocks'])
+finally:
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,62 @@
+"""
+Benchmark of `selfcal_heuristics.field_solution_statistics`, the grouped
+reduction used by `goodenough_field_solutions`, against the per-field loop
+it replaced.
+
+The synthetic caltable columns have 500 fields (a large mosaic), 50 antennas,
+two polarizations, and 10 solution intervals per field.  Run with
+``python benchmark_goodenough_field_solutions.py`` from this directory in a
+python environment with casatools.
+"""
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '../reduction'))
+from selfcal_heuristics import field_solution_statistics
+
+rng = np.random.RandomState(42)
+
+nfields = 500
+nant = 50
+nsolint = 10
+npol = 2
+
+fields = np.repeat(np.arange(nfields), nant*nsolint)
+nrow = fields.size
+phase_noise = rng.uniform(0.05, 1.5, nfields)[fields]
+solns = np.exp(1j*rng.normal(0, phase_noise, [npol, 1, nrow])).astype('complex64')
+snr = rng.uniform(1, 20, [npol, 1, nrow]).astype('float32')
+
+
+def per_field_loop(solns, snr, fields, minsnr=5, maxphasenoise=np.pi/4.):
+    okfields = []
+    not_ok_fields = []
+    for field in np.unique(fields):
+        sel = fields==field
+        angles = np.angle(solns[:,:,sel])
+        field_ok = ((angles.std() < maxphasenoise) &
+                    (snr[:,:,sel].mean() > minsnr))
+        if field_ok:
+            okfields.append(field)
+        else:
+            not_ok_fields.append(field)
+    return okfields, not_ok_fields
+
+
+def grouped(solns, snr, fields, minsnr=5, maxphasenoise=np.pi/4.):
+    ufields, phase_std, mean_snr = field_solution_statistics(solns, snr, fields)
+    field_ok = (phase_std < maxphasenoise) & (mean_snr > minsnr)
+    return list(ufields[field_ok]), list(ufields[~field_ok])
+
+
+print("{0} fields, {1} caltable rows".format(nfields, nrow))
+assert per_field_loop(solns, snr, fields) == grouped(solns, snr, fields)
+
+for label, func in (("per-field loop", per_field_loop),
+                    ("grouped reduction", grouped)):
+    time = min(timeit.repeat(lambda: func(solns, snr, fields), number=3, repeat=3)) / 3
+    print("{0:<20s} {1:10.1f} ms".format(label, time*1e3))
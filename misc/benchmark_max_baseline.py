@@ -0,0 +1,71 @@
+"""
+Benchmark of `baseline_tools.max_baseline_length` against the full N x N x 3
+broadcast previously used in `metadata_tools.get_indiv_imsize`.
+
+The synthetic array has 200 antennas: a compact 7m-like core plus 12m pads in
+two configurations, observed in scans that each use only one configuration
+(as in a concatenated 7M+12M measurement set).
+
+Run with ``python benchmark_max_baseline.py`` from this directory; does not
+require CASA.
+"""
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '../reduction'))
+from baseline_tools import max_baseline_length
+
+rng = np.random.RandomState(42)
+
+nant = 200
+n7m = 16
+ncfg = (nant - n7m) // 2
+
+# nearly-planar array: x, y scattered, small z
+radii = np.concatenate([rng.uniform(0, 50, n7m),
+                        rng.uniform(0, 500, ncfg),
+                        rng.uniform(0, 3000, nant - n7m - ncfg)])
+angles = rng.uniform(0, 2*np.pi, nant)
+positions = np.array([radii*np.cos(angles),
+                      radii*np.sin(angles),
+                      rng.normal(0, 2, nant)])
+diameters = np.array([7.]*n7m + [12.]*(nant-n7m))
+
+ids_7m = np.arange(n7m)
+ids_cfg1 = np.arange(n7m, n7m+ncfg)
+ids_cfg2 = np.arange(n7m+ncfg, nant)
+scan_antennas = [ids_7m]*20 + [ids_cfg1]*40 + [ids_cfg2]*40
+
+
+def broadcast(positions, bl_sel=slice(None)):
+    baseline_lengths = (((positions[None,:,:]-positions.T[:,:,None])**2).sum(axis=1)**0.5)
+    return baseline_lengths[bl_sel,:][:,bl_sel].max()
+
+
+def report(label, func, number=20):
+    result = func()
+    time = min(timeit.repeat(func, number=number, repeat=3)) / number
+    print("{0:<45s} {1:10.2f} m  {2:8.3f} ms".format(label, result, time*1e3))
+    return result
+
+
+print("{0} antennas, {1} scans".format(nant, len(scan_antennas)))
+old = report("N x N x 3 broadcast, all antennas",
+             lambda: broadcast(positions))
+new = report("max_baseline_length, all antennas",
+             lambda: max_baseline_length(positions))
+assert np.isclose(old, new)
+
+old12 = report("N x N x 3 broadcast, 12m only",
+               lambda: broadcast(positions, diameters != 7))
+new12 = report("max_baseline_length, 12m only",
+               lambda: max_baseline_length(positions, antenna_ids=diameters != 7))
+assert np.isclose(old12, new12)
+
+report("max_baseline_length, 12m per-scan groups",
+       lambda: max_baseline_length(positions, antenna_ids=diameters != 7,
+                                   antenna_groups=scan_antennas))
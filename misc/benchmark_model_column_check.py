@@ -0,0 +1,99 @@
+"""
+Benchmark of `metadata_tools.model_column_is_populated` against reading the
+whole model column at once (as the ``ms.getdata(['MODEL_PHASE'])`` checks in
+continuum_imaging_selfcal.py used to).
+
+Synthetic MS-like tables (DATA_DESC_ID and MODEL_DATA columns only) of
+increasing numbers of rows are written to a temporary directory, once with a
+cleared model (1+0j everywhere, so the whole column has to be searched) and
+once with a populated one.  Each check runs in a fresh process so that its
+peak resident memory can be reported: it stays constant for the chunked check
+and grows with the table for the full read.
+
+Run with ``python benchmark_model_column_check.py [nchan]`` from this
+directory in a python environment with casatools.
+"""
+import os
+import sys
+import time
+import shutil
+import resource
+import tempfile
+import subprocess
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '../reduction'))
+
+from casatools import table
+
+npol = 2
+nrows_list = (100000, 400000, 1600000)
+
+
+def make_table(tablename, nrows, nchan, populated, chunkrows=50000):
+    desc = {'DATA_DESC_ID': {'valueType': 'int',
+                             'dataManagerType': 'StandardStMan',
+                             'dataManagerGroup': 'StandardStMan',
+                             'option': 0, 'maxlen': 0, 'comment': ''},
+            'MODEL_DATA': {'valueType': 'complex', 'ndim': 2,
+                           'shape': [npol, nchan],
+                           'dataManagerType': 'TiledShapeStMan',
+                           'dataManagerGroup': 'TiledModel',
+                           'option': 5, 'maxlen': 0, 'comment': ''},
+           }
+    tb = table()
+    tb.create(tablename, desc, nrow=nrows)
+    tb.putcol('DATA_DESC_ID', np.zeros(nrows, dtype='int32'))
+    for startrow in range(0, nrows, chunkrows):
+        nrow = min(chunkrows, nrows - startrow)
+        model = np.ones([npol, nchan, nrow], dtype='complex64')
+        if populated:
+            model *= np.exp(1j*np.random.uniform(-np.pi, np.pi, nrow))
+        tb.putcol('MODEL_DATA', model, startrow=startrow, nrow=nrow)
+    tb.close()
+
+
+def check(method, tablename):
+    """ Run in a child process; prints result, time, and peak RSS """
+    t0 = time.time()
+    if method == 'chunked':
+        from metadata_tools import model_column_is_populated
+        result = model_column_is_populated(tablename)
+    else:
+        tb = table()
+        tb.open(tablename)
+        model = tb.getcol('MODEL_DATA')
+        tb.close()
+        result = bool(np.any(np.angle(model) != 0))
+    dt = time.time() - t0
+    # ru_maxrss is in kB on linux
+    print(result, dt, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == '--check':
+        check(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+
+    nchan = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print("{0:>9s} {1:>10s} {2:>9s} {3:>8s} {4:>9s} {5:>12s}"
+              .format('nrows', 'model', 'method', 'result', 'time (s)', 'peak RSS (MB)'))
+        for nrows in nrows_list:
+            for populated in (False, True):
+                tablename = os.path.join(tmpdir, 'model{0}_{1}.tab'.format(nrows, populated))
+                make_table(tablename, nrows, nchan, populated)
+                for method in ('chunked', 'full'):
+                    output = subprocess.check_output([sys.executable, __file__,
+                                                      '--check', method, tablename])
+                    result, dt, rss = output.decode().split()[-3:]
+                    print("{0:>9d} {1:>10s} {2:>9s} {3:>8s} {4:>9.2f} {5:>12.0f}"
+                          .format(nrows, 'populated' if populated else 'cleared',
+                                  method, result, float(dt), float(rss)))
+                shutil.rmtree(tablename)
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,153 @@
+"""
+Validation of the INCREMENTAL_APPLYCAL option of continuum_imaging_selfcal.py:
+applying the caltables of the self-calibration iterations composed into one
+table (`selfcal_heuristics.compose_caltables`) against clearing the corrected
+column and applying all of them.
+
+A small two-field mosaic is simulated, its visibilities are set to a 1 Jy
+point source corrupted by antenna phases with a slow (per-scan) and a fast
+(per-integration) component and slowly varying antenna amplitudes.  Two
+self-calibration sequences are solved against the point source model:
+coarse then fine (phase with solint='inf', then phase with solint='int'), and
+fine then coarse (phase with solint='int', then amplitude and phase with
+solint='inf', as the selfcal_pars in imaging_parameters.py end).  The corrected
+data from both ways of applying the tables are compared, with all fields used
+as gainfields, with the first table restricted to one field, and with the last
+table restricted to one field.
+
+Run with ``python validate_incremental_applycal.py`` from this directory in a
+python environment with casatools and casatasks.
+"""
+import os
+import sys
+import shutil
+import tempfile
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '../reduction'))
+
+from casatools import simulator, measures, table
+from casatasks import clearcal, gaincal, applycal
+
+from selfcal_heuristics import compose_caltables
+
+nant = 12
+nscans = 6
+rng = np.random.RandomState(42)
+
+me = measures()
+tb = table()
+
+
+def simulate(msname):
+    sm = simulator()
+    sm.open(msname)
+    xx = rng.uniform(-300, 300, nant)
+    yy = rng.uniform(-300, 300, nant)
+    names = ['A{0:02d}'.format(ii) for ii in range(nant)]
+    sm.setconfig(telescopename='ALMA', x=xx, y=yy, z=np.zeros(nant),
+                 dishdiameter=[12.]*nant, mount=['alt-az']*nant,
+                 antname=names, padname=names, coordsystem='local',
+                 referencelocation=me.observatory('ALMA'))
+    sm.setspwindow(spwname='spw0', freq='230GHz', deltafreq='100MHz',
+                   freqresolution='100MHz', nchannels=4, stokes='XX YY')
+    sm.setfeed(mode='perfect X Y')
+    sm.setfield(sourcename='field0',
+                sourcedirection=me.direction('J2000', '16h00m00s', '-50d00m00s'))
+    sm.setfield(sourcename='field1',
+                sourcedirection=me.direction('J2000', '16h00m02s', '-50d00m00s'))
+    sm.setlimits(shadowlimit=0.001, elevationlimit='8.0deg')
+    sm.setauto(autocorrwt=0.0)
+    sm.settimes(integrationtime='10s', usehourangle=True,
+                referencetime=me.epoch('utc', '2019/10/01/00:00:00'))
+    for scan in range(nscans):
+        sm.observe(sourcename='field{0}'.format(scan % 2), spwname='spw0',
+                   starttime='{0}s'.format(scan*120),
+                   stoptime='{0}s'.format(scan*120+100))
+    sm.close()
+
+    # 1 Jy point source with antenna-based phase corruptions
+    tb.open(msname, nomodify=False)
+    ant1 = tb.getcol('ANTENNA1')
+    ant2 = tb.getcol('ANTENNA2')
+    times = tb.getcol('TIME')
+    data = tb.getcol('DATA')
+    scans = tb.getcol('SCAN_NUMBER')
+
+    slow = rng.uniform(-np.pi, np.pi, [nant, scans.max()+1])
+    period = rng.uniform(200, 600, nant)
+    amplitude = rng.uniform(0, 0.5, nant)
+    gain = rng.uniform(0.8, 1.2, nant)
+    def phase(ant):
+        return slow[ant, scans] + amplitude[ant]*np.sin(2*np.pi*times/period[ant])
+    def amp(ant):
+        return gain[ant] * (1 + 0.05*np.sin(2*np.pi*times/(4*period[ant])))
+    vis = amp(ant1)*amp(ant2)*np.exp(1j*(phase(ant1) - phase(ant2)))
+    noise = (rng.normal(0, 0.01, data.shape) + 1j*rng.normal(0, 0.01, data.shape))
+    tb.putcol('DATA', vis[None, None, :] + noise)
+    tb.close()
+
+
+def corrected_data(msname):
+    tb.open(msname)
+    corrected = tb.getcol('CORRECTED_DATA')
+    flags = tb.getcol('FLAG')
+    tb.close()
+    return corrected, flags
+
+
+if __name__ == "__main__":
+    tmpdir = tempfile.mkdtemp()
+    try:
+        msname = os.path.join(tmpdir, 'sim.ms')
+        simulate(msname)
+
+        # the model is the point source (MODEL_DATA = 1)
+        clearcal(vis=msname, addmodel=True)
+        coarse_fine = [os.path.join(tmpdir, 'phase1_inf.cal'),
+                       os.path.join(tmpdir, 'phase2_int.cal')]
+        gaincal(vis=msname, caltable=coarse_fine[0], solint='inf', calmode='p',
+                gaintype='T', refant='A00')
+        gaincal(vis=msname, caltable=coarse_fine[1], solint='int', calmode='p',
+                gaintype='T', refant='A00', gaintable=coarse_fine[:1])
+        fine_coarse = [os.path.join(tmpdir, 'phase1_int.cal'),
+                       os.path.join(tmpdir, 'ampphase2_inf.cal')]
+        gaincal(vis=msname, caltable=fine_coarse[0], solint='int', calmode='p',
+                gaintype='T', refant='A00')
+        gaincal(vis=msname, caltable=fine_coarse[1], solint='inf', calmode='ap',
+                gaintype='T', refant='A00', gaintable=fine_coarse[:1])
+
+        for cals in (coarse_fine, fine_coarse):
+            for okfields_list in (['0,1', '0,1'], ['0', '0,1'], ['0,1', '0']):
+                clearcal(vis=msname, addmodel=True)
+                applycal(vis=msname, gainfield=okfields_list, gaintable=cals,
+                         interp="linear", applymode='calonly', calwt=False)
+                full, flags = corrected_data(msname)
+
+                composed, gainfield = compose_caltables(cals, okfields_list,
+                                                        cals[-1]+".composed")
+                applycal(vis=msname, gainfield=[gainfield],
+                         gaintable=[composed], interp="linear",
+                         applymode='calonly', calwt=False)
+                incremental, flags_incremental = corrected_data(msname)
+
+                assert np.all(flags == flags_incremental)
+                good = ~flags
+                diff = np.abs(full - incremental)[good]
+                phasediff = np.abs(np.angle(full[good] / incremental[good], deg=True))
+                ampratio = np.abs(np.abs(full[good]) / np.abs(incremental[good]) - 1)
+                print("{0}, gainfields {1}:".format(" then ".join(os.path.basename(x) for x in cals),
+                                                    okfields_list))
+                print("  residual phase rms: full reapply {0:0.3f} deg, "
+                      "composed {1:0.3f} deg"
+                      .format(np.angle(full[good], deg=True).std(),
+                              np.angle(incremental[good], deg=True).std()))
+                print("  max |difference| {0:0.2e} Jy, max phase difference {1:0.3f} deg, "
+                      "max amplitude difference {2:0.2e}"
+                      .format(diff.max(), phasediff.max(), ampratio.max()))
+                assert phasediff.max() < 1, "Composed caltable does not match"
+                assert ampratio.max() < 0.01, "Composed caltable does not match"
+    finally:
+        shutil.rmtree(tmpdir)
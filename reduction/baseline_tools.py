@@ -0,0 +1,98 @@
+"""
+Baseline-length utilities that only depend on numpy (and optionally scipy),
+so they can be used and benchmarked outside of CASA.
+"""
+import numpy as np
+
+try:
+    from scipy.spatial import ConvexHull
+    from scipy.spatial.distance import pdist
+except ImportError:
+    ConvexHull = None
+    pdist = None
+
+
+def _max_pairwise_distance(xyz, blocksize=256, hull_threshold=500):
+    """
+    Maximum distance between any two of the ``(n, 3)`` points ``xyz``.
+
+    Only the points on the convex hull can be the ends of the longest
+    baseline, so for large point sets the hull is computed first when scipy is
+    available (for a few hundred points, pdist alone is faster).  Without
+    scipy, the pairwise distances are computed in row blocks so that memory
+    use stays at ``blocksize * n`` rather than ``n * n * 3``.
+    """
+    if len(xyz) < 2:
+        return 0.0
+
+    if ConvexHull is not None and len(xyz) > hull_threshold:
+        try:
+            # joggle ('QJ') so that coplanar arrays (ALMA is nearly flat on
+            # the scale of the convex hull) do not make qhull fail
+            xyz = xyz[ConvexHull(xyz, qhull_options='QJ').vertices]
+        except Exception:
+            # degenerate geometry (e.g., collinear pads); use all points
+            pass
+
+    if pdist is not None:
+        return float(pdist(xyz).max())
+
+    maxsq = 0.0
+    for start in range(0, len(xyz), blocksize):
+        block = xyz[start:start+blocksize]
+        sq = ((block[:,None,:] - xyz[None,:,:])**2).sum(axis=2)
+        maxsq = max(maxsq, sq.max())
+    return float(maxsq**0.5)
+
+
+def max_baseline_length(positions, antenna_ids=None, antenna_groups=None):
+    """
+    Determine the maximum baseline length of an array.
+
+    Parameters
+    ----------
+    positions : array, shape (3, nant)
+        Antenna positions in m, as read from the ``POSITION`` column of the
+        ANTENNA table
+    antenna_ids : array or None
+        Indices (or a boolean mask) of the antennas allowed to contribute,
+        e.g. to select only the 12m or only the 7m antennas.  Defaults to all
+        antennas.
+    antenna_groups : list of arrays or None
+        Sets of antenna IDs that were observing together, e.g. the antennas in
+        each scan.  Baselines are only formed within a group, which avoids
+        counting "baselines" between pads occupied in different
+        configurations of a concatenated MS.  If not specified, all selected
+        antennas are treated as one group.
+
+    Returns
+    -------
+    max_baseline : float
+        The longest baseline in the same units as ``positions``
+    """
+    positions = np.asarray(positions, dtype='float')
+    nant = positions.shape[1]
+
+    selected = np.zeros(nant, dtype='bool')
+    if antenna_ids is None:
+        selected[:] = True
+    else:
+        selected[antenna_ids] = True
+
+    if antenna_groups is None:
+        antenna_groups = [np.arange(nant)]
+
+    # many scans share the same set of antennas; only compute each set once
+    unique_groups = {tuple(np.unique(np.asarray(group, dtype='int')))
+                     for group in antenna_groups}
+
+    max_baseline = 0.0
+    for group in unique_groups:
+        group = np.array(group, dtype='int')
+        group = group[selected[group]]
+        if len(group) < 2:
+            continue
+        max_baseline = max(max_baseline,
+                           _max_pairwise_distance(positions[:, group].T))
+
+    return max_baseline
@@ -2,6 +2,8 @@
 beam_volume_tools.py
 '''
 
+import functools
+
 import numpy as np
 from scipy import ndimage, signal
 from os import path
@@ -57,8 +59,247 @@ def measure_epsilon_from_psf(psf, beam, pixels_per_beam, max_npix_peak=100):
     return epsilon, clean_psf_sum, psf_sum
 
 
+@functools.lru_cache(maxsize=1024)
+def _radius_bins(major, minor, pa, max_npix_peak):
+    """
+    Elliptical radius bins, as in `measure_epsilon_from_psf`, of a
+    ``(2*max_npix_peak+1)``-pixel square cutout centred on its middle pixel
+    for a beam with axes ``major`` and ``minor`` (in the same units) and
+    position angle ``pa`` (in radians).  Bins beyond ``max_npix_peak - 1``,
+    which are not used, are merged into bin ``max_npix_peak``.
+
+    Returns the flattened bins and the number of pixels in each bin; both are
+    cached, since the same beam is typically shared by many channels.
+    """
+    Y, X = np.mgrid[0:2*max_npix_peak+1, 0:2*max_npix_peak+1]
+    dy = (Y - max_npix_peak)
+    dx = (X - max_npix_peak)
+    costh = np.cos(pa)
+    sinth = np.sin(pa)
+    rminmaj = minor / major
+
+    rr = ((dx * costh + dy * sinth)**2 / rminmaj**2 +
+          (dx * sinth - dy * costh)**2 / 1**2)**0.5
+    rbin = np.minimum(rr.astype(int), max_npix_peak).ravel()
+    counts = np.bincount(rbin, minlength=max_npix_peak+1)
+
+    rbin.flags.writeable = False
+    counts.flags.writeable = False
+    return rbin, counts
+
+
+def _first_minima(profiles):
+    """
+    Index of the first local minimum of each row of ``profiles``, as
+    ``signal.find_peaks(-profile)[0][0]``, or -1 if there is none.  Strict
+    minima are found for all rows at once; rows where a flat stretch precedes
+    them (or where there are none) are passed to `signal.find_peaks`.
+    """
+    left = profiles[:, 1:-1] < profiles[:, :-2]
+    right = profiles[:, 1:-1] < profiles[:, 2:]
+    strict = left & right
+    has_minimum = strict.any(axis=1)
+    first_min = strict.argmax(axis=1) + 1
+
+    flat = profiles[:, 1:] == profiles[:, :-1]
+    flat_before = (flat & (np.arange(1, profiles.shape[1])[None, :] <= first_min[:, None])).any(axis=1)
+    for row in np.flatnonzero(~has_minimum | flat_before):
+        minima = signal.find_peaks(-profiles[row])[0]
+        first_min[row] = minima[0] if len(minima) > 0 else -1
+
+    return first_min
+
+
+def _radial_psf_sums(cutouts, beams, max_npix_peak):
+    """
+    The PSF sum within the first null of each of ``cutouts``, PSFs of shape
+    ``(n, 2*max_npix_peak+1, 2*max_npix_peak+1)`` centred on their peaks, as
+    in `measure_epsilon_from_psf`.
+
+    The radial profiles of all cutouts are computed with one `np.bincount`,
+    using the (cached) radius bins of each one's beam, and the first nulls
+    are found for all of them together.
+
+    Returns the PSF sums and the index of the first null (-1 where no null
+    was found within ``max_npix_peak``).
+    """
+    ncut = len(cutouts)
+    nbins = max_npix_peak + 1
+
+    labels = np.empty([ncut, cutouts[0].size], dtype='int')
+    counts = np.empty([ncut, nbins], dtype='float')
+    for ii, beam in enumerate(beams):
+        rbin, counts[ii] = _radius_bins(beam.major.to(u.deg).value,
+                                        beam.minor.to(u.deg).value,
+                                        beam.pa.to(u.rad).value,
+                                        max_npix_peak)
+        labels[ii] = rbin + ii*nbins
+
+    values = np.asarray(cutouts, dtype='float').reshape(ncut, -1)
+    abs_sums = np.bincount(labels.ravel(), weights=np.abs(values).ravel(),
+                           minlength=ncut*nbins).reshape(ncut, nbins)
+    sums = np.bincount(labels.ravel(), weights=values.ravel(),
+                       minlength=ncut*nbins).reshape(ncut, nbins)
+
+    # the last bin holds everything beyond the integration radius
+    with np.errstate(invalid='ignore', divide='ignore'):
+        radial_mean = (abs_sums / counts)[:, :max_npix_peak]
+    first_min_ind = _first_minima(radial_mean)
+
+    cumulative_sums = np.cumsum(sums, axis=1)
+    psf_sum = cumulative_sums[np.arange(ncut), first_min_ind - 1]
+    psf_sum[first_min_ind < 0] = np.nan
+
+    return psf_sum, first_min_ind
+
+
+def measure_epsilon_from_psf_block(psf_block, beams, pixels_per_beam,
+                                   max_npix_peak=100):
+    """
+    `measure_epsilon_from_psf` for a block of PSF channels at once.
+
+    The radial profiles of all channels are computed together (see
+    `_radial_psf_sums`).  Channels whose peak is closer
+    than ``max_npix_peak`` to the image edge, where the cutout is clipped,
+    are measured one by one with `measure_epsilon_from_psf`.
+
+    Parameters
+    ----------
+    psf_block : np.ndarray
+        The PSF, shape ``(nchan, ny, nx)``
+    beams : list of `radio_beam.Beam`
+        The beam of each channel
+    pixels_per_beam : array
+        The clean beam area of each channel in pixels
+    max_npix_peak : int
+        The maximum separation to integrate within to estimate the beam
+
+    Returns
+    -------
+    epsilon, clean_psf_sum, psf_sum : np.ndarray
+        As returned by `measure_epsilon_from_psf`, one value per channel
+    """
+    nchan, ny, nx = psf_block.shape
+
+    flat_block = psf_block.reshape(nchan, ny*nx)
+    peaks = flat_block.argmax(axis=1)
+    if np.any(flat_block[np.arange(nchan), peaks] <= 0):
+        raise ValueError("Invalid PSF")
+    cy, cx = np.unravel_index(peaks, (ny, nx))
+    clipped = ((cy < max_npix_peak) | (cy + max_npix_peak >= ny) |
+               (cx < max_npix_peak) | (cx + max_npix_peak >= nx))
+
+    epsilon = np.zeros(nchan)
+    clean_psf_sum = np.asarray(pixels_per_beam, dtype='float')
+    psf_sum = np.zeros(nchan)
+
+    for chan in np.flatnonzero(clipped):
+        epsilon[chan], _, psf_sum[chan] = measure_epsilon_from_psf(psf_block[chan],
+                                                                   beams[chan],
+                                                                   pixels_per_beam[chan],
+                                                                   max_npix_peak)
+
+    chans = np.flatnonzero(~clipped)
+    if len(chans) == 0:
+        return epsilon, clean_psf_sum, psf_sum
+
+    cutouts = [psf_block[chan,
+                         cy[chan]-max_npix_peak:cy[chan]+max_npix_peak+1,
+                         cx[chan]-max_npix_peak:cx[chan]+max_npix_peak+1]
+               for chan in chans]
+    psf_sum[chans], first_min_ind = _radial_psf_sums(cutouts,
+                                                     [beams[chan] for chan in chans],
+                                                     max_npix_peak)
+    if np.any(first_min_ind < 0):
+        raise ValueError("No first null found within {0} pixels of the PSF peak "
+                         "for channel(s) {1} of the block"
+                         .format(max_npix_peak, chans[first_min_ind < 0]))
+    epsilon[chans] = clean_psf_sum[chans] / psf_sum[chans]
+
+    return epsilon, clean_psf_sum, psf_sum
+
+
+def psf_peak_position(psf):
+    """
+    The (y, x) pixel of the peak of a PSF cube, found in a single channel.
+
+    CASA puts the PSF peak of every channel on the same pixel, so only one
+    plane is read: the middle one or, if its PSF is empty (e.g., a fully
+    flagged channel), the first non-empty one.
+    """
+    nchan = psf.shape[0]
+    for chan in [nchan // 2] + list(range(nchan)):
+        plane = psf.filled_data[chan].value
+        if np.nanmax(plane) > 0:
+            return np.unravel_index(np.nanargmax(plane), plane.shape)
+    return psf.shape[1] // 2, psf.shape[2] // 2
+
+
+def psf_central_max(psf, half_width=5, max_pixels=2**26):
+    """
+    Maximum of each channel of a PSF cube within ``half_width`` pixels of the
+    PSF peak (see `psf_peak_position`), which is the PSF peak unless the
+    channel is empty.  Only that cutout of the cube is read.
+    """
+    peak_y, peak_x = psf_peak_position(psf)
+    nchan, ny, nx = psf.shape
+    yslc = slice(max(peak_y - half_width, 0), min(peak_y + half_width + 1, ny))
+    xslc = slice(max(peak_x - half_width, 0), min(peak_x + half_width + 1, nx))
+    npix = (yslc.stop - yslc.start) * (xslc.stop - xslc.start)
+    chans_per_block = max(1, max_pixels // npix)
+
+    psf_max = np.empty(nchan)
+    for start in range(0, nchan, chans_per_block):
+        stop = min(start + chans_per_block, nchan)
+        cutout = psf.filled_data[start:stop, yslc, xslc].value
+        psf_max[start:stop] = np.nanmax(cutout, axis=(1, 2))
+    return psf_max
+
+
+def _psf_cutout_sums(psf, start, stop, peak, half_width):
+    """
+    PSF sums within the first null of channels ``start:stop`` of ``psf``,
+    measured on a ``(2*half_width+1)``-pixel square cutout centred on
+    ``peak``, the only part of the PSF that is read.
+
+    The sums are exactly those of the full-image measurement with any
+    ``max_npix_peak >= half_width`` for channels whose peak is at the centre
+    of the cutout and whose first null is found within it: the radius bins
+    inside ``half_width`` are then complete.  The second returned array flags
+    the other channels, which have to be measured on the full image.
+    """
+    nchan, ny, nx = psf.shape
+    peak_y, peak_x = peak
+    if (peak_y - half_width < 0 or peak_y + half_width >= ny or
+        peak_x - half_width < 0 or peak_x + half_width >= nx):
+        return np.zeros(stop - start), np.ones(stop - start, dtype='bool')
+
+    cutouts = psf.filled_data[start:stop,
+                              peak_y-half_width:peak_y+half_width+1,
+                              peak_x-half_width:peak_x+half_width+1].value
+    ncut = len(cutouts)
+    flat = cutouts.reshape(ncut, -1)
+    peaks = flat.argmax(axis=1)
+    invalid = np.flatnonzero(flat[np.arange(ncut), peaks] <= 0)
+    if len(invalid) > 0:
+        raise ValueError(f"Invalid PSF for channel {start+invalid[0]}")
+    centred = peaks == flat.shape[1] // 2
+
+    psf_sum = np.zeros(ncut)
+    redo = ~centred
+    chans = np.flatnonzero(centred)
+    if len(chans) > 0:
+        psf_sum[chans], first_min_ind = _radial_psf_sums(cutouts[chans],
+                                                         [psf.beams[start+chan] for chan in chans],
+                                                         half_width)
+        redo[chans[first_min_ind < 0]] = True
+
+    return psf_sum, redo
+
+
 def epsilon_from_psf(psf_image, max_npix_peak=100, export_clean_beam=True,
-                     verbose=False, beam_threshold=0.1, pbar=False, **kwargs):
+                     verbose=False, beam_threshold=0.1, pbar=False,
+                     max_pixels=2**26, cutout_factor=None, **kwargs):
     """
     Determine epsilon, the ratio of the clean beam volume to the dirty beam volume within the first null, for a cube's PSFs.
 
@@ -70,6 +311,19 @@ def epsilon_from_psf(psf_image, max_npix_peak=100, export_clean_beam=True,
         The maximum separation to integrate within to estimate the beam
     export_clean_beam : bool
         Return the synthesized beam in addition to the epsilon values?
+    pbar : callable
+        A progress bar (e.g. ``tqdm.tqdm``) wrapped around the iteration over
+        blocks of channels
+    max_pixels : int
+        The maximum number of PSF pixels read and measured at once (see
+        `measure_epsilon_from_psf_block`); at least one channel is read
+    cutout_factor : float or None
+        If given, only a square cutout of the PSF around its peak is read,
+        with a half-width of ``cutout_factor`` times the largest beam major
+        axis (FWHM) of each block of channels, in pixels, but at most
+        ``max_npix_peak``.  Channels whose first null is not found within the
+        cutout are measured on the full image, so the results are the same
+        as without a cutout.
     kwargs :
         passed to `common_beam`
     """
@@ -100,23 +354,52 @@ def epsilon_from_psf(psf_image, max_npix_peak=100, export_clean_beam=True,
     if not pbar:
         pbar = lambda x: x
 
-    for chan in pbar(range(len(psf))):
-
-        if psf[chan].max() == 0:
-            print("INVALID PSF for channel {chan}")
-            epsilon_arr[chan] = 0
-
-        epsilon, clean_psf_sum, psf_sum = measure_epsilon_from_psf(psf[chan],
-                                                                   psf.beams[chan],
-                                                                   psf.pixels_per_beam[chan],
-                                                                   max_npix_peak)
-        epsilon_arr[chan] = epsilon
+    nchan, ny, nx = psf.shape
+    chans_per_block = max(1, max_pixels // (ny*nx))
+
+    if cutout_factor is not None:
+        peak = psf_peak_position(psf)
+        pixscale = np.abs(psf.header['CDELT2'])*u.deg
+        nfull = 0
+
+    for start in pbar(range(0, nchan, chans_per_block)):
+        stop = min(start + chans_per_block, nchan)
+        beams = psf.beams[start:stop]
+        clean_psf_sum = np.asarray(psf.pixels_per_beam[start:stop], dtype='float')
+
+        if cutout_factor is not None:
+            major_npix = max((beam.major / pixscale).decompose().value for beam in beams)
+            half_width = int(min(max_npix_peak, np.ceil(cutout_factor * major_npix)))
+            psf_sum, full = _psf_cutout_sums(psf, start, stop, peak, half_width)
+            nfull += full.sum()
+        else:
+            psf_sum = np.zeros(stop - start)
+            full = np.ones(stop - start, dtype='bool')
+
+        if full.any():
+            chans = np.flatnonzero(full)
+            psf_block = psf.filled_data[start:stop].value[chans]
+            for chan, psf_plane in zip(chans, psf_block):
+                if psf_plane.max() <= 0:
+                    raise ValueError(f"Invalid PSF for channel {start+chan}")
+
+            _, _, psf_sum[chans] = measure_epsilon_from_psf_block(psf_block,
+                                                                  [beams[chan] for chan in chans],
+                                                                  clean_psf_sum[chans],
+                                                                  max_npix_peak)
+
+        epsilon = clean_psf_sum / psf_sum
+        epsilon_arr[start:stop] = epsilon
 
         if verbose:
-            print('\n')
-            print('Clean beam area of channel {0} is {1} pixels:'.format(chan, clean_psf_sum))
-            print('Dirty beam area of channel {0} is {1} pixels:'.format(chan, psf_sum))
-            print('epsilon = Omega_clean / Omega_dirty = {}'.format(epsilon))
+            for chan in range(start, stop):
+                print('\n')
+                print('Clean beam area of channel {0} is {1} pixels:'.format(chan, clean_psf_sum[chan-start]))
+                print('Dirty beam area of channel {0} is {1} pixels:'.format(chan, psf_sum[chan-start]))
+                print('epsilon = Omega_clean / Omega_dirty = {}'.format(epsilon[chan-start]))
+
+    if cutout_factor is not None:
+        log.info(f"Measured epsilon on PSF cutouts for {nchan - nfull} of {nchan} channels")
 
     if export_clean_beam:
         output = {'epsilon': epsilon_arr, 'clean_beam': common_beam}
@@ -62,7 +62,8 @@ else:
 almaimf_rootdir = os.getenv('ALMAIMF_ROOTDIR')
 
 from getversion import git_date, git_version
-from metadata_tools import determine_imsize, determine_phasecenter, logprint
+from metadata_tools import (determine_imsize, determine_phasecenter, logprint,
+                            MSMetadataSnapshot)
 from make_custom_mask import make_custom_mask
 from imaging_parameters import imaging_parameters
 from tasks import tclean, exportfits, plotms, split
@@ -203,14 +204,17 @@ for continuum_ms in continuum_mses:
     logprint("Imaging MS {0} with array {1}".format(continuum_ms, arrayname),
              origin='almaimf_cont_imaging')
 
-    coosys,racen,deccen = determine_phasecenter(ms=continuum_ms, field=field)
+    metadata_snapshot = MSMetadataSnapshot(continuum_ms)
+    coosys,racen,deccen = determine_phasecenter(ms=continuum_ms, field=field,
+                                                snapshot=metadata_snapshot)
     phasecenter = "{0} {1}deg {2}deg".format(coosys, racen, deccen)
     (dra,ddec,pixscale) = list(determine_imsize(ms=continuum_ms, field=field,
                                                 phasecenter=(racen,deccen),
                                                 exclude_7m=exclude_7m,
                                                 only_7m=only_7m,
                                                 spw='all',
-                                                pixfraction_of_fwhm=1/8. if only_7m else 1/4.))
+                                                pixfraction_of_fwhm=1/8. if only_7m else 1/4.,
+                                                snapshot=metadata_snapshot))
     imsize = [dra, ddec]
     cellsize = ['{0:0.2f}arcsec'.format(pixscale)] * 2
 
@@ -25,6 +25,12 @@ You can set the following environmental variables for this script:
         (for B3, specifying this parameter will exclude the 93.173 GHz Diazenylium (N2H+) line)
         This is most important if DO_BSENS=True.
         This will add a _noco (or _no2hp) suffix
+    PARALLEL_ROBUST=<number>
+        Run the two robust sweeps (bottom-up and top-down; each robust value
+        starts from the model of the previous one) as concurrent CASA
+        processes (see parallel_imaging.py) if set to 2 or more and if they
+        fit in memory.  By default, they are run one after the other.
+        Requires CASA 6.
 
 The environmental variable ``ALMAIMF_ROOTDIR`` should be set to the directory
 containing this file.
@@ -119,12 +125,14 @@ import numpy as np
 
 from getversion import git_date, git_version
 from metadata_tools import (determine_imsize, determine_phasecenter, logprint,
+                            MSMetadataSnapshot,
                             check_model_is_populated, test_tclean_success,
                             populate_model_column, get_non_bright_spws,
                             sethistory)
 from make_custom_mask import make_custom_mask
 from imaging_parameters import imaging_parameters, selfcal_pars
 from selfcal_heuristics import goodenough_field_solutions
+from parallel_imaging import run_imaging_job, run_imaging_sequences
 
 try:
     from tasks import tclean, plotms, split, flagdata
@@ -216,6 +224,14 @@ if len(continuum_mses) == 0:
 
 dryrun = bool(os.getenv('DRYRUN') or (dryrun if 'dryrun' in locals() else False))
 
+parallel_robust = int(os.getenv('PARALLEL_ROBUST') or 1)
+if parallel_robust > 1 and sys.version_info[0] < 3:
+    # the concurrent imaging processes run parallel_imaging.py with the
+    # python executable, which can only import the CASA tasks in CASA 6
+    raise ValueError("PARALLEL_ROBUST={0} requires CASA 6; unset it (or set it "
+                     "to 1) to run the imaging serially under CASA 5"
+                     .format(parallel_robust))
+
 if 'do_bsens' in locals():
     os.environ['DO_BSENS'] = str(do_bsens)
 if os.getenv('DO_BSENS') is not None and os.getenv('DO_BSENS').lower() != 'false':
@@ -301,14 +317,17 @@ for continuum_ms in continuum_mses:
     if flagsum is not None and 'flagged' in flagsum and flagsum['flagged'] != flagsum['total']:
         raise ValueError("Found unflagged autocorrelation data (or at least, short baselines) in {0}".format(selfcal_ms))
 
-    coosys,racen,deccen = determine_phasecenter(ms=selfcal_ms, field=field)
+    metadata_snapshot = MSMetadataSnapshot(selfcal_ms)
+    coosys,racen,deccen = determine_phasecenter(ms=selfcal_ms, field=field,
+                                                snapshot=metadata_snapshot)
     phasecenter = "{0} {1}deg {2}deg".format(coosys, racen, deccen)
     (dra,ddec,pixscale) = list(determine_imsize(ms=selfcal_ms, field=field,
                                                 phasecenter=(racen,deccen),
                                                 exclude_7m=exclude_7m,
                                                 only_7m=only_7m,
                                                 spw='all',
-                                                pixfraction_of_fwhm=1/8. if only_7m else 1/4.))
+                                                pixfraction_of_fwhm=1/8. if only_7m else 1/4.,
+                                                snapshot=metadata_snapshot))
     imsize = [dra, ddec]
     cellsize = ['{0:0.2f}arcsec'.format(pixscale)] * 2
 
@@ -401,11 +420,14 @@ for continuum_ms in continuum_mses:
                  interp="linear", applymode='calonly', calwt=False)
 
 
+    # each sweep is a sequence of imaging jobs that depend on each other
+    sweeps = []
     for order,robusts in zip(('bottomup', 'topdown'),
                              [(-2, -1, -0.5, 0, 0.5, 1, 2),
                               (-2, -1, -0.5, 0, 0.5, 1, 2)[::-1]]):
         robust_startmod = 0
         first = True
+        sweep = []
 
         for robust in robusts:
             logprint("Imaging self-cal iter {0} (final) with robust {1}"
@@ -458,24 +480,35 @@ for continuum_ms in continuum_mses:
             if not dryrun:
                 logprint("Final imaging parameters are: {0} for image name {1}".format(impars_finaliter, finaliterimname),
                          origin='almaimf_cont_selfcal')
-                tclean(vis=selfcal_ms,
-                       field=field.encode(),
-                       imagename=finaliterimname,
-                       phasecenter=phasecenter,
-                       startmodel=modelname,
-                       outframe='LSRK',
-                       veltype='radio',
-                       interactive=False,
-                       antenna=antennae,
-                       savemodel='none',
-                       datacolumn='corrected',
-                       pbcor=True,
-                       **impars_finaliter
-                      )
-                test_tclean_success()
-                sethistory(finaliterimname, impars=impars_finaliter, selfcalpars=selfcalpars, selfcaliter=selfcaliter)
-                # overwrite=True because these could already exist
-                exportfits(finaliterimname+".image.tt0", finaliterimname+".image.tt0.fits", overwrite=True)
-                exportfits(finaliterimname+".image.tt0.pbcor", finaliterimname+".image.tt0.pbcor.fits", overwrite=True)
+                job = {'tclean': dict(vis=selfcal_ms,
+                                      field=field.encode(),
+                                      imagename=finaliterimname,
+                                      phasecenter=phasecenter,
+                                      startmodel=modelname,
+                                      outframe='LSRK',
+                                      veltype='radio',
+                                      interactive=False,
+                                      antenna=antennae,
+                                      savemodel='none',
+                                      datacolumn='corrected',
+                                      pbcor=True,
+                                      **impars_finaliter
+                                     ),
+                       'impars': impars_finaliter,
+                       'selfcalpars': selfcalpars,
+                       'selfcaliter': selfcaliter,
+                      }
+                if parallel_robust > 1:
+                    sweep.append(job)
+                else:
+                    run_imaging_job(job)
 
             robust_startmod = robust
+
+        if sweep:
+            sweeps.append(sweep)
+
+    if sweeps:
+        # savemodel='none': the MS is only read
+        run_imaging_sequences(sweeps, nprocs=parallel_robust,
+                              jobdir=imaging_root)
@@ -25,6 +25,18 @@ You can set the following environmental variables for this script:
         (for B3, specifying this parameter will exclude the 93.173 GHz Diazenylium (N2H+) line)
         This is most important if DO_BSENS=True.
         This will add a _noco (or _no2hp) suffix
+    INCREMENTAL_APPLYCAL=<boolean>
+        Instead of clearing the corrected column and applying all of the
+        caltables so far in each self-calibration iteration, compose them into
+        a single table (<last caltable>.composed) and apply only that one.
+        The solutions of all tables are interpolated onto the union of their
+        solution times, so the result differs slightly from applying them all
+        (see misc/validate_incremental_applycal.py).
+    PARALLEL_ROBUST=<number>
+        Run the final imaging at the different robust values as up to this
+        many concurrent CASA processes (see parallel_imaging.py), as many as
+        fit in memory.  The default, 1, images them one after the other.
+        Requires CASA 6.
 
 The environmental variable ``ALMAIMF_ROOTDIR`` should be set to the directory
 containing this file.
@@ -52,6 +64,16 @@ The imaging self-calibration step does the following:
 
 Restarting
 ==========
+The progress of the self-calibration is recorded in a checkpoint manifest,
+<prefix>_robust0_selfcal_checkpoints.json, in the imaging_results directory
+(see selfcal_checkpoints.py).  A rerun skips every iteration whose caltable and
+image are recorded as complete and unchanged, and it only re-populates the
+model column or re-applies the caltables when the measurement set does not
+already hold them.  Caltables and images that are left over from an interrupted
+run (i.e., not recorded as complete) are removed and redone.  If there is no
+manifest, e.g. for products made by an older version of this script, the
+existing products are adopted as they are.
+
 If you want to restart the selfcal iterations from scratch or from a particular
 self-calibration iteration (e.g., you want to change your mask and start over
 from iteration #3), remove all associated imaging files.  The script will reimage
@@ -119,11 +141,15 @@ import numpy as np
 
 from getversion import git_date, git_version
 from metadata_tools import (determine_imsize, determine_phasecenter, logprint,
-                            check_model_is_populated, test_tclean_success,
+                            MSMetadataSnapshot,
+                            check_model_is_populated, model_column_is_populated,
+                            test_tclean_success,
                             populate_model_column, get_non_bright_spws)
 from make_custom_mask import make_custom_mask
 from imaging_parameters import imaging_parameters, selfcal_pars
-from selfcal_heuristics import goodenough_field_solutions
+from selfcal_heuristics import goodenough_field_solutions, compose_caltables
+from selfcal_checkpoints import SelfcalCheckpoint
+from parallel_imaging import run_imaging_job, run_imaging_sequences
 
 try:
     from tasks import tclean, plotms, split, flagdata
@@ -219,6 +245,74 @@ def sethistory(prefix, selfcalpars=None, impars=None, selfcaliter=None):
             ia.close()
             ia.done()
 
+def ensure_model_column(checkpoint, selfcaliter, imname, impars, selfcal_ms,
+                        field, phasecenter, maskname, antennae):
+    """
+    Populate the model column of ``selfcal_ms`` from ``imname``, the image of
+    self-calibration iteration ``selfcaliter``, unless the checkpoints show
+    that it already holds that model
+    """
+    if checkpoint.ms_state('model_column') == imname:
+        logprint("Model column is already populated from {0}".format(imname),
+                 origin='contim_selfcal')
+        return
+    # populating the model does not touch the corrected column
+    corrected = checkpoint.ms_state('corrected')
+    populate_model_column(imname, selfcal_ms, field, copy.copy(impars),
+                          phasecenter, maskname, antennae)
+    # the zero-iteration tclean rewrites the image products
+    checkpoint.record_image(selfcaliter, imname)
+    checkpoint.record_ms_state(model_column=imname, corrected=corrected)
+
+def apply_selfcal(checkpoint, selfcal_ms, cals, okfields_list):
+    """
+    Apply the self-calibration tables ``cals``, with gainfields
+    ``okfields_list``, to ``selfcal_ms``, unless the checkpoints show that
+    they are already applied.  Returns the record of what was applied.
+    """
+    applied = {'gaintable': list(cals), 'gainfield': list(okfields_list),
+               'incremental': incremental_applycal}
+    if checkpoint.ms_state('corrected') == applied:
+        logprint("Caltables {0} are already applied".format(cals),
+                 origin='contim_selfcal')
+        return applied
+
+    composed = None
+    if incremental_applycal and len(cals) > 1:
+        try:
+            composed, composed_gainfield = compose_caltables(cals, okfields_list,
+                                                             cals[-1]+".composed")
+        except ValueError as ex:
+            # e.g., gaintype 'G' and 'T' tables cannot be composed
+            logprint("Applying all caltables because they could not be "
+                     "composed: {0}".format(ex), origin='contim_selfcal')
+
+    if composed is not None:
+        model_column = checkpoint.ms_state('model_column')
+        logprint("Applying {0}, composed from {1}".format(composed, cals),
+                 origin='contim_selfcal')
+        # applycal rewrites the whole corrected column, so it does not need
+        # to be cleared first
+        applycal(vis=selfcal_ms,
+                 gainfield=[composed_gainfield],
+                 gaintable=[composed],
+                 interp="linear",
+                 applymode='calonly',
+                 calwt=False)
+    else:
+        # clearcal also resets the model column
+        model_column = None
+        clearcal(vis=selfcal_ms, addmodel=True)
+        # use gainfield so we interpolate the good solutions to the other
+        # fields
+        applycal(vis=selfcal_ms,
+                 gainfield=okfields_list,
+                 gaintable=cals,
+                 interp="linear",
+                 applymode='calonly',
+                 calwt=False)
+    checkpoint.record_ms_state(model_column=model_column, corrected=applied)
+    return applied
 
 
 logprint("Beginning selfcal script with exclude_7m={0} and only_7m={1}".format(exclude_7m, only_7m),
@@ -236,6 +330,19 @@ if len(continuum_mses) == 0:
 
 dryrun = bool(os.getenv('DRYRUN') or (dryrun if 'dryrun' in locals() else False))
 
+if 'incremental_applycal' in locals():
+    os.environ['INCREMENTAL_APPLYCAL'] = str(incremental_applycal)
+incremental_applycal = (os.getenv('INCREMENTAL_APPLYCAL') is not None and
+                        os.getenv('INCREMENTAL_APPLYCAL').lower() != 'false')
+
+parallel_robust = int(os.getenv('PARALLEL_ROBUST') or 1)
+if parallel_robust > 1 and sys.version_info[0] < 3:
+    # the concurrent imaging processes run parallel_imaging.py with the
+    # python executable, which can only import the CASA tasks in CASA 6
+    raise ValueError("PARALLEL_ROBUST={0} requires CASA 6; unset it (or set it "
+                     "to 1) to run the imaging serially under CASA 5"
+                     .format(parallel_robust))
+
 if 'do_bsens' in locals():
     os.environ['DO_BSENS'] = str(do_bsens)
 if os.getenv('DO_BSENS') is not None and os.getenv('DO_BSENS').lower() != 'false':
@@ -373,14 +480,17 @@ for continuum_ms in continuum_mses:
         else:
             raise ex
 
-    coosys,racen,deccen = determine_phasecenter(ms=selfcal_ms, field=field)
+    metadata_snapshot = MSMetadataSnapshot(selfcal_ms)
+    coosys,racen,deccen = determine_phasecenter(ms=selfcal_ms, field=field,
+                                                snapshot=metadata_snapshot)
     phasecenter = "{0} {1}deg {2}deg".format(coosys, racen, deccen)
     (dra,ddec,pixscale) = list(determine_imsize(ms=selfcal_ms, field=field,
                                                 phasecenter=(racen,deccen),
                                                 exclude_7m=exclude_7m,
                                                 only_7m=only_7m,
                                                 spw='all',
-                                                pixfraction_of_fwhm=1/8. if only_7m else 1/4.))
+                                                pixfraction_of_fwhm=1/8. if only_7m else 1/4.,
+                                                snapshot=metadata_snapshot))
     imsize = [dra, ddec]
     cellsize = ['{0:0.2f}arcsec'.format(pixscale)] * 2
 
@@ -432,6 +542,9 @@ for continuum_ms in continuum_mses:
     else:
         brightlinesuffix = ''
 
+    checkpoint = SelfcalCheckpoint(contimagename+"_robust{0}_selfcal_checkpoints.json".format(robust),
+                                   selfcal_ms, enabled=not dryrun)
+
     dirty_impars = copy.copy(impars)
     dirty_impars['niter'] = 0
     dirty_impars['usemask'] = 'pb' # we're not cleaning so we force the mask to pb
@@ -568,35 +681,29 @@ for continuum_ms in continuum_mses:
             exportfits(imname+".image.tt0.pbcor", imname+".image.tt0.pbcor.fits")
 
         # CHECK FOR MODEL FAILURES!
-        ms.open(selfcal_ms)
-        model_data = ms.getdata(['MODEL_PHASE'])
-        ms.close()
-        if 'model_phase' not in model_data or np.all(model_data['model_phase'] == 0):
+        if not model_column_is_populated(selfcal_ms):
             logprint("SEVERE error encountered: model column was not populated!"
                      "Therefore, populated model column from {0}".format(imname),
                      origin='almaimf_cont_selfcal')
             if not dryrun:
-                populate_model_column(imname, selfcal_ms, field, impars_thisiter,
+                populate_model_column(imname, selfcal_ms, field,
+                                      copy.copy(impars_thisiter),
                                       phasecenter, maskname,
                                       antennae)
         else:
             logprint("Model column was populated from pre-selfcal image.",
                      origin='almaimf_cont_selfcal')
+        if not dryrun:
+            checkpoint.record_image(0, imname, gaintables=[], gainfields=[])
+            checkpoint.record_ms_state(model_column=imname)
 
     else:
-        # populate the model column (should be from data on disk matching
-        # this format, but we don't need to - and can't - specify it)
-        # If you want to use `ft`, you need to specify this:
-        # modelname = [contimagename+"_robust{0}.model.tt0".format(robust),
-        #              contimagename+"_robust{0}.model.tt1".format(robust)]
+        # the model column is populated from this image (see
+        # `ensure_model_column`) only if the first gaincal needs to be run
+        if not checkpoint.image_complete(0, imname):
+            checkpoint.record_image(0, imname)
 
-        if not dryrun:
-            populate_model_column(imname, selfcal_ms, field, impars_thisiter,
-                                  phasecenter, maskname,
-                                  antennae)
-
-        logprint("Skipped completed file {0},"
-                 " populated model column".format(imname),
+        logprint("Skipped completed file {0}".format(imname),
                  origin='almaimf_cont_selfcal')
 
     # make a custom mask using the first-pass clean
@@ -630,7 +737,8 @@ for continuum_ms in continuum_mses:
 
     okfields_list = []
     cals = []
-    skipped_any = False
+    # gaincal solves against the model of the previous iteration
+    imname_lastiter, impars_lastiter = imname, impars_thisiter
 
     for selfcaliter in selfcalpars.keys():
 
@@ -644,16 +752,40 @@ for continuum_ms in continuum_mses:
         caltype = 'amp' if 'a' in selfcalpars[selfcaliter]['calmode'] else 'phase'
         caltable = '{0}{5}_{1}_{2}{3}_{4}.cal'.format(basename, arrayname, caltype, selfcaliter,
                                                       selfcalpars[selfcaliter]['solint'], brightlinesuffix)
+        if (os.path.exists(caltable) and not checkpoint.is_new and
+                not checkpoint.caltable_complete(selfcaliter, caltable)):
+            if checkpoint.caltable_recorded(selfcaliter, caltable):
+                # e.g., flagged by hand or with flag_extreme_amplitudes
+                logprint("WARNING: Caltable {0} was modified after it was "
+                         "solved; using it as it is".format(caltable),
+                         origin='contim_selfcal')
+                checkpoint.record_caltable(selfcaliter, caltable)
+            else:
+                # e.g., gaincal was interrupted while writing it
+                logprint("Caltable {0} was not recorded as complete; removing it"
+                         .format(caltable), origin='contim_selfcal')
+                if not dryrun:
+                    rmtables(caltable)
         if not os.path.exists(caltable):
             #check_model_is_populated(selfcal_ms)
             if not dryrun:
+                # the images (and caltables) of this and the later iterations
+                # were made with the old caltable
+                checkpoint.forget_iterations(selfcaliter)
+                ensure_model_column(checkpoint, selfcaliter-1, imname_lastiter,
+                                    impars_lastiter, selfcal_ms, field,
+                                    phasecenter, maskname, antennae)
                 gaincal(vis=selfcal_ms,
                         caltable=caltable,
                         gaintable=cals,
                         **selfcalpars[selfcaliter])
+                checkpoint.record_caltable(selfcaliter, caltable)
         else:
             logprint("Skipping existing caltable {0}".format(caltable),
                      origin='contim_selfcal')
+            if not checkpoint.caltable_complete(selfcaliter, caltable):
+                # made before checkpoints were recorded
+                checkpoint.record_caltable(selfcaliter, caltable)
 
         cals.append(caltable)
 
@@ -686,22 +818,30 @@ for continuum_ms in continuum_mses:
                 del impars_thisiter[key]
 
 
-        if os.path.exists(imname+".image.tt0"):
-            with open(caltable+".fields", 'r') as fh:
-                okfields_str = fh.read()
+        if (checkpoint.image_complete(selfcaliter, imname) or
+                (checkpoint.is_new and os.path.exists(imname+".image.tt0"))):
+            okfields_str = checkpoint.okfields(selfcaliter)
+            if okfields_str is None:
+                with open(caltable+".fields", 'r') as fh:
+                    okfields_str = fh.read()
             okfields_list.append(okfields_str)
-            skipped_any = True
+            if not checkpoint.image_complete(selfcaliter, imname):
+                # made before checkpoints were recorded
+                checkpoint.record_image(selfcaliter, imname, cals, okfields_list)
             logprint("Skipped gaincal iteration {0} - already done".format(selfcaliter),
                      origin='contim_selfcal')
-            impars_lastiter = impars_thisiter
+            imname_lastiter, impars_lastiter = imname, impars_thisiter
             continue
-        elif skipped_any:
+        elif os.path.exists(imname+".image.tt0"):
+            logprint("Image {0} was not recorded as complete or was modified "
+                     "since; re-imaging it".format(imname),
+                     origin='contim_selfcal')
             if not dryrun:
-                imname_lastiter = contimagename+"_robust{0}_selfcal{1}".format(robust,
-                                                                               selfcaliter-1)
-                populate_model_column(imname_lastiter, selfcal_ms, field,
-                                      impars_lastiter, phasecenter, maskname,
-                                      antennae)
+                for fn in glob.glob(imname+".*"):
+                    if os.path.isdir(fn):
+                        shutil.rmtree(fn)
+                    else:
+                        os.remove(fn)
 
 
         # start from previous model to save time
@@ -714,114 +854,98 @@ for continuum_ms in continuum_mses:
                          contimagename+"_robust{0}_selfcal{1}.model.tt1".format(robust, selfcaliter-1)]
 
 
-        if not os.path.exists(imname+".image.tt0"):
-
-            if 'minsnr' in selfcalpars[selfcaliter]:
-                minsnr = selfcalpars[selfcaliter].pop('minsnr')
-            else:
-                minsnr = 5
+        if 'minsnr' in selfcalpars[selfcaliter]:
+            minsnr = selfcalpars[selfcaliter].pop('minsnr')
+        else:
+            minsnr = 5
 
-            if not selfcalpars[selfcaliter].get('ignore_selfcalheuristics'):
-                okfields,notokfields = goodenough_field_solutions(caltable,
-                                                                  minsnr=minsnr)
-                logprint("Fields {0} had min snr {2}, fields {1} did not"
-                         .format(okfields, notokfields, minsnr), origin='contim_selfcal')
+        if not selfcalpars[selfcaliter].get('ignore_selfcalheuristics'):
+            okfields,notokfields = goodenough_field_solutions(caltable,
+                                                              minsnr=minsnr)
+            logprint("Fields {0} had min snr {2}, fields {1} did not"
+                     .format(okfields, notokfields, minsnr), origin='contim_selfcal')
+        else:
+            tb.open(caltable)
+            okfields = np.unique(tb.getcol('FIELD_ID'))
+            tb.close()
+        if len(okfields) == 0:
+            if selfcal_field_id is None:
+                logprint("All fields flagged out of gaincal solns!",
+                         origin='contim_selfcal')
+                raise ValueError("All fields flagged out of gaincal solns!")
             else:
-                tb.open(caltable)
-                okfields = np.unique(tb.getcol('FIELD_ID'))
-                tb.close()
-            if len(okfields) == 0:
-                if selfcal_field_id is None:
-                    logprint("All fields flagged out of gaincal solns!",
-                             origin='contim_selfcal')
-                    raise ValueError("All fields flagged out of gaincal solns!")
-                else:
-                    logprint("All fields flagged out of gaincal solns.  "
-                             "Using manually-specified self-calibration field {0}".format(selfcal_field_id),
-                             origin='contim_selfcal')
-                    okfields = selfcal_field_id
-            elif selfcal_field_id is not None:
-                intersection = set(okfields).intersection(set(selfcal_field_id))
-                logprint("Using fields {0} as manually specified for self-calibration, "
-                         "though {1} were found to be good (the intersection is {2}"
-                         .format(selfcal_field_id, okfields, intersection),
+                logprint("All fields flagged out of gaincal solns.  "
+                         "Using manually-specified self-calibration field {0}".format(selfcal_field_id),
                          origin='contim_selfcal')
                 okfields = selfcal_field_id
-            okfields_str = ",".join(["{0}".format(x) for x in okfields])
-            with open(caltable+".fields", 'w') as fh:
-                fh.write(okfields_str)
-            okfields_list.append(okfields_str)
-
-            # check that there is an appropriate number of okfield_lists and calibration tables
-            logprint("Using okfield_list = {0} matched with cals {1}".format(okfields_list, cals),
+        elif selfcal_field_id is not None:
+            intersection = set(okfields).intersection(set(selfcal_field_id))
+            logprint("Using fields {0} as manually specified for self-calibration, "
+                     "though {1} were found to be good (the intersection is {2}"
+                     .format(selfcal_field_id, okfields, intersection),
                      origin='contim_selfcal')
-            assert len(okfields_list) == len(cals)
+            okfields = selfcal_field_id
+        okfields_str = ",".join(["{0}".format(x) for x in okfields])
+        with open(caltable+".fields", 'w') as fh:
+            fh.write(okfields_str)
+        okfields_list.append(okfields_str)
+        if not dryrun:
+            checkpoint.record_caltable(selfcaliter, caltable, okfields=okfields_str)
 
-            if not dryrun:
-                clearcal(vis=selfcal_ms, addmodel=True)
-                # use gainfield so we interpolate the good solutions to the other
-                # fields
-                applycal(vis=selfcal_ms,
-                         gainfield=okfields_list,
-                         gaintable=cals,
-                         interp="linear",
-                         applymode='calonly',
-                         calwt=False)
-
-            if maskname:
-                # do not run the clean if no mask exists
-                assert os.path.exists(maskname), "Mask {0} was not found.".format(maskname)
-
-            # Note Sep 6, 2020: the comment below doesn't make sense to me;
-            # we are in a block that _will not_ be executed if image.tt0 exists.
-            # do this even if the output file exists: we need to populate the
-            # modelcolumn
-            logprint("Imaging parameters are: {0} for image name {1}".format(impars_thisiter, imname),
-                     origin='almaimf_cont_selfcal')
-            existing_files = glob.glob(imname+"*")
-            logprint("Pre-existing files matching imname = {0}".format(existing_files),
-                     origin='almaimf_cont_selfcal')
-            if not dryrun:
-                tclean(vis=selfcal_ms,
-                       field=field,
-                       imagename=imname,
-                       phasecenter=phasecenter,
-                       startmodel=modelname,
-                       outframe='LSRK',
-                       veltype='radio',
-                       mask=maskname,
-                       interactive=False,
-                       antenna=antennae,
-                       savemodel='modelcolumn',
-                       datacolumn='corrected', # now use corrected data
-                       pbcor=True,
-                       **impars_thisiter
-                      )
-                test_tclean_success()
-                sethistory(imname, impars=impars_thisiter, selfcalpars=selfcalpars, selfcaliter=selfcaliter)
-                # overwrite=True because these could already exist
-                exportfits(imname+".image.tt0", imname+".image.tt0.fits", overwrite=True)
-                exportfits(imname+".image.tt0.pbcor", imname+".image.tt0.pbcor.fits", overwrite=True)
-
-                # CHECK FOR MODEL FAILURES!
-                ms.open(selfcal_ms)
-                model_data = ms.getdata(['MODEL_PHASE'])
-                ms.close()
-                if 'model_phase' not in model_data or np.all(model_data['model_phase'] == 0):
-                    logprint("SEVERE error encountered: model column was not populated!"
-                             "Therefore, populated model column from {0}".format(imname),
-                             origin='almaimf_cont_selfcal')
-                    populate_model_column(imname, selfcal_ms, field, impars_thisiter,
-                                          phasecenter, maskname,
-                                          antennae)
-        else:
-            with open(caltable+".fields", 'r') as fh:
-                okfields_str = fh.read()
-            okfields_list.append(okfields_str)
-            if not dryrun:
+        # check that there is an appropriate number of okfield_lists and calibration tables
+        logprint("Using okfield_list = {0} matched with cals {1}".format(okfields_list, cals),
+                 origin='contim_selfcal')
+        assert len(okfields_list) == len(cals)
+
+        if not dryrun:
+            applied = apply_selfcal(checkpoint, selfcal_ms, cals, okfields_list)
+
+        if maskname:
+            # do not run the clean if no mask exists
+            assert os.path.exists(maskname), "Mask {0} was not found.".format(maskname)
+
+        # Note Sep 6, 2020: the comment below doesn't make sense to me;
+        # we are in a block that _will not_ be executed if image.tt0 exists.
+        # do this even if the output file exists: we need to populate the
+        # modelcolumn
+        logprint("Imaging parameters are: {0} for image name {1}".format(impars_thisiter, imname),
+                 origin='almaimf_cont_selfcal')
+        existing_files = glob.glob(imname+"*")
+        logprint("Pre-existing files matching imname = {0}".format(existing_files),
+                 origin='almaimf_cont_selfcal')
+        if not dryrun:
+            tclean(vis=selfcal_ms,
+                   field=field,
+                   imagename=imname,
+                   phasecenter=phasecenter,
+                   startmodel=modelname,
+                   outframe='LSRK',
+                   veltype='radio',
+                   mask=maskname,
+                   interactive=False,
+                   antenna=antennae,
+                   savemodel='modelcolumn',
+                   datacolumn='corrected', # now use corrected data
+                   pbcor=True,
+                   **impars_thisiter
+                  )
+            test_tclean_success()
+            sethistory(imname, impars=impars_thisiter, selfcalpars=selfcalpars, selfcaliter=selfcaliter)
+            # overwrite=True because these could already exist
+            exportfits(imname+".image.tt0", imname+".image.tt0.fits", overwrite=True)
+            exportfits(imname+".image.tt0.pbcor", imname+".image.tt0.pbcor.fits", overwrite=True)
+
+            # CHECK FOR MODEL FAILURES!
+            if not model_column_is_populated(selfcal_ms):
+                logprint("SEVERE error encountered: model column was not populated!"
+                         "Therefore, populated model column from {0}".format(imname),
+                         origin='almaimf_cont_selfcal')
                 populate_model_column(imname, selfcal_ms, field,
-                                      impars_thisiter, phasecenter, maskname,
+                                      copy.copy(impars_thisiter),
+                                      phasecenter, maskname,
                                       antennae)
+            checkpoint.record_image(selfcaliter, imname, cals, okfields_list)
+            checkpoint.record_ms_state(model_column=imname, corrected=applied)
 
 
         regsuffix = '_selfcal{2}_robust{0}_{1}'.format(robust, arrayname,
@@ -854,6 +978,8 @@ for continuum_ms in continuum_mses:
                      origin='contim_selfcal')
 
 
+        imname_lastiter, impars_lastiter = imname, impars_thisiter
+
         logprint("Completed gaincal iteration {0}".format(selfcaliter),
                  origin='contim_selfcal')
 
@@ -866,7 +992,6 @@ for continuum_ms in continuum_mses:
     # make sure the calibration tables have been applied, otherwise re-runs can
     # result in starting from un-corrected data
     if not dryrun:
-        clearcal(vis=selfcal_ms, addmodel=True)
         # use gainfield so we interpolate the good solutions to the other
         # fields
         assert len(cals) >= selfcaliter
@@ -878,10 +1003,11 @@ for continuum_ms in continuum_mses:
             okfields_list.append(okfields_str)
         assert len(cals) == len(okfields_list)
 
-        applycal(vis=selfcal_ms, gainfield=okfields_list, gaintable=cals,
-                 interp="linear", applymode='calonly', calwt=False)
+        apply_selfcal(checkpoint, selfcal_ms, cals, okfields_list)
 
 
+    # the robust values are imaged independently of each other
+    finaliter_jobs = []
     #for robust in (0, -2, 2, -1, 1, -0.5, 0.5):
     for robust in (0, -2, 2, -1, 1, -0.5, 0.5):
         logprint("Imaging self-cal iter {0} (final) with robust {1}"
@@ -960,26 +1086,34 @@ for continuum_ms in continuum_mses:
         if not dryrun:
             logprint("Final imaging parameters are: {0} for image name {1}".format(impars_finaliter, finaliterimname),
                      origin='almaimf_cont_selfcal')
-            tclean(vis=selfcal_ms,
-                   field=field,
-                   imagename=finaliterimname,
-                   phasecenter=phasecenter,
-                   startmodel=modelname,
-                   outframe='LSRK',
-                   veltype='radio',
-                   mask=maskname,
-                   interactive=False,
-                   antenna=antennae,
-                   savemodel='none',
-                   datacolumn='corrected',
-                   pbcor=True,
-                   **impars_finaliter
-                  )
-            test_tclean_success()
-            sethistory(finaliterimname, impars=impars_finaliter, selfcalpars=selfcalpars, selfcaliter=selfcaliter)
-            # overwrite=True because these could already exist
-            exportfits(finaliterimname+".image.tt0", finaliterimname+".image.tt0.fits", overwrite=True)
-            exportfits(finaliterimname+".image.tt0.pbcor", finaliterimname+".image.tt0.pbcor.fits", overwrite=True)
+            job = {'tclean': dict(vis=selfcal_ms,
+                                  field=field,
+                                  imagename=finaliterimname,
+                                  phasecenter=phasecenter,
+                                  startmodel=modelname,
+                                  outframe='LSRK',
+                                  veltype='radio',
+                                  mask=maskname,
+                                  interactive=False,
+                                  antenna=antennae,
+                                  savemodel='none',
+                                  datacolumn='corrected',
+                                  pbcor=True,
+                                  **impars_finaliter
+                                 ),
+                   'impars': impars_finaliter,
+                   'selfcalpars': selfcalpars,
+                   'selfcaliter': selfcaliter,
+                  }
+            if parallel_robust > 1:
+                finaliter_jobs.append([job])
+            else:
+                run_imaging_job(job)
+
+    if finaliter_jobs:
+        # savemodel='none': the MS is only read
+        run_imaging_sequences(finaliter_jobs, nprocs=parallel_robust,
+                              jobdir=imaging_root)
 
     imname = contimagename+"_robust0_dirty_postselfcal"
 
@@ -3,26 +3,121 @@
 
 try:
     from tasks import imregrid
-    from taskinit import iatool
+    from taskinit import iatool, tbtool
 except (ImportError,ModuleNotFoundError):
     # futureproofing: CASA 6 imports this way
     from casatasks import imregrid
-    from casatools import image
+    from casatools import image, table
     iatool = image
+    tbtool = table
 
 import shutil
 import os
+import json
+import hashlib
+
+import numpy as np
 
 from metadata_tools import logprint
+from imaging_stages import path_digest
 
 ia = iatool()
+tb = tbtool()
 
 # Notes:
 # 1) The output continuum_cube.model is what will be used as startmodel in tclean. It probably needs a better name within the pipeline framework
 # 2) robust0 cleanest model .tt0 and .tt1 are used to construct continuum_cube.model. A next level of complexity would be to use the robust 1 or
 # robust -1 continuum images depending on the robust param of the line tclean command.
 
-def create_clean_model(cubeimagename, contimagename, imaging_results_path, contmodel_path=None, cubeinsuffix='image'):
+def image_tile_shape(imagename):
+    """
+    The tile shape of a CASA image as stored on disk, or None if it cannot be
+    determined
+    """
+    tb.open(imagename)
+    try:
+        dminfo = tb.getdminfo()
+    finally:
+        tb.close()
+    for dm in dminfo.values():
+        if 'DEFAULTTILESHAPE' in dm.get('SPEC', {}):
+            return [int(x) for x in dm['SPEC']['DEFAULTTILESHAPE']]
+    return None
+
+
+def regrid_cache_key(sourcenames, template):
+    """
+    Cache key of the regrid of the images ``sourcenames`` onto the
+    ``imregrid`` template ``template``: it changes if any of the source
+    images change (see `imaging_stages.path_digest`) or if the target
+    shape or coordinate system do
+    """
+    def to_json(obj):
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        if isinstance(obj, np.generic):
+            return obj.item()
+        return str(obj)
+
+    key = json.dumps({'sources': [path_digest(fn) for fn in sourcenames],
+                      'shape': template['shap'],
+                      'csys': template['csys']},
+                     sort_keys=True, default=to_json)
+    return hashlib.md5(key.encode()).hexdigest()[:16]
+
+
+def cached_regrid(imagename, output, template):
+    """
+    ``imregrid`` ``imagename`` onto ``template`` into ``output``, unless
+    ``output`` already exists.  The regrid is written under a temporary name
+    and renamed once complete, so that concurrent jobs (e.g., the spws of a
+    field) never see a partial regrid.
+    """
+    if os.path.exists(output):
+        logprint("Reusing cached regrid {0}".format(output))
+        return output
+
+    tmpname = "{0}.{1}.tmp".format(output, os.getpid())
+    imregrid(imagename=imagename, output=tmpname, template=template, overwrite=True)
+    try:
+        os.rename(tmpname, output)
+    except OSError:
+        # another job finished the same regrid first
+        shutil.rmtree(tmpname)
+    return output
+
+
+def write_spectral_index_model(line_im, tt0_pixvalues, tt1_pixvalues, factors,
+                               chans_per_block):
+    """
+    Write ``tt0 + factor * tt1`` for each of the ``factors`` (one per
+    channel) into the open image ``line_im``, computed as one broadcast per
+    block of ``chans_per_block`` channels and written with one putchunk per
+    block.  The images are [ra, dec, stokes, freq]; tt0 and tt1 have a single
+    channel.
+    """
+    factors = np.asarray(factors)
+    for start in range(0, factors.size, chans_per_block):
+        block = (tt0_pixvalues +
+                 factors[None, None, None, start:start+chans_per_block] *
+                 tt1_pixvalues)
+        line_im.putchunk(block, blc=[0, 0, 0, start], replicate=False)
+
+
+def create_clean_model(cubeimagename, contimagename, imaging_results_path, contmodel_path=None, cubeinsuffix='image',
+                       max_pixels=2**26, regrid_cache=True):
+    """
+    Make ``<cubeimagename>.contcube.model`` in ``imaging_results_path``, the
+    continuum model (Taylor terms tt0 and tt1 of ``contimagename``)
+    extrapolated to every channel of the cube ``<cubeimagename>.<cubeinsuffix>``.
+
+    The continuum model is first regridded onto the cube's spatial grid.
+    With ``regrid_cache``, the regrids are stored in
+    ``<contmodel_path>/continuum_model_regrid_cache`` under a key made from
+    the continuum model and the target grid (see `regrid_cache_key`), so all
+    cubes of a field that share the spatial grid (i.e., all of its spws)
+    reuse one regrid, and only the spectral extrapolation is done per cube.
+    """
     #results_path = "./imaging_results/"  # imaging_results frmo the pipeline
     #contmodel_path = "./imaging_results_test_casatools/"  #Path with input and temporary continuum models
     if contmodel_path is None:
@@ -55,15 +150,27 @@ def create_clean_model(cubeimagename, contimagename, imaging_results_path, contm
     temp_dict_line['csys']['spectral2'] = temp_dict_cont_tt0['csys']['spectral2']
     temp_dict_line['csys']['worldreplace2'] = temp_dict_cont_tt0['csys']['worldreplace2']
 
-    tt0model = ("{contmodel_path}/{cubeimagename}_continuum_model.image.tt0"
-                .format(contmodel_path=contmodel_path,
-                        cubeimagename=cubeimagename))
-    tt1model = ("{contmodel_path}/{cubeimagename}_continuum_model.image.tt1"
-                .format(contmodel_path=contmodel_path,
-                        cubeimagename=cubeimagename))
-
-    imregrid(imagename=tt0name, output=tt0model, template=temp_dict_line, overwrite=True)
-    imregrid(imagename=tt1name, output=tt1model, template=temp_dict_line, overwrite=True)
+    if regrid_cache:
+        # the template has the cube's spatial axes and the continuum's single
+        # spectral channel, so it is the same for all spws of a field
+        cachedir = os.path.join(contmodel_path, "continuum_model_regrid_cache")
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir, exist_ok=True)
+        key = regrid_cache_key([tt0name, tt1name], temp_dict_line)
+        tt0model = cached_regrid(tt0name, os.path.join(cachedir, key+".image.tt0"),
+                                 temp_dict_line)
+        tt1model = cached_regrid(tt1name, os.path.join(cachedir, key+".image.tt1"),
+                                 temp_dict_line)
+    else:
+        tt0model = ("{contmodel_path}/{cubeimagename}_continuum_model.image.tt0"
+                    .format(contmodel_path=contmodel_path,
+                            cubeimagename=cubeimagename))
+        tt1model = ("{contmodel_path}/{cubeimagename}_continuum_model.image.tt1"
+                    .format(contmodel_path=contmodel_path,
+                            cubeimagename=cubeimagename))
+
+        imregrid(imagename=tt0name, output=tt0model, template=temp_dict_line, overwrite=True)
+        imregrid(imagename=tt1name, output=tt1model, template=temp_dict_line, overwrite=True)
 
     # Use CASA tools to create a model cube from the continuum model
     if os.path.exists(cubeoutmodelpath):
@@ -89,17 +196,21 @@ def create_clean_model(cubeimagename, contimagename, imaging_results_path, contm
     # dict_line['csys']['spectral2']['wcs']
     # dnu_plane: dnu with respect to cube reference freq.
     # dnu: dnu with respect to tt0 continuum reference
-    for plane in range(dict_line['shap'][-1]):
-        #logprint('Calculating continuum model for plane {}'.format(plane))
-        dnu_plane = (plane - dict_line['csys']['spectral2']['wcs']['crpix'])*dict_line['csys']['spectral2']['wcs']['cdelt']
-        nu_plane = dict_line['csys']['spectral2']['wcs']['crval'] + dnu_plane
-        #print(dnu_plane, nu_plane)
-        factor = (nu_plane - temp_dict_cont_tt0['csys']['spectral2']['wcs']['crval'])/temp_dict_cont_tt0['csys']['spectral2']['wcs']['crval']
-        #print(factor)
-        plane_pixvalues = (tt0_pixvalues + factor*tt1_pixvalues)
-        blc = [0, 0, 0, plane]
-        #trc = [line_im.shape()[0]-1, line_im.shape()[1]-1, 0, plane]
-        line_im.putchunk(plane_pixvalues, blc=blc, replicate=False)
+    planes = np.arange(dict_line['shap'][-1])
+    dnu_plane = (planes - dict_line['csys']['spectral2']['wcs']['crpix'])*dict_line['csys']['spectral2']['wcs']['cdelt']
+    nu_plane = dict_line['csys']['spectral2']['wcs']['crval'] + dnu_plane
+    factors = (nu_plane - temp_dict_cont_tt0['csys']['spectral2']['wcs']['crval'])/temp_dict_cont_tt0['csys']['spectral2']['wcs']['crval']
+
+    # write whole tiles at once, in blocks of at most ~max_pixels pixels
+    tileshape = image_tile_shape(cubeoutmodelpath)
+    tile_depth = tileshape[-1] if tileshape is not None else 1
+    plane_size = int(np.prod(tt0_pixvalues.shape))
+    chans_per_block = max(tile_depth, (max_pixels // plane_size) // tile_depth * tile_depth)
+    logprint("Writing continuum model {0} in blocks of {1} channels"
+             .format(cubeoutmodelpath, chans_per_block))
+
+    write_spectral_index_model(line_im, tt0_pixvalues, tt1_pixvalues, factors,
+                               chans_per_block)
     line_im.close()
 
     return cubeoutmodelpath
@@ -1,6 +1,7 @@
 """
 Cube finalizing:
 
+    0. Export the image, pbcor, and minimized ("mincube") FITS products
     1. Minimize the model, residual, and pb cubes
     2. Compute the PSF epsilon
     3. Create the JVM-corrected image and pb
@@ -11,7 +12,7 @@ import numpy as np
 import gzip
 import bz2 as bzip
 import os
-from beam_volume_tools import epsilon_from_psf, conv_model, rescale
+from beam_volume_tools import epsilon_from_psf, conv_model, rescale, psf_central_max
 from spectral_cube import SpectralCube
 from radio_beam.utils import BeamError
 
@@ -29,22 +30,181 @@ except ImportError:
     tqdm = False
 
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 multirowkeys = ('HISTORY', 'COMMENT')
 
-def gzip_file(fn):
-    with open(fn, "rb") as f_in:
-        with gzip.open(fn+".gz", "wb") as f_out:
-            f_out.writelines(f_in)
+def gzip_file(fn, nthreads=4, blocksize=64*1024**2, compresslevel=9):
+    """
+    Compress ``fn`` to ``fn.gz`` with ``nthreads`` threads.
+
+    The file is split into blocks of ``blocksize`` bytes that are compressed
+    independently (zlib releases the GIL) and written, in order, as the
+    members of a multi-member gzip file, which gzip, ``gzip.open``, and
+    astropy read as one stream.  At most ``2*nthreads`` blocks are held in
+    memory.  The output is written to a temporary file that is renamed when
+    it is complete, so an existing ``fn.gz`` is never partial.
+    """
+    with open(fn, "rb") as f_in, open(fn+".gz.tmp", "wb") as f_out:
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            members = []
+            while True:
+                block = f_in.read(blocksize)
+                if block:
+                    members.append(pool.submit(gzip.compress, block, compresslevel))
+                if members and (not block or len(members) >= 2*nthreads):
+                    f_out.write(members.pop(0).result())
+                if not block and not members:
+                    break
+    os.replace(fn+".gz.tmp", fn+".gz")
 
 def bzip_file(fn):
     with open(fn, "rb") as f_in:
         with bzip.open(fn+".bz2", "wb") as f_out:
             f_out.writelines(f_in)
 
+def _streaming_header(cube, shape):
+    """
+    A primary FITS header for streaming a float32 array of ``shape``
+    (nchan, ny, nx) with the WCS and metadata of ``cube``
+    """
+    header = fits.PrimaryHDU().header
+    header['BITPIX'] = -32
+    header['NAXIS'] = 3
+    # (the FITS standard requires NAXISn to follow NAXIS, i.e., to come
+    # before the EXTEND card of the default header)
+    previous = 'NAXIS'
+    for ii, size in enumerate(shape[::-1]):
+        header.insert(previous, ('NAXIS{0}'.format(ii+1), size), after=True)
+        previous = 'NAXIS{0}'.format(ii+1)
+    for key, value in cube.header.items():
+        if key not in header and key not in multirowkeys and key != 'EXTEND':
+            header[key] = value
+    return header
+
+
+def _beam_table(cube):
+    if hasattr(cube, 'beams'):
+        from spectral_cube.cube_utils import beams_to_bintable
+        return beams_to_bintable(cube.beams)
+
+
+def export_cube_products(basename, pbcutoff=0.2, nthreads=4,
+                         max_block_bytes=2*1024**3):
+    """
+    Write the FITS products of a cleaned cube in a single pass over the data.
+
+    The ``.image``, ``.pb``, ``.model``, and ``.residual`` CASA images are
+    each read once, in blocks of channels.  Each block is used to write
+    ``.image.fits``, ``.image.pbcor.fits`` (pixels with pb < ``pbcutoff`` are
+    blanked, as in ``impbcor``), and the ``.mincube.fits`` versions of the
+    image, pbcor, model, and residual, all cut to the bounding box of the
+    image mask.  The writes of one block run in a thread pool while the next
+    block is read.
+
+    Parameters
+    ----------
+    basename : str
+        The image name prefix
+    pbcutoff : float
+        Primary beam level below which the pbcor image is blanked
+    nthreads : int
+        Number of threads used for writing
+    max_block_bytes : int
+        Approximate memory budget for one block of all cubes
+
+    Returns
+    -------
+    cutslc : tuple of slices
+        The slices used to make the mincubes
+    """
+    t0 = time.time()
+
+    imcube = SpectralCube.read(basename+".image", format='casa_image', use_dask=True)
+    pbcube = SpectralCube.read(basename+".pb", format='casa_image', use_dask=True)
+    modcube = SpectralCube.read(basename+".model", format='casa_image', use_dask=True)
+    residcube = SpectralCube.read(basename+".residual", format='casa_image', use_dask=True)
+
+    # the mask is much smaller than the data, so scanning it first is cheap
+    cutslc = imcube.subcube_slices_from_mask(imcube.mask)
+    log.info(f"Mincube slices are {cutslc}.  t={time.time() - t0}")
+
+    nchan, ny, nx = imcube.shape
+    specslc, yslc, xslc = cutslc
+    minshape = (len(range(nchan)[specslc]), len(range(ny)[yslc]), len(range(nx)[xslc]))
+
+    # (filename, cube with the WCS, shape, which data array, cut or not)
+    products = [(basename+".image.fits", imcube, imcube.shape, 'image', False),
+                (basename+".image.pbcor.fits", imcube, imcube.shape, 'pbcor', False),
+                (basename+".image.mincube.fits", imcube[cutslc], minshape, 'image', True),
+                (basename+".image.pbcor.mincube.fits", imcube[cutslc], minshape, 'pbcor', True),
+                (basename+".model.mincube.fits", modcube[cutslc], minshape, 'model', True),
+                (basename+".residual.mincube.fits", residcube[cutslc], minshape, 'residual', True),
+               ]
+
+    # four cubes read plus the pbcor cube
+    chans_per_block = int(max(1, max_block_bytes // (5 * ny * nx * 4)))
+    blocks = [(lo, min(lo+chans_per_block, nchan))
+              for lo in range(0, nchan, chans_per_block)]
+
+    def read_block(lo, hi):
+        block = {'image': np.asarray(imcube.unitless_filled_data[lo:hi], dtype='float32'),
+                 'model': np.asarray(modcube.unitless_filled_data[lo:hi], dtype='float32'),
+                 'residual': np.asarray(residcube.unitless_filled_data[lo:hi], dtype='float32'),
+                }
+        pb = np.asarray(pbcube.unitless_filled_data[lo:hi], dtype='float32')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            block['pbcor'] = np.where(pb >= pbcutoff, block['image'] / pb, np.nan).astype('float32')
+        return block
+
+    streams = []
+    for filename, cube, shape, key, cut in products:
+        if os.path.exists(filename):
+            os.remove(filename)
+        header = _streaming_header(cube, shape)
+        header['FILENAME'] = os.path.basename(filename)
+        streams.append(fits.StreamingHDU(filename, header))
+
+    def write(stream, data):
+        stream.write(np.ascontiguousarray(data))
+
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        next_block = pool.submit(read_block, *blocks[0])
+        for ii, (lo, hi) in enumerate(blocks):
+            block = next_block.result()
+            if ii + 1 < len(blocks):
+                next_block = pool.submit(read_block, *blocks[ii+1])
+
+            # channel range of this block that falls within the mincube
+            clo, chi, _ = specslc.indices(nchan)
+            mlo, mhi = max(lo, clo), min(hi, chi)
+
+            writes = []
+            for stream, (filename, cube, shape, key, cut) in zip(streams, products):
+                if not cut:
+                    writes.append(pool.submit(write, stream, block[key]))
+                elif mhi > mlo:
+                    writes.append(pool.submit(write, stream,
+                                              block[key][mlo-lo:mhi-lo, yslc, xslc]))
+            for future in writes:
+                future.result()
+            log.info(f"Exported channels {lo}-{hi} of {nchan}.  t={time.time() - t0}")
+
+    for stream, (filename, cube, shape, key, cut) in zip(streams, products):
+        stream.close()
+        beamtable = _beam_table(cube)
+        if beamtable is not None:
+            fits.append(filename, beamtable.data, beamtable.header)
+
+    log.info(f"Completed export of {basename}.  t={time.time() - t0}")
+
+    return cutslc
+
+
 def beam_correct_cube(basename, minimize=True, pbcor=True, write_pbcor=True,
                       use_velocity=False,
-                      pbar=False, beam_threshold=0.1, save_to_tmp_dir=False):
+                      pbar=False, beam_threshold=0.1, save_to_tmp_dir=False,
+                      psf_cutout_factor=8, max_block_bytes=2*1024**3):
 
     if not pbar:
         pbar = contextlib.nullcontext()
@@ -73,7 +233,8 @@ def beam_correct_cube(basename, minimize=True, pbcor=True, write_pbcor=True,
 
     good_beams = psfcube.identify_bad_beams(0.1)
     log.info(f"Found {good_beams.sum()} good beams out of {good_beams.size} channels")
-    psf_max = psfcube.max(axis=(1,2))
+    # only the centre of the PSF is read, here and for epsilon
+    psf_max = psf_central_max(psfcube)
     good_beams &= (psf_max > 0)
     log.info(f"Found {good_beams.sum()} good beams out of {good_beams.size} channels after excluding PSFs with zero value")
 
@@ -132,85 +293,161 @@ def beam_correct_cube(basename, minimize=True, pbcor=True, write_pbcor=True,
 
     # there are sometimes problems with identifying a common beam
     try:
-        epsdict = epsilon_from_psf(psfcube, export_clean_beam=True, beam_threshold=beam_threshold, pbar=tpbar, max_epsilon=0.01)
+        epsdict = epsilon_from_psf(psfcube, export_clean_beam=True, beam_threshold=beam_threshold, pbar=tpbar, max_epsilon=0.01,
+                                   cutout_factor=psf_cutout_factor)
     except BeamError as ex:
         print(f"Exception {ex}")
         print("Needed to calculate commonbeam with epsilon=0.005", flush=True)
-        epsdict = epsilon_from_psf(psfcube, epsilon=0.005, export_clean_beam=True, beam_threshold=beam_threshold, pbar=tpbar)
+        epsdict = epsilon_from_psf(psfcube, epsilon=0.005, export_clean_beam=True, beam_threshold=beam_threshold, pbar=tpbar,
+                                   cutout_factor=psf_cutout_factor)
     log.info(f"Epsilon completed. t={time.time() - t0}, eps took {time.time()-teps}")
 
 
     clean_beam = epsdict['clean_beam']
 
-    log.info(f"Convolving.  t={time.time()-t0}")
-    with pbar:
-        convmod = conv_model(modcube, clean_beam, save_to_tmp_dir=save_to_tmp_dir)
-
-    log.info(f"Done convolving, now rescaling.  t={time.time()-t0}")
-
-    merged = rescale(convmod, epsdict['epsilon'],
-                     residual_image=residcube,
-                     export_fits=False
-                     )
-
-    log.info(f"Done rescaling.  t={time.time()-t0}")
+    epsilon = epsdict['epsilon']
+    epsilon_table = fits.BinTableHDU(Table(data=[epsilon], names=['JvM_epsilon'], dtype=[float]))
 
-
-    merged.meta.update(imcube.meta)
-    merged.header.update(imcube.header) # this was supposed to preserve header info but seems not to have
-    merged.meta['JvM_epsilon_max'] = np.max(epsdict['epsilon'])
-    merged.header['JvM_epsilon_max'] = np.max(epsdict['epsilon'])
-    merged.meta['JvM_epsilon_min'] = np.min(epsdict['epsilon'])
-    merged.header['JvM_epsilon_min'] = np.min(epsdict['epsilon'])
-    merged.meta['JvM_epsilon_median'] = np.median(epsdict['epsilon'])
-    merged.header['JvM_epsilon_median'] = np.median(epsdict['epsilon'])
-    epsilon_table = fits.BinTableHDU(Table(data=[epsdict['epsilon']], names=['JvM_epsilon'], dtype=[np.float]))
-
-    flatpb = pbcube.mean(axis=0)
-    flatpb.hdu.writeto(basename+".flatpb.fits", overwrite=True)
-
-    log.info(f"Beginning JvM write.  t={time.time()-t0}")
-    hdul = merged.hdulist
-    hdul.append(epsilon_table)
+    header = _streaming_header(modcube, modcube.shape)
+    for key in ('BMAJ', 'BMIN', 'BPA', 'CASAMBM'):
+        header.remove(key, ignore_missing=True)
+    header.update(clean_beam.to_header_keywords())
+    header['JvM_epsilon_max'] = np.max(epsilon)
+    header['JvM_epsilon_min'] = np.min(epsilon)
+    header['JvM_epsilon_median'] = np.median(epsilon)
     # add any missing header keywords
     for key in imcube.header:
         # don't overwrite any WCS though
-        if key not in hdul[0].header and key not in multirowkeys:
-            hdul[0].header[key] = imcube.header[key]
+        if key not in header and key not in multirowkeys:
+            header[key] = imcube.header[key]
     for multirowkey in multirowkeys:
         if multirowkey in imcube.header:
-            hdul[0].header[multirowkey] = ''
+            header[multirowkey] = ''
             for row in imcube.header[multirowkey]:
-                hdul[0].header[multirowkey] = row
+                header[multirowkey] = row
     # need to manually specify units b/c none of the model, residual, etc. have them!
-    hdul[0].header['BUNIT'] = 'Jy/beam'
-    hdul[0].header['CREDIT'] = 'Please cite Ginsburg et al 2022A&A...662A...9G when using these data, and Motte et al 2022A&A...662A...8M for the ALMA-IMF program.  Cunningham et al (2023) describes the line data.'
-    hdul[0].header['BIBCODE'] = '2022A&A...662A...9G,2022A&A...662A...8M'
-    hdul[0].header['FILENAME'] = basename+".JvM.image.fits"
+    header['BUNIT'] = 'Jy/beam'
+    header['CREDIT'] = 'Please cite Ginsburg et al 2022A&A...662A...9G when using these data, and Motte et al 2022A&A...662A...8M for the ALMA-IMF program.  Cunningham et al (2023) describes the line data.'
+    header['BIBCODE'] = '2022A&A...662A...9G,2022A&A...662A...8M'
+
+    log.info(f"Beginning JvM convolution, rescaling, and write.  t={time.time()-t0}")
+    jvm_filename = basename+".JvM.image.fits"
+    pbcor_filename = basename+".JvM.image.pbcor.fits" if pbcor and write_pbcor else None
     with pbar:
-        hdul.writeto(basename+".JvM.image.fits", overwrite=True)
+        flatpb = write_jvm_cubes(modcube, residcube, pbcube if pbcor else None,
+                                 clean_beam, epsilon, header,
+                                 jvm_filename, pbcor_filename,
+                                 max_block_bytes=max_block_bytes,
+                                 save_to_tmp_dir=save_to_tmp_dir)
     log.info(f"Done JvM write.  t={time.time()-t0}")
 
-    header = hdul[0].header
+    for filename in (jvm_filename, pbcor_filename):
+        if filename is not None:
+            fits.append(filename, epsilon_table.data, epsilon_table.header)
+
+    if pbcor:
+        fits.PrimaryHDU(data=flatpb, header=pbcube[0].hdu.header).writeto(basename+".flatpb.fits", overwrite=True)
 
+    merged = SpectralCube.read(jvm_filename)
     if pbcor:
-        log.info(f"Beginning pbcor.  t={time.time()-t0}")
-        pbc = merged / pbcube
-        log.info(f"Done pbcor.  t={time.time()-t0}")
-        if write_pbcor:
-            log.info(f"Creating HDUlist.  t={time.time()-t0}")
-            hdul = pbc.hdulist
-            # copy header from non-pbcor
-            hdul[0].header = header
-            hdul[0].header['FILENAME'] = basename+".JvM.image.pbcor.fits"
-            log.info(f"appending epsilon table.  t={time.time()-t0}")
-            hdul.append(epsilon_table)
-            log.info(f"changing dtype.  t={time.time()-t0}")
-            with pbar:
-                hdul[0].data = hdul[0].data.astype('float32')
-                log.info(f"writing HDUL.  t={time.time()-t0}")
-                hdul.writeto(basename+".JvM.image.pbcor.fits", overwrite=True)
-            log.info(f"Done writing pbcor.  t={time.time()-t0}")
+        pbc = SpectralCube.read(pbcor_filename) if write_pbcor else merged / pbcube
         return merged, pbc
 
     return merged
+
+
+def _create_fits(filename, header):
+    """
+    Create ``filename`` with primary ``header`` and a zero-filled data array
+    of the size it describes, and open it memory-mapped for writing
+    """
+    header = header.copy()
+    header['FILENAME'] = os.path.basename(filename)
+    shape = tuple(header['NAXIS{0}'.format(ii)] for ii in range(header['NAXIS'], 0, -1))
+    header_bytes = header.tostring().encode()
+    data_bytes = int(np.prod(shape)) * np.abs(header['BITPIX']) // 8
+    # FITS files are made of 2880-byte blocks
+    nbytes = len(header_bytes) + int(np.ceil(data_bytes / 2880.)) * 2880
+    with open(filename, 'wb') as fh:
+        fh.write(header_bytes)
+        fh.seek(nbytes - 1)
+        fh.write(b'\0')
+    return fits.open(filename, mode='update', memmap=True)
+
+
+def write_jvm_cubes(modcube, residcube, pbcube, clean_beam, epsilon, header,
+                    filename, pbcor_filename=None, max_block_bytes=2*1024**3,
+                    save_to_tmp_dir=False):
+    """
+    Make the JvM-corrected cube, the model convolved to ``clean_beam`` plus
+    the residual scaled by ``epsilon`` (see `beam_volume_tools.conv_model` and
+    `beam_volume_tools.rescale`), and its pb-corrected version, and write them
+    to ``filename`` and ``pbcor_filename`` with the primary ``header``.
+
+    The cubes are processed in blocks of channels and each block is written
+    to memory-mapped FITS files, so that only one block of the model,
+    residual, pb, and output cubes is held in memory at a time.
+
+    Parameters
+    ----------
+    modcube, residcube, pbcube : `spectral_cube.SpectralCube`
+        The model, residual, and primary beam cubes; ``pbcube`` may be None
+        if no pb-corrected cube is written
+    clean_beam : `radio_beam.Beam`
+        The beam to convolve the model to
+    epsilon : array
+        The ratio of the clean to the dirty beam volume for each channel
+    header : `astropy.io.fits.Header`
+        The primary header of the output files
+    filename : str
+        The output JvM-corrected cube
+    pbcor_filename : str or None
+        The output pb-corrected cube, if any
+    max_block_bytes : int
+        Approximate memory budget for one block of channels
+    save_to_tmp_dir : bool
+        Passed to `beam_volume_tools.conv_model`
+
+    Returns
+    -------
+    flatpb : np.ndarray or None
+        The mean of ``pbcube`` over channels, if it was given
+    """
+    nchan, ny, nx = modcube.shape
+    # model, convolved model (and its complex FFTs), residual, pb, and outputs
+    chans_per_block = int(max(1, max_block_bytes // (12 * ny * nx * 8)))
+
+    hduls = [_create_fits(filename, header)]
+    if pbcor_filename is not None:
+        hduls.append(_create_fits(pbcor_filename, header))
+
+    if pbcube is not None:
+        pbsum = np.zeros([ny, nx])
+        pbcount = np.zeros([ny, nx])
+
+    try:
+        for lo in range(0, nchan, chans_per_block):
+            hi = min(lo + chans_per_block, nchan)
+
+            convmod = conv_model(modcube[lo:hi], clean_beam, save_to_tmp_dir=save_to_tmp_dir)
+            residual = np.asarray(residcube[lo:hi].unitless_filled_data[:])
+            restored = np.asarray(convmod.unitless_filled_data[:]) + residual*epsilon[lo:hi, None, None]
+            hduls[0][0].data[lo:hi] = restored
+
+            if pbcube is not None:
+                pb = np.asarray(pbcube[lo:hi].unitless_filled_data[:])
+                if pbcor_filename is not None:
+                    hduls[1][0].data[lo:hi] = restored / pb
+                pbsum += np.nansum(pb, axis=0)
+                pbcount += np.isfinite(pb).sum(axis=0)
+
+            for hdul in hduls:
+                hdul.flush()
+            log.info(f"Wrote JvM-corrected channels {lo}-{hi} of {nchan}")
+    finally:
+        for hdul in hduls:
+            hdul.close()
+
+    if pbcube is not None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (pbsum / pbcount).astype('float32')
@@ -0,0 +1,174 @@
+"""
+Channel-range sharding of cube imaging.
+
+A cube is split into ``nshards`` disjoint, contiguous channel ranges that are
+imaged as independent jobs (e.g., the tasks of a SLURM job array) on exactly
+the same spectral grid as the full cube, then merged back together along the
+spectral axis.  Each shard restores with its own per-channel beams, and the
+merge keeps them.
+"""
+import os
+import shutil
+
+import numpy as np
+import astropy.units as u
+
+try:
+    from taskinit import iatool, mstool, msmdtool
+except (ImportError,ModuleNotFoundError):
+    from casatools import image, ms as mstool, msmetadata
+    iatool = image
+    msmdtool = msmetadata
+
+from metadata_tools import logprint
+
+
+# the images that make up a tclean cube; all but the first five are optional
+SHARD_IMAGE_SUFFIXES = ('.image', '.residual', '.model', '.psf', '.pb',
+                        '.mask', '.sumwt', '.weight')
+
+
+def shard_suffix(index, nshards):
+    """ Suffix added to the image name of shard ``index`` of ``nshards`` """
+    return ".shard{0:03d}of{1:03d}".format(index, nshards)
+
+
+def shard_channel_ranges(nchan, nshards):
+    """
+    Split ``nchan`` channels into ``nshards`` contiguous ranges whose lengths
+    differ by at most one channel.
+
+    Returns
+    -------
+    ranges : list of (first, last) tuples
+        Inclusive channel ranges
+    """
+    if nshards > nchan:
+        raise ValueError("Cannot split {0} channels into {1} shards"
+                         .format(nchan, nshards))
+    edges = np.linspace(0, nchan, nshards + 1).round().astype('int')
+    return [(int(first), int(last) - 1) for first, last in zip(edges[:-1], edges[1:])]
+
+
+def full_spectral_grid(vis, field):
+    """
+    The default full-cube spectral grid (LSRK start frequency, channel width,
+    and number of channels) of ``field`` covering all of its spectral windows
+    in ``vis``.
+
+    Sharded runs image on this explicit grid (rather than letting tclean pick
+    one for each shard), so that the shards tile the cube exactly.
+    """
+    if isinstance(vis, str):
+        vis = [vis]
+
+    freqs = []
+    for vv in vis:
+        msmd = msmdtool()
+        msmd.open(vv)
+        spws = msmd.spwsforfield(field)
+        msmd.close()
+
+        ms = mstool()
+        ms.open(vv)
+        for spw in spws:
+            try:
+                freqs.append(ms.cvelfreqs(spwids=[spw], outframe='LSRK'))
+            except TypeError:
+                freqs.append(ms.cvelfreqs(spwid=[spw], outframe='LSRK'))
+        ms.close()
+
+    width = np.min([np.abs(np.diff(ff)).min() for ff in freqs if len(ff) > 1])
+    fmin = np.min([ff.min() for ff in freqs])
+    fmax = np.max([ff.max() for ff in freqs])
+    nchan = int(np.round((fmax - fmin) / width)) + 1
+
+    return '{0!r}Hz'.format(float(fmin)), '{0!r}Hz'.format(float(width)), nchan
+
+
+def shard_impars(impars, index, nshards, vis, field):
+    """
+    Imaging parameters for shard ``index`` of ``nshards``: the spectral grid
+    of the full cube (``start``, ``width``, ``nchan``, in whatever units
+    ``impars`` gives them, or the default grid from `full_spectral_grid`)
+    restricted to the shard's channel range.
+
+    Returns
+    -------
+    impars : dict
+    first, last : int
+        The shard's (inclusive) channel range in the full cube
+    """
+    impars = impars.copy()
+    if 'nchan' in impars and 'start' in impars and 'width' in impars:
+        start, width, nchan = impars['start'], impars['width'], impars['nchan']
+    else:
+        start, width, nchan = full_spectral_grid(vis, field)
+
+    first, last = shard_channel_ranges(nchan, nshards)[index]
+
+    start = u.Quantity(start)
+    width = u.Quantity(width)
+    # CASA quanta do not accept the spaces in astropy's unit strings
+    impars['start'] = '{0!r}{1}'.format(float((start + first * width).value),
+                                         start.unit.to_string().replace(' ', ''))
+    impars['width'] = '{0!r}{1}'.format(float(width.value),
+                                         width.unit.to_string().replace(' ', ''))
+    impars['nchan'] = last - first + 1
+    # the shards are the chunks
+    impars.pop('chanchunks', None)
+
+    return impars, first, last
+
+
+def merge_shard_images(imagename, nshards, shardname=None,
+                       suffixes=SHARD_IMAGE_SUFFIXES, overwrite=False):
+    """
+    Concatenate the images of all shards of ``imagename`` along the spectral
+    axis into ``imagename+suffix``.  The shards are named ``shardname +
+    shard_suffix(index, nshards) + suffix``; ``shardname`` defaults to
+    ``imagename``.
+
+    The merged images are written under a temporary name and renamed once
+    complete.  Per-channel restoring beams are carried over from the shards.
+    Optional images (see `SHARD_IMAGE_SUFFIXES`) are skipped unless every
+    shard has them.
+    """
+    if shardname is None:
+        shardname = imagename
+    shardnames = [shardname + shard_suffix(ii, nshards) for ii in range(nshards)]
+
+    for suffix in suffixes:
+        infiles = [name + suffix for name in shardnames]
+        missing = [fn for fn in infiles if not os.path.exists(fn)]
+        if missing:
+            if suffix in SHARD_IMAGE_SUFFIXES[:5]:
+                raise IOError("Cannot merge {0}: shard images {1} are missing"
+                              .format(imagename+suffix, missing))
+            logprint("Not merging {0}: shard images {1} are missing"
+                     .format(imagename+suffix, missing))
+            continue
+
+        outfile = imagename + suffix
+        if os.path.exists(outfile):
+            if not overwrite:
+                raise IOError("Merged image {0} exists".format(outfile))
+            shutil.rmtree(outfile)
+
+        tmpfile = outfile + ".merging"
+        if os.path.exists(tmpfile):
+            shutil.rmtree(tmpfile)
+
+        ia = iatool()
+        ia.open(infiles[0])
+        spectral_axis = ia.coordsys().findcoordinate('spectral')['pixel'][0]
+        ia.close()
+
+        logprint("Concatenating {0} shards into {1}".format(nshards, outfile))
+        # relax=False: the shards must have identical coordinates apart from
+        # contiguous spectral axes
+        merged = ia.imageconcat(outfile=tmpfile, infiles=infiles,
+                                axis=spectral_axis, relax=False,
+                                tempclose=True, overwrite=True)
+        merged.done()
+        os.rename(tmpfile, outfile)
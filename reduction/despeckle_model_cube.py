@@ -1,6 +1,8 @@
 from spectral_cube import SpectralCube
 import numpy as np
 import os
+import dask.array as da
+from scipy import ndimage
 import astropy.units as u
 from astropy import constants
 try:
@@ -46,3 +48,102 @@ def despeckle_model_image(basename, threshold_factor=4.0, median_npix=3):
             ia.putchunk(pixels=modslc.T.astype('float64'), blc=[-1,-1,-1,ii])
 
     ia.close()
+
+
+class _CasaImageBlocks(object):
+    """
+    Array-like access to a CASA image for `dask.array.from_array` and
+    `dask.array.store`: slicing reads and assignment writes blocks with
+    ``ia.getchunk`` / ``ia.putchunk``.  Axes are in numpy order, i.e.,
+    reversed from CASA's, i.e., (freq, stokes, dec, ra).
+    """
+    def __init__(self, imagename):
+        self.imagename = imagename
+        ia.open(imagename)
+        self.shape = tuple(int(x) for x in ia.shape()[::-1])
+        ia.close()
+        self.dtype = np.dtype('float32')
+        self.ndim = len(self.shape)
+
+    def _corners(self, item):
+        blc = [sl.start or 0 for sl in item]
+        trc = [(sl.stop if sl.stop is not None else size) - 1
+               for sl, size in zip(item, self.shape)]
+        return blc[::-1], trc[::-1]
+
+    def __getitem__(self, item):
+        blc, trc = self._corners(item)
+        ia.open(self.imagename)
+        try:
+            return ia.getchunk(blc=blc, trc=trc).T.astype(self.dtype)
+        finally:
+            ia.close()
+
+    def __setitem__(self, item, value):
+        blc, trc = self._corners(item)
+        ia.open(self.imagename)
+        try:
+            ia.putchunk(pixels=np.asarray(value).T.astype('float64'), blc=blc)
+        finally:
+            ia.close()
+
+
+def _despeckle_block(block, threshold_factor, median_npix):
+    """
+    Replace the pixels of a (freq, stokes, dec, ra) block that deviate from
+    the spectral running median by more than ``threshold_factor`` (as a
+    fraction of the median) with the median
+    """
+    filt = ndimage.median_filter(block, size=(median_npix, 1, 1, 1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        deviation = (block - filt) / filt
+    reject = np.abs(deviation) > threshold_factor
+    return np.where(reject, filt, block)
+
+
+def despeckle_model_image_dask(basename, threshold_factor=4.0, median_npix=3,
+                               max_memory_mb=1024):
+    """
+    Same as `despeckle_model_image`, but processed blockwise with dask over
+    spatial tiles that each hold all channels: the median filter and the
+    rejection are computed for the whole spectral range of a tile at once, and
+    the model is rewritten in a single streaming pass, one tile at a time.
+
+    Parameters
+    ----------
+    basename : str
+        The image name; ``basename+".model"`` is despeckled in place
+    threshold_factor : float
+        Pixels deviating from the spectral median by more than this factor
+        (relative to the median) are replaced with the median
+    median_npix : int
+        Width of the spectral median filter in channels
+    max_memory_mb : float
+        Memory bound for one tile, in MB: the input, the filtered version, and
+        the intermediate arrays of all channels of the tile, and the double
+        precision copies made to read and write it with the CASA image tool
+    """
+    image = _CasaImageBlocks(basename+".model")
+    nchan, nstokes, ny, nx = image.shape
+
+    # for each spatial pixel: the input, filtered, deviation, and output
+    # arrays, plus the float64 arrays from getchunk (before the conversion of
+    # the input) and for putchunk (the converted output)
+    bytes_per_pixel = nstokes * nchan * (image.dtype.itemsize * 4 +
+                                         np.dtype('float64').itemsize * 2)
+    tile = int((max_memory_mb * 1024**2 / bytes_per_pixel)**0.5)
+    if tile < 1:
+        raise ValueError("max_memory_mb={0} is too small to hold all {1} channels "
+                         "of a single pixel".format(max_memory_mb, nchan))
+    tile = min(tile, max(ny, nx))
+    print("Despeckling {0} in {1}x{1} pixel tiles of {2} channels"
+          .format(basename+".model", tile, nchan))
+
+    data = da.from_array(image, chunks=(nchan, nstokes, tile, tile),
+                         lock=True, asarray=False)
+    despeckled = data.map_blocks(_despeckle_block, threshold_factor, median_npix,
+                                 dtype=image.dtype)
+
+    # the CASA image tool is not thread-safe: read and write one tile at a time
+    da.store(despeckled, image, lock=True, scheduler='synchronous')
+
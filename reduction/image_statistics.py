@@ -0,0 +1,332 @@
+"""
+Out-of-core robust statistics (median, MAD) of large images.
+
+The estimator streams over the data in chunks and refines the location of
+the requested order statistics with histograms, so memory use is bounded by
+the chunk size and the number of histogram bins, and the result is exact and
+deterministic (it does not depend on the chunking).  Each refinement pass
+reads the data once; typically two or three passes are needed per quantity.
+
+The per-channel lower and upper medians (the order statistics ``(n-1)//2``
+and ``n//2``) are computed exactly along the way and are used to bracket the
+global values: the global lower and upper medians lie between the smallest
+lower and the largest upper channel median, and likewise for the MAD, with
+the channel deviations shifted by ``|m_c - m|``.  Should a bracket
+nevertheless not contain the requested order statistics, it is widened to
+the full range of the data.
+"""
+import numpy as np
+
+try:
+    from taskinit import iatool
+except ImportError:
+    try:
+        from casatools import image as iatool
+    except ImportError:
+        # only casa_image_chunks needs CASA; the statistics need numpy only
+        iatool = None
+
+# MAD -> sigma for a normal distribution
+mad_to_std = 1.482602218505602
+
+
+def casa_image_chunks(imagename, max_pixels=2**26):
+    """
+    Return a function that iterates over a CASA image in blocks of whole
+    channels, yielding ``(first_channel, data)`` where ``data`` has shape
+    ``(nchan_block, npix)`` with masked pixels set to NaN.
+
+    ``max_pixels`` bounds the number of pixels read at once.
+    """
+    ia = iatool()
+    ia.open(imagename)
+    shape = ia.shape()
+    spectral_axis = ia.coordsys().findcoordinate('spectral')['pixel'][0]
+    ia.close()
+
+    nchan = shape[spectral_axis]
+    npix_per_chan = int(np.prod(shape)) // nchan
+    chans_per_block = int(max(1, max_pixels // npix_per_chan))
+
+    def chunks():
+        ia = iatool()
+        ia.open(imagename)
+        try:
+            for start in range(0, nchan, chans_per_block):
+                stop = min(start + chans_per_block, nchan) - 1
+                blc = [0] * len(shape)
+                trc = [-1] * len(shape)
+                blc[spectral_axis] = start
+                trc[spectral_axis] = stop
+                data = ia.getchunk(blc=blc, trc=trc)
+                # CASA masks are True for good pixels
+                mask = ia.getchunk(blc=blc, trc=trc, getmask=True)
+                data = np.where(mask, data, np.nan)
+                data = np.moveaxis(data, spectral_axis, 0)
+                yield start, data.reshape(data.shape[0], -1)
+        finally:
+            ia.close()
+
+    return chunks
+
+
+def array_chunks(data, chans_per_block=16):
+    """
+    Like `casa_image_chunks`, but for an in-memory array whose first axis is
+    the spectral axis
+    """
+    data = np.asarray(data)
+
+    def chunks():
+        for start in range(0, data.shape[0], chans_per_block):
+            block = data[start:start+chans_per_block]
+            yield start, block.reshape(block.shape[0], -1)
+
+    return chunks
+
+
+def _select_ranks(chunks, transform, ranks, lo, hi, nbins, max_exact,
+                  full_range=None):
+    """
+    Find the values of order statistics ``ranks`` (0-indexed, ascending) of
+    ``transform(data)`` over all finite data, which are expected to lie in
+    ``[lo, hi]``.  If they do not, the search is restarted on ``full_range``,
+    the range of all of the transformed data.
+
+    Values equal to either end of the bracket are counted rather than
+    collected, so that ties (e.g., the zeros of a mostly empty model cube)
+    cost no memory, and at most ``max_exact`` values strictly inside the
+    bracket are ever collected.
+    """
+    requested = list(ranks)
+    kmin, kmax = min(ranks), max(ranks)
+    results = {}
+    while True:
+        below = n_lo = n_hi = 0
+        hist = np.zeros(nbins, dtype='int64')
+        inside_min, inside_max = np.inf, -np.inf
+        # too narrow to bin in floating point: count the distinct values
+        # (of which there are at most a few per bin) instead
+        narrow = hi - lo < 4 * nbins * np.spacing(max(abs(lo), abs(hi)))
+        distinct = {}
+        for start, block in chunks():
+            values = transform(block[np.isfinite(block)])
+            below += np.count_nonzero(values < lo)
+            n_lo += np.count_nonzero(values == lo)
+            n_hi += np.count_nonzero(values == hi) if hi != lo else 0
+            inside = values[(values > lo) & (values < hi)]
+            if inside.size:
+                if narrow:
+                    for value, count in zip(*np.unique(inside, return_counts=True)):
+                        distinct[value] = distinct.get(value, 0) + count
+                else:
+                    hist += np.histogram(inside, bins=nbins, range=(lo, hi))[0]
+                inside_min = min(inside_min, inside.min())
+                inside_max = max(inside_max, inside.max())
+
+        ninside = sum(distinct.values()) if narrow else hist.sum()
+        above = below + n_lo + ninside + n_hi
+        if below > kmin or above <= kmax or above == below:
+            if full_range is None or (lo, hi) == tuple(full_range):
+                raise ValueError("The order statistics are not within [{0}, {1}]"
+                                 .format(lo, hi))
+            lo, hi = full_range
+            continue
+
+        # ranks that fall on the values at the ends of the bracket
+        todo = []
+        for rank in ranks:
+            if rank < below + n_lo:
+                results[rank] = float(lo)
+            elif rank >= below + n_lo + ninside:
+                results[rank] = float(hi)
+            else:
+                todo.append(rank)
+        if not todo:
+            break
+
+        if narrow:
+            values = sorted(distinct)
+            cumulative = below + n_lo + np.cumsum([distinct[value] for value in values])
+            for rank in todo:
+                results[rank] = float(values[np.searchsorted(cumulative, rank, side='right')])
+            break
+
+        if ninside <= max_exact:
+            collected = []
+            for start, block in chunks():
+                values = transform(block[np.isfinite(block)])
+                collected.append(values[(values > lo) & (values < hi)])
+            collected = np.sort(np.concatenate(collected))
+            for rank in todo:
+                results[rank] = float(collected[rank - below - n_lo])
+            break
+
+        # narrow the bracket to the bins containing the remaining ranks
+        cumulative = below + n_lo + np.cumsum(hist)
+        edges = np.linspace(lo, hi, nbins + 1)
+        first_bin = np.searchsorted(cumulative, min(todo), side='right')
+        last_bin = np.searchsorted(cumulative, max(todo), side='right')
+        # (keep a one-bin margin against rounding in the bin assignment; the
+        # bracket always shrinks, since the values at its ends are excluded)
+        lo = max(edges[max(first_bin - 1, 0)], inside_min)
+        hi = min(edges[min(last_bin + 2, nbins)], inside_max)
+        kmin, kmax = min(todo), max(todo)
+        ranks = todo
+
+    return [results[rank] for rank in requested]
+
+
+def _lower_upper_median(values):
+    """ The order statistics ``(n-1)//2`` and ``n//2`` of ``values`` """
+    ranks = _median_ranks(values.size)
+    lower, upper = np.partition(values, ranks)[ranks]
+    return lower, upper
+
+
+def _median_ranks(npts):
+    return [(npts - 1) // 2, npts // 2]
+
+
+def robust_statistics(chunks, nbins=2**16, max_exact=2**22):
+    """
+    Exact median and median absolute deviation from the median (MAD) of all
+    finite values produced by ``chunks``, plus the same quantities for each
+    channel.
+
+    Parameters
+    ----------
+    chunks : callable
+        Returns an iterator over ``(first_channel, data)`` blocks; see
+        `casa_image_chunks`.  It is called once per pass.
+    nbins : int
+        Number of histogram bins per refinement pass
+    max_exact : int
+        Once at most this many values remain as candidates, they are collected
+        and sorted
+
+    Returns
+    -------
+    stats : dict
+        ``median``, ``mad``, ``rms`` (``1.4826 * mad``), ``min``, ``max``,
+        ``npts``, and the per-channel arrays ``channel_median``,
+        ``channel_mad``, ``channel_rms``, ``channel_max``, and
+        ``channel_npts``.  Channels with no valid data have NaN statistics.
+    """
+    # per channel: lower and upper median, lower and upper MAD, min, max
+    channel_stats, channel_npts = {}, {}
+    for start, block in chunks():
+        for ii, chan in enumerate(block):
+            chan = chan[np.isfinite(chan)]
+            channel_npts[start + ii] = chan.size
+            if chan.size == 0:
+                channel_stats[start + ii] = [np.nan] * 6
+                continue
+            med_lo, med_hi = _lower_upper_median(chan)
+            mad_lo, mad_hi = _lower_upper_median(np.abs(chan - (med_lo + med_hi) / 2.))
+            channel_stats[start + ii] = [med_lo, med_hi, mad_lo, mad_hi,
+                                         chan.min(), chan.max()]
+
+    nchan = max(channel_npts) + 1
+    (channel_median_lo, channel_median_hi, channel_mad_lo, channel_mad_hi,
+     channel_min, channel_max) = np.array([channel_stats[ii] for ii in range(nchan)],
+                                          dtype='float').T
+    channel_npts = np.array([channel_npts[ii] for ii in range(nchan)])
+    # (the same as np.median)
+    channel_median = (channel_median_lo + channel_median_hi) / 2.
+    channel_mad = (channel_mad_lo + channel_mad_hi) / 2.
+
+    npts = int(channel_npts.sum())
+    if npts == 0:
+        raise ValueError("There are no valid data")
+    good = channel_npts > 0
+
+    data_min = np.min(channel_min[good])
+    data_max = np.max(channel_max[good])
+
+    median = np.mean(_select_ranks(chunks, lambda x: x, _median_ranks(npts),
+                                   lo=np.min(channel_median_lo[good]),
+                                   hi=np.max(channel_median_hi[good]),
+                                   nbins=nbins, max_exact=max_exact,
+                                   full_range=(data_min, data_max)))
+
+    offset = np.abs(channel_median[good] - median)
+    mad = np.mean(_select_ranks(chunks, lambda x: np.abs(x - median),
+                                _median_ranks(npts),
+                                lo=max(0, np.min(channel_mad_lo[good] - offset)),
+                                hi=np.max(channel_mad_hi[good] + offset),
+                                nbins=nbins, max_exact=max_exact,
+                                full_range=(0, max(data_max - median, median - data_min))))
+
+    return {'median': float(median),
+            'mad': float(mad),
+            'rms': float(mad * mad_to_std),
+            'min': float(data_min),
+            'max': float(data_max),
+            'npts': npts,
+            'channel_median': channel_median,
+            'channel_mad': channel_mad,
+            'channel_rms': channel_mad * mad_to_std,
+            'channel_max': channel_max,
+            'channel_npts': channel_npts,
+           }
+
+
+def robust_image_statistics(imagename, max_pixels=2**26, **kwargs):
+    """
+    `robust_statistics` of a CASA image, read in blocks of at most
+    ``max_pixels`` pixels
+    """
+    return robust_statistics(casa_image_chunks(imagename, max_pixels=max_pixels),
+                             **kwargs)
+
+
+def group_channels_by_noise(channel_rms, tolerance=0.1, min_nchan=1):
+    """
+    Split a spectrum of per-channel noise into contiguous groups of channels
+    whose rms agrees with the first channel of the group to within
+    ``tolerance`` (fractional).
+
+    Channels with no valid data (NaN or None rms) join the group they fall
+    in.  Groups shorter than ``min_nchan`` are merged into the neighbouring
+    group whose median rms is closest.
+
+    Returns
+    -------
+    groups : list of (first, last) tuples
+        Inclusive channel ranges covering all channels
+    """
+    rms = np.array([np.nan if x is None else x for x in channel_rms], dtype='float')
+
+    groups = []
+    first, ref = 0, np.nan
+    for ii, value in enumerate(rms):
+        if np.isnan(value):
+            continue
+        if np.isnan(ref):
+            ref = value
+        elif np.abs(value - ref) > tolerance * ref:
+            groups.append([first, ii - 1])
+            first, ref = ii, value
+    groups.append([first, len(rms) - 1])
+
+    def group_rms(group):
+        values = rms[group[0]:group[1]+1]
+        values = values[np.isfinite(values)]
+        return np.median(values) if values.size else np.nan
+
+    while len(groups) > 1:
+        lengths = [last - first + 1 for first, last in groups]
+        shortest = int(np.argmin(lengths))
+        if lengths[shortest] >= min_nchan:
+            break
+        neighbours = [ii for ii in (shortest - 1, shortest + 1)
+                      if 0 <= ii < len(groups)]
+        this_rms = group_rms(groups[shortest])
+        distance = [np.abs(group_rms(groups[ii]) - this_rms) for ii in neighbours]
+        # NaN distances (groups without data) sort last
+        target = neighbours[int(np.argmin(np.nan_to_num(distance, nan=np.inf)))]
+        lo, hi = sorted((shortest, target))
+        groups[lo:hi+1] = [[groups[lo][0], groups[hi][1]]]
+
+    return [tuple(group) for group in groups]
@@ -0,0 +1,302 @@
+"""
+Bookkeeping for resumable, multi-stage imaging runs.
+
+Each imaging target (e.g., one line cube) gets a JSON state file that records
+which stages have completed, how long each took, how much each raised the
+peak memory use, and a digest of each stage's output products.  On a subsequent run, a stage is
+skipped only if it, and everything it depends on, completed and its products
+are unchanged on disk.  Re-running a stage invalidates all stages downstream
+of it.
+
+The digests are computed from the names, sizes, and modification times of
+the files making up each product (CASA images are directories), not from
+their contents: checksumming 100 GB cubes on every resume would cost more
+than some of the stages.
+"""
+import os
+import json
+import time
+import hashlib
+import resource
+import contextlib
+
+from metadata_tools import logprint
+
+
+# The stages of line_imaging.py, in execution order.
+# Each entry is (name, dependencies, product suffixes written by the stage).
+LINE_IMAGING_STAGES = (
+    ('psf', (), ('.psf', '.pb', '.sumwt', '.weight')),
+    ('dirty', ('psf',), ('.residual', '.pb', '.sumwt', '.weight')),
+    ('noise', ('dirty',), ()),
+    ('startmodel', ('dirty',), ('.contcube.model',)),
+    ('mask', ('psf',), ('.mask',)),
+    ('clean', ('noise', 'startmodel', 'mask'), ('.model', '.image', '.residual',
+                                                '.pb', '.sumwt', '.weight')),
+    ('restore', ('clean',), ('.model', '.image', '.residual',
+                             '.pb', '.sumwt', '.weight')),
+    ('pbcor', ('restore',), ('.image.pbcor',)),
+    ('export', ('restore',), ('.image.fits', '.image.pbcor.fits',
+                              '.image.mincube.fits',
+                              '.image.pbcor.mincube.fits',
+                              '.model.mincube.fits',
+                              '.residual.mincube.fits')),
+    ('jvm', ('restore',), ('.JvM.image.fits', '.JvM.image.pbcor.fits')),
+    ('finalize', ('pbcor', 'export', 'jvm'), ()),
+)
+
+# A channel shard of a sharded cube (see cube_sharding.py) stops after the
+# restoration; the products are finished after the merge.
+SHARD_IMAGING_STAGES = LINE_IMAGING_STAGES[:7] + (
+    ('finalize', ('restore',), ()),
+)
+
+# The merge of the shards of a cube and the rest of the line imaging stages
+SHARD_MERGE_STAGES = (
+    ('merge', (), ('.image', '.residual', '.model', '.psf', '.pb',
+                   '.mask', '.sumwt', '.weight')),
+    ('pbcor', ('merge',), ('.image.pbcor',)),
+    ('export', ('merge',), LINE_IMAGING_STAGES[8][2]),
+    ('jvm', ('merge',), LINE_IMAGING_STAGES[9][2]),
+    ('finalize', ('pbcor', 'export', 'jvm'), ()),
+)
+
+
+def path_digest(path):
+    """
+    Digest of a file or directory tree based on relative file names, sizes,
+    and modification times.  Lock files, which CASA rewrites whenever a table
+    is opened (even read-only), are ignored.
+
+    Returns None if ``path`` does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+
+    if os.path.isfile(path):
+        entries = [('', os.stat(path))]
+    else:
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for fn in sorted(filenames):
+                if fn.endswith('.lock'):
+                    continue
+                full = os.path.join(dirpath, fn)
+                entries.append((os.path.relpath(full, path), os.stat(full)))
+
+    md5 = hashlib.md5()
+    for relpath, st in entries:
+        # (st_mtime_ns does not exist in python 2, i.e., CASA 5)
+        mtime_ns = getattr(st, 'st_mtime_ns', int(st.st_mtime*1e9))
+        md5.update("{0}:{1}:{2};".format(relpath, st.st_size,
+                                         mtime_ns).encode())
+    return md5.hexdigest()
+
+
+def peak_rss_mb_self_and_children():
+    """
+    Peak resident set size over the lifetime of this process and over its
+    (waited-for) children, in MB.  ``ru_maxrss`` is in kB on Linux.
+
+    Returns
+    -------
+    self_mb, children_mb : float
+    """
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.)
+
+
+class StageTracker(object):
+    """
+    Track the stages of the imaging of one target in a JSON state file.
+
+    Parameters
+    ----------
+    statefile : str
+        The JSON file to store the state in.  It should not live in a
+        temporary working directory, since it needs to survive the run.
+    basename : str
+        Products are named ``basename + suffix``
+    directory : str
+        The directory the products currently live in
+    stages : sequence
+        ``(name, dependencies, suffixes)`` tuples in execution order
+    enabled : bool
+        If False (e.g., for a dry run), nothing is written and all stages are
+        reported as incomplete
+    """
+    def __init__(self, statefile, basename, directory,
+                 stages=LINE_IMAGING_STAGES, enabled=True):
+        self.statefile = statefile
+        self.basename = basename
+        self.enabled = enabled
+
+        self.order = [name for name, deps, suffixes in stages]
+        self.dependencies = {name: deps for name, deps, suffixes in stages}
+        self.suffixes = {name: suffixes for name, deps, suffixes in stages}
+
+        if not (enabled and os.path.exists(statefile)):
+            self.state = {'basename': basename,
+                          'directory': directory,
+                          'stages': {},
+                          'timings': []}
+        else:
+            with open(statefile, 'r') as fh:
+                self.state = json.load(fh)
+            logprint("Loaded imaging state from {0}; completed stages: {1}"
+                     .format(statefile, [name for name in self.order
+                                         if self.is_complete(name)]))
+
+        # no stage has ever been started for this target
+        self.is_new = not self.state['stages']
+
+    @property
+    def directory(self):
+        return self.state['directory']
+
+    def set_directory(self, directory):
+        """
+        Record that the products were moved to ``directory``
+        """
+        self.state['directory'] = directory
+        self.save()
+
+    def product(self, suffix):
+        return os.path.join(self.directory, self.basename + suffix)
+
+    def save(self):
+        if not self.enabled:
+            return
+        tmpfile = self.statefile + ".tmp"
+        with open(tmpfile, 'w') as fh:
+            json.dump(self.state, fh, indent=2)
+        os.replace(tmpfile, self.statefile)
+
+    def _owner(self, suffix):
+        """
+        The last stage that has a record and declares ``suffix`` as an output;
+        only that stage's digest is expected to match the product on disk.
+        """
+        owner = None
+        for name in self.order:
+            if name in self.state['stages'] and suffix in self.suffixes[name]:
+                owner = name
+        return owner
+
+    def _dependents(self, name):
+        """ All stages that (transitively) depend on ``name`` """
+        dependents = set()
+        for other in self.order:
+            if any(dep == name or dep in dependents
+                   for dep in self.dependencies[other]):
+                dependents.add(other)
+        return dependents
+
+    def is_complete(self, name):
+        """
+        A stage is complete if it finished successfully, its dependencies are
+        complete, and its products are unchanged since it finished.
+        """
+        if not self.enabled:
+            return False
+        record = self.state['stages'].get(name)
+        if record is None or record['status'] != 'complete':
+            return False
+
+        for suffix, digest in record['digests'].items():
+            if not os.path.exists(self.product(suffix)):
+                return False
+            if self._owner(suffix) == name and path_digest(self.product(suffix)) != digest:
+                logprint("Product {0} of stage {1} changed on disk since the "
+                         "stage completed".format(self.product(suffix), name))
+                return False
+
+        return all(self.is_complete(dep) for dep in self.dependencies[name])
+
+    def result(self, name, key, default=None):
+        """ A value stored by a completed stage """
+        record = self.state['stages'].get(name)
+        if record is None:
+            return default
+        return record['results'].get(key, default)
+
+    def mark_complete(self, name, results=None):
+        """
+        Record a stage as complete without running it, e.g., to adopt products
+        made by a run that predates the state file.
+        """
+        self.state['stages'][name] = {'status': 'complete',
+                                      'results': results or {},
+                                      'digests': self._digests(name),
+                                      'adopted': True}
+        self.save()
+
+    def _digests(self, name):
+        return {suffix: path_digest(self.product(suffix))
+                for suffix in self.suffixes[name]
+                if os.path.exists(self.product(suffix))}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Run a stage: yields a dict into which the stage may put results (JSON
+        serializable) to be retrieved with `result` on later runs.
+
+        Starting a stage invalidates every stage downstream of it.  If the
+        block raises, the stage is recorded as failed and the exception
+        propagates.
+        """
+        for dependent in self._dependents(name):
+            self.state['stages'].pop(dependent, None)
+
+        results = {}
+        record = {'status': 'running', 'results': results, 'digests': {},
+                  'started': time.strftime("%Y-%m-%dT%H:%M:%S")}
+        self.state['stages'][name] = record
+        self.save()
+
+        logprint("Starting stage {0} for {1}".format(name, self.basename))
+        t0 = time.time()
+        rss0 = peak_rss_mb_self_and_children()
+        try:
+            yield results
+        except BaseException:
+            record['status'] = 'failed'
+            self._finish(name, record, t0, rss0)
+            raise
+        record['status'] = 'complete'
+        record['digests'] = self._digests(name)
+        self._finish(name, record, t0, rss0)
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        """
+        Time a step that is not a resumable stage (e.g., it works on files
+        shared with other targets and manages its own resumption)
+        """
+        record = {'name': name, 'started': time.strftime("%Y-%m-%dT%H:%M:%S")}
+        t0 = time.time()
+        rss0 = peak_rss_mb_self_and_children()
+        try:
+            yield
+        finally:
+            self.state['timings'].append(record)
+            self._finish(name, record, t0, rss0)
+
+    def _finish(self, name, record, t0, rss0):
+        record['wall_time'] = time.time() - t0
+        # the peaks are over the lifetime of the process, so what the stage
+        # itself needed shows only as how much it raised them (0 if an
+        # earlier stage needed more)
+        rss1 = peak_rss_mb_self_and_children()
+        record['lifetime_peak_rss_mb'] = rss1[0]
+        record['peak_rss_increase_mb'] = rss1[0] - rss0[0]
+        record['peak_rss_children_increase_mb'] = rss1[1] - rss0[1]
+        logprint("Stage {0} of {1} {2} in {3:0.1f}s; raised the peak RSS by "
+                 "{4:0.1f} MB to {5:0.1f} MB (children: by {6:0.1f} MB)"
+                 .format(name, self.basename, record.get('status', 'finished'),
+                         record['wall_time'], record['peak_rss_increase_mb'],
+                         record['lifetime_peak_rss_mb'],
+                         record['peak_rss_children_increase_mb']))
+        self.save()
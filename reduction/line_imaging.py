@@ -48,17 +48,54 @@ For now, please pick chanchunks so that nchan/chanchunks is an integer.
         See WORK_DIRECTORY.  This is where the final products will be put.
     CONTINUE_IF_MS_EXISTS
         A boolean flag that only applies if both PRODUCT_DIRECTORY and
-        WORK_DIRECTORY are set.  If this is not set, and the .ms file to
-        clean from exists in WORK_DIRECTORY, an error will be raised and
-        the script will fail.  If this is set, it will use that file.
+        WORK_DIRECTORY are set.  The MS is copied into WORK_DIRECTORY with a
+        manifest (<ms>.staging.json) of the copied files; an interrupted copy
+        is resumed and a complete one reused.  If this is not set, and an .ms
+        file without a manifest (i.e., of unknown completeness) exists in
+        WORK_DIRECTORY, an error will be raised and the script will fail.  If
+        this is set, it will use that file.
+    STAGING_NTHREADS
+        Number of files of the MS copied concurrently (default 8)
+    STAGING_CACHE_DIRECTORY
+        If set (e.g., to node-local scratch), the MS is staged into this cache
+        instead of WORK_DIRECTORY, so that jobs on the same node imaging the
+        same MS share one copy.
+    STAGING_CACHE_SIZE_GB
+        Size limit of the staging cache; the least recently used copies that
+        are not in use are evicted to stay below it.
     USE_EXISTING_PSF
         A boolean flag that will continue imaging even if a PSF already exists.
-        This can be used to resume a partially-completed run, but it's not clear
-        if it's ever safe to use.
+        This only applies to products made before the stage state files
+        (<imagename>.stages.json) were introduced: runs with a state file
+        resume exactly from the last completed stage.
     TEMP_WORKDIR
         A directory to do operations in when running the code; this will allow
         storage of temporary files.  This will be set automatically if not
         specified.
+    CHANNEL_GROUP_TOLERANCE=<fraction>
+        If set, and the clean threshold is given in units of sigma, clean the
+        cube in groups of contiguous channels whose dirty-residual rms agrees
+        to within this fraction (e.g., 0.1), each with its own threshold of
+        nsigma times the largest rms in the group.  The group models are
+        stitched into the full cube before the final restoration.
+    CHANNEL_GROUP_MIN_NCHAN=<number>
+        The minimum number of channels in a group (default 16); shorter groups
+        are merged with their neighbours.
+    EXPORT_NTHREADS
+        Number of threads used to write the FITS products after cleaning
+        (default 4).
+    SHARD_STAGE=prepare / image / merge
+        Image the cube in NSHARDS disjoint channel ranges ("shards") as
+        independent jobs, e.g. the tasks of a SLURM job array (see
+        slurm_scripts/job_runner_nov2021.py).  'prepare' concatenates,
+        continuum-subtracts, and stages the MS and stops; 'image' images one
+        shard on the spectral grid of the full cube, up to the restoration;
+        'merge' concatenates the shards' images along the spectral axis
+        (keeping the per-channel beams) and makes the pbcor and FITS products.
+    NSHARDS=<number>
+        The number of shards (required with SHARD_STAGE).
+    SHARD_INDEX=<number>
+        The shard to image (0-based); defaults to SLURM_ARRAY_TASK_ID.
 """
 
 import json
@@ -71,7 +108,7 @@ from astropy import constants
 from spectral_cube import SpectralCube
 import re
 try:
-    from tasks import tclean, uvcontsub, impbcor, concat, flagdata, makemask, immath
+    from tasks import tclean, uvcontsub, impbcor, concat, flagdata, makemask, immath, imsubimage
     from taskinit import casalog
     from exportfits_cli import exportfits_cli as exportfits
     from casa_system_defaults import casa
@@ -79,7 +116,7 @@ try:
     version = map(int, re.split("[-.]", casa['version']))
 except (ImportError,ModuleNotFoundError):
     # futureproofing: CASA 6 imports this way
-    from casatasks import tclean, uvcontsub, impbcor, concat, exportfits, flagdata, makemask, immath
+    from casatasks import tclean, uvcontsub, impbcor, concat, exportfits, flagdata, makemask, immath, imsubimage
     from casatasks import casalog
     import casatools
     version = casatools.version()
@@ -89,12 +126,18 @@ except (ImportError,ModuleNotFoundError):
 versionstring = ".".join(map(str, version))
 from parse_contdotdat import parse_contdotdat, freq_selection_overlap, contchannels_to_linechannels
 from metadata_tools import (determine_imsize, determine_phasecenter, is_7m,
-                            logprint as logprint_, check_channel_flags)
+                            logprint as logprint_, check_channel_flags,
+                            MSMetadataSnapshot)
 from imaging_parameters import line_imaging_parameters, selfcal_pars, line_parameters, flag_thresholds
 from unite_contranges import merge_contdotdat
 from metadata_tools import effectiveResolutionAtFreq
-from cube_finalizing import beam_correct_cube
+from cube_finalizing import beam_correct_cube, export_cube_products
 from create_clean_model import create_clean_model
+from imaging_stages import StageTracker, LINE_IMAGING_STAGES, SHARD_IMAGING_STAGES, SHARD_MERGE_STAGES
+from cube_sharding import shard_suffix, shard_impars, merge_shard_images
+from ms_staging import (stage_ms, stage_ms_cached, release_ms, release_cached_ms,
+                        manifest_name as staging_manifest_name)
+from image_statistics import robust_image_statistics, group_channels_by_noise
 from getversion import git_date, git_version
 msmd = msmdtool()
 ia = iatool()
@@ -108,6 +151,9 @@ logprint(f"Environment:\n {os.environ}\n\n\n")
 
 with open('to_image.json', 'r') as fh:
     to_image = json.load(fh)
+# split_line_windows.py also records the timing of the splits; all other
+# keys are bands
+to_image.pop('split_timing', None)
 
 if os.getenv('LOGFILENAME'):
     casalog.setlogfile(os.path.join(os.getcwd(), os.getenv('LOGFILENAME')))
@@ -189,6 +235,20 @@ if os.getenv('DO_NOT_CONCAT'):
 else:
     do_not_concat = False
 
+shard_stage = (os.getenv('SHARD_STAGE') or '').lower()
+if shard_stage:
+    if shard_stage not in ('prepare', 'image', 'merge'):
+        raise ValueError("SHARD_STAGE must be one of prepare, image, or merge; got {0}"
+                         .format(shard_stage))
+    nshards = int(os.getenv('NSHARDS'))
+    if shard_stage == 'image':
+        shard_index = int(os.getenv('SHARD_INDEX') or os.getenv('SLURM_ARRAY_TASK_ID'))
+        if os.getenv('LOGFILENAME'):
+            # one log per shard
+            casalog.setlogfile(os.path.join(os.getcwd(), os.getenv('LOGFILENAME')
+                                            + shard_suffix(shard_index, nshards)))
+        logprint("Imaging shard {0} of {1}".format(shard_index, nshards))
+
 if os.getenv('TEMP_WORKDIR'):
     temp_workdir = os.getenv('TEMP_WORKDIR')
 else:
@@ -197,6 +257,9 @@ else:
             ('7M' if only_7m else ('12M' if exclude_7m else '7M12M')),
             "_".join(band_list)
             ))
+if shard_stage == 'image':
+    # the shards run concurrently; keep their temporary files apart
+    temp_workdir += shard_suffix(shard_index, nshards)
 if not os.path.exists(temp_workdir):
     os.mkdir(temp_workdir)
 logprint("Working in directory {0}".format(temp_workdir))
@@ -207,15 +270,23 @@ parallel = bool(os.getenv('MPICASA'))
 
 # TODO: make this optional
 do_export_fits = True
+# number of threads writing the FITS products in parallel
+export_nthreads = int(os.getenv('EXPORT_NTHREADS') or 4)
+
+# MS staging to WORK_DIRECTORY (see ms_staging.py)
+staging_nthreads = int(os.getenv('STAGING_NTHREADS') or 8)
+staging_cache_directory = os.getenv('STAGING_CACHE_DIRECTORY')
+staging_cache_size_gb = (float(os.getenv('STAGING_CACHE_SIZE_GB'))
+                         if os.getenv('STAGING_CACHE_SIZE_GB') else None)
+
+# optional noise-adaptive channel grouping for the main clean
+channel_group_tolerance = float(os.getenv('CHANNEL_GROUP_TOLERANCE') or 0)
+channel_group_min_nchan = int(os.getenv('CHANNEL_GROUP_MIN_NCHAN') or 16)
 
 # set the 'chanchunks' parameter globally.
 # CASAguides recommend chanchunks=-1, but this resulted in: 2018-09-05 23:16:34     SEVERE  tclean::task_tclean::   Exception from task_tclean : Invalid Gridding/FTM Parameter set : Must have at least 1 chanchunk
 chanchunks = int(os.getenv('CHANCHUNKS') or 16)
 
-# default: don't continue imaging
-# (TODO: check whether we actually want to continue sometimes)
-continue_imaging = False
-
 def sethistory(prefix, nsigma=None, impars=None, suffixes=('.image', '.residual', '.model')):
     for suffix in suffixes:
         ia.open(prefix+suffix)
@@ -306,19 +377,156 @@ def set_impars(impars, line_name, vis, linpars, spwnames=None):
     return impars
 
 def copy_ms(src, dest):
-    if os.path.exists(dest):
+    """
+    Stage ``src`` to ``dest`` (or to the staging cache, if there is one) and
+    return the path of the copy.  An interrupted copy is resumed, and a
+    complete copy whose manifest matches the source is reused.
+    """
+    if staging_cache_directory:
+        return stage_ms_cached(src, staging_cache_directory,
+                               nthreads=staging_nthreads,
+                               max_size_gb=staging_cache_size_gb)
+
+    if os.path.exists(dest) and not os.path.exists(staging_manifest_name(dest)):
+        # a copy made without a manifest cannot be checked for completeness
         if not os.getenv('CONTINUE_IF_MS_EXISTS'):
             raise IOError("The target directory {dest} already exists".format(dest=dest))
         else:
-            logprint("{0} exists, using it as concatvis".format(dest), origin='almaimf_line_imaging')
+            logprint("{0} exists but has no staging manifest; using it as concatvis "
+                     "unverified".format(dest), origin='almaimf_line_imaging')
             return dest
-    else:
-        logprint("Copying concatvis {0}->{1}".format(src, dest), origin='almaimf_line_imaging')
-        shutil.copytree(src, dest)
-        # could use filecmp.dircmp to do a deeper comparison, but that might be expensive and unnecessary
-        assert os.path.exists(dest)
-        return dest
 
+    logprint("Copying concatvis {0}->{1}".format(src, dest), origin='almaimf_line_imaging')
+    return stage_ms(src, dest, nthreads=staging_nthreads)
+
+
+
+def channel_grid(imagename, channel):
+    """
+    Frequency of ``channel`` and the channel width (both in Hz) of a tclean
+    image, for imaging a channel range on exactly the same grid
+    """
+    ia.open(imagename)
+    csys = ia.coordsys()
+    spectral_axis = csys.findcoordinate('spectral')['pixel'][0]
+    pixel = [0] * len(ia.shape())
+    pixel[spectral_axis] = channel
+    freq = csys.toworld(pixel, format='n')['numeric'][spectral_axis]
+    width = csys.increment(type='spectral', format='n')['numeric'][0]
+    csys.done()
+    ia.close()
+    return float(freq), float(width)
+
+def make_channel_group_images(imagename, groupname, first, last, suffixes):
+    """
+    Cut channels ``first`` to ``last`` (inclusive) out of the existing
+    ``imagename+suffix`` images
+    """
+    for suffix in suffixes:
+        if os.path.exists(groupname+suffix):
+            shutil.rmtree(groupname+suffix)
+        if os.path.exists(imagename+suffix):
+            imsubimage(imagename=imagename+suffix, outfile=groupname+suffix,
+                       chans='{0}~{1}'.format(first, last))
+
+def stitch_channel_group_models(imagename, groups):
+    """
+    Assemble ``imagename.model`` from the models of the channel groups
+    ``(groupname, first_channel)``
+    """
+    ia.open(imagename+".residual")
+    shape = ia.shape()
+    csys = ia.coordsys()
+    ia.close()
+
+    # build under a temporary name so that a .model only exists once it is
+    # complete
+    tmpname = imagename+".model.stitching"
+    if os.path.exists(tmpname):
+        shutil.rmtree(tmpname)
+    ia.fromshape(outfile=tmpname, shape=shape, csys=csys.torecord(), overwrite=True)
+    ia.setbrightnessunit('Jy/pixel')
+    csys.done()
+    spectral_axis = ia.coordsys().findcoordinate('spectral')['pixel'][0]
+    for groupname, first in groups:
+        ia2 = iatool()
+        ia2.open(groupname+".model")
+        blc = [0] * len(shape)
+        blc[spectral_axis] = first
+        ia.putchunk(pixels=ia2.getchunk(), blc=blc)
+        ia2.close()
+    ia.close()
+    # (a model left by an earlier, interrupted run would make the rename fail)
+    if os.path.exists(imagename+".model"):
+        shutil.rmtree(imagename+".model")
+    os.rename(tmpname, imagename+".model")
+
+def finish_cube(tracker, lineimagename):
+    """
+    Primary-beam correct the restored cube and write out the FITS products
+    """
+    if not tracker.is_complete('pbcor'):
+        with tracker.stage('pbcor'):
+            if not dryrun:
+                logprint("pbcorrecting {0}".format(lineimagename), origin='almaimf_line_imaging')
+                impbcor(imagename=lineimagename+'.image',
+                        pbimage=lineimagename+'.pb',
+                        outfile=lineimagename+'.image.pbcor',
+                        cutoff=0.2,
+                        overwrite=True)
+
+    if do_export_fits and not tracker.is_complete('export'):
+        with tracker.stage('export'):
+            if not dryrun:
+                # full, pbcor, and mincube FITS products from a
+                # single read of the image, pb, model, and residual
+                export_cube_products(lineimagename, pbcutoff=0.2,
+                                     nthreads=export_nthreads)
+
+    if do_export_fits and not tracker.is_complete('jvm'):
+        with tracker.stage('jvm'):
+            if not dryrun:
+                # write out JvM-corrected cubes
+                beam_correct_cube(lineimagename)
+
+def finalize_cube(tracker, lineimagename):
+    """
+    Move the products to the product directory, if there is one
+    """
+    if not dryrun:
+        with tracker.stage('finalize'):
+            if copy_files:
+                for suffix in ('.image', '.image.pbcor', '.mask', '.model',
+                               '.pb', '.psf', '.residual', '.sumwt', '.weight',
+                               '.contcube.model',
+                               '.model.mincube.fits',
+                               '.residual.mincube.fits',
+                               '.image.fits',
+                               '.image.mincube.fits',
+                               '.image.pbcor.fits',
+                               '.image.pbcor.mincube.fits',
+                               '.JvM.image.pbcor.fits',
+                               '.JvM.image.fits',
+                               '.flatpb.fits',
+                              ):
+                    src = lineimagename+suffix
+                    dest = proddir
+                    destfile = os.path.join(proddir, os.path.basename(src))
+                    if os.path.exists(src):
+                        if os.path.exists(destfile):
+                            logprint("Destination {0} exists".format(destfile), origin='almaimf_line_imaging')
+                            if not os.getenv('CONTINUE_IF_MS_EXISTS'):
+                                raise ValueError("Target destination {0} exists and we were trying to copy into it.".format(destfile))
+                            else:
+                                logprint("Removing the workingdir file {0}".format(src), origin='almaimf_line_imaging')
+                                if src.endswith('fits'):
+                                    os.remove(src)
+                                else:
+                                    shutil.rmtree(src)
+                        else:
+                            logprint("Moving {0}->{1}".format(src, dest), origin='almaimf_line_imaging')
+                            shutil.move(src, dest)
+                tracker.set_directory(proddir)
 
 
 if exclude_7m:
@@ -441,161 +649,250 @@ for band in band_list:
                 continue
 
 
-            if do_not_concat:
-                concatvis = vis
-                logprint("DO_NOT_CONCAT set; NOT concatenating vis={0}.".format(vis),
-                         origin='almaimf_line_imaging')
-            elif any('concat' in x for x in vis):
-                logprint("NOT concatenating vis={0}.".format(vis),
+            if 'spw' in line_name:
+                if not int(line_name.lstrip('spw')) == int(spw):
+                    raise ValueError("Line name is {0}, which does not match spw number {1}".format(line_name, spw))
+
+            baselineimagename = ("{0}_{1}_spw{2}_{3}_{4}{5}"
+                                 .format(field, band, spw, arrayname,
+                                         line_name, contsub_suffix))
+            # the name of the full cube (the same as baselineimagename unless
+            # this is one shard of it)
+            cubeimagename = baselineimagename
+            if shard_stage == 'image':
+                baselineimagename = cubeimagename + shard_suffix(shard_index, nshards)
+            lineimagename = os.path.join(imaging_root, baselineimagename)
+
+            # the state file lives with the final products so that it
+            # survives the cleanup of the working directory
+            stagefile = os.path.join(proddir if copy_files else imaging_root,
+                                     baselineimagename + ".stages.json")
+            stages = {'image': SHARD_IMAGING_STAGES,
+                      'merge': SHARD_MERGE_STAGES}.get(shard_stage, LINE_IMAGING_STAGES)
+            tracker = StageTracker(stagefile, basename=baselineimagename,
+                                   directory=imaging_root, stages=stages,
+                                   enabled=not dryrun)
+            if tracker.is_complete('finalize'):
+                logprint("All imaging stages of {0} are complete according to {1}; "
+                         "skipping.".format(baselineimagename, stagefile),
                          origin='almaimf_line_imaging')
-            elif not os.path.exists(concatvis):
-                if do_contsub and os.path.exists(concatvis+".contsub"):
-                    logprint("Concatvis-contsub already exists, though non-contsub may not",
-                             origin='almaimf_line_imaging'
-                            )
-                else:
-                    logprint("Concatenating visibilities {vis} into {concatvis}"
-                             .format(vis=vis, concatvis=concatvis),
-                             origin='almaimf_line_imaging'
-                            )
-                    if dryrun:
-                        raise ValueError("Cannot do a dry run without concatenated data in place")
-                    for vv in vis:
-                        # allow up to 1% flagging
-                        check_channel_flags(vv, tolerance=flagging_tolerance, nchan_tolerance=nflag_threshold)
-                    concat(vis=vis, concatvis=concatvis)
+                continue
+
+            if shard_stage == 'merge':
+                if not tracker.is_complete('merge'):
+                    with tracker.stage('merge'):
+                        if not dryrun:
+                            # the shards' products were moved to the product
+                            # directory by their finalize stage
+                            merge_shard_images(lineimagename, nshards,
+                                               shardname=os.path.join(proddir if copy_files else imaging_root,
+                                                                      cubeimagename),
+                                               overwrite=True)
+                            sethistory(lineimagename, suffixes=('.image', '.residual', '.model'))
+                            for ii in range(nshards):
+                                shardname = os.path.join(proddir if copy_files else imaging_root,
+                                                         cubeimagename + shard_suffix(ii, nshards))
+                                for fn in glob.glob(shardname + ".*"):
+                                    if fn.endswith('.stages.json'):
+                                        continue
+                                    logprint("Removing merged shard product {0}".format(fn),
+                                             origin='almaimf_line_imaging')
+                                    if os.path.isdir(fn):
+                                        shutil.rmtree(fn)
+                                    else:
+                                        os.remove(fn)
+                finish_cube(tracker, lineimagename)
+                finalize_cube(tracker, lineimagename)
+
+                if copy_files and not dryrun:
+                    # remove the MS staged by the prepare stage
+                    sources = vis if do_not_concat else [concatvis + contsub_suffix]
+                    for vv in sources:
+                        if staging_cache_directory:
+                            # the merge does not hold the cache entry; drop
+                            # it unless another job is using it
+                            release_cached_ms(vv, staging_cache_directory)
+                            continue
+                        newvv = os.path.join(workdir, os.path.basename(vv))
+                        if os.path.exists(newvv):
+                            logprint("Removing MS file {0} from working directory {1}"
+                                     .format(newvv, workdir),
+                                     origin='almaimf_line_imaging')
+                            release_ms(newvv)
+                continue
+
+            with tracker.timed('concat'):
+                if do_not_concat:
+                    concatvis = vis
+                    logprint("DO_NOT_CONCAT set; NOT concatenating vis={0}.".format(vis),
+                             origin='almaimf_line_imaging')
+                elif any('concat' in x for x in vis):
+                    logprint("NOT concatenating vis={0}.".format(vis),
+                             origin='almaimf_line_imaging')
+                elif not os.path.exists(concatvis):
+                    if do_contsub and os.path.exists(concatvis+".contsub"):
+                        logprint("Concatvis-contsub already exists, though non-contsub may not",
+                                 origin='almaimf_line_imaging'
+                                )
+                    elif shard_stage == 'image':
+                        raise ValueError("{0} does not exist; the shards must be preceded "
+                                         "by a SHARD_STAGE=prepare run".format(concatvis))
+                    else:
+                        logprint("Concatenating visibilities {vis} into {concatvis}"
+                                 .format(vis=vis, concatvis=concatvis),
+                                 origin='almaimf_line_imaging'
+                                )
+                        if dryrun:
+                            raise ValueError("Cannot do a dry run without concatenated data in place")
+                        for vv in vis:
+                            # allow up to 1% flagging
+                            check_channel_flags(vv, tolerance=flagging_tolerance, nchan_tolerance=nflag_threshold)
+                        concat(vis=vis, concatvis=concatvis)
 
             if do_contsub:
 
                 if not os.path.exists(concatvis+".contsub"):
                     if dryrun:
                         raise ValueError("Cannot do a dry run without contsub concatenated data in place")
+                    if shard_stage == 'image':
+                        raise ValueError("{0}.contsub does not exist; the shards must be preceded "
+                                         "by a SHARD_STAGE=prepare run".format(concatvis))
                     logprint("Concatvis contsub {0}.contsub does not exist, doing continuum subtraction.".format(str(concatvis)),
                              origin='almaimf_line_imaging')
 
-                    contfile12m, contfile7m = merge_contdotdat(field, band,
-                                                               basepath='.',
-                                                               datfiles=metadata[band][field]['cont.dat'].values())
-                    contfile = contfile12m
-
-                    cont_freq_selection = parse_contdotdat(contfile)
-                    logprint("Selected {0} as continuum channels".format(cont_freq_selection), origin='almaimf_line_imaging')
-
-                    msmd.open(concatvis)
-                    spws = msmd.spwsforfield(field)
-                    msmd.close()
-
-                    # obtain the frequency arrays for each spectral window
-                    ms.open(concatvis)
-                    try:
-                        frqs = {spw: ms.cvelfreqs(spwid=[spw], outframe='LSRK') for spw in spws}
-                    except TypeError:
-                        frqs = {spw: ms.cvelfreqs(spwids=[spw], outframe='LSRK') for spw in spws}
-                    ms.close()
-
-                    # calculate the line channels from the contdatfile (which is in LSRK)
-                    # and the frequency arrays
-                    linechannels = contchannels_to_linechannels(cont_freq_selection, frqs)
-
-                    uvcontsub(vis=concatvis,
-                              fitspw=linechannels,
-                              excludechans=True, # fit the non-line channels
-                              combine='none', # DO NOT combine spws for continuum ID (since that implies combining 7m <-> 12m)
-                              solint='int', # fit each integration (may be noisy?)
-                              fitorder=1,
-                              want_cont=False)
+                    with tracker.timed('contsub'):
+                        contfile12m, contfile7m = merge_contdotdat(field, band,
+                                                                   basepath='.',
+                                                                   datfiles=metadata[band][field]['cont.dat'].values())
+                        contfile = contfile12m
+
+                        cont_freq_selection = parse_contdotdat(contfile)
+                        logprint("Selected {0} as continuum channels".format(cont_freq_selection), origin='almaimf_line_imaging')
+
+                        msmd.open(concatvis)
+                        spws = msmd.spwsforfield(field)
+                        msmd.close()
+
+                        # obtain the frequency arrays for each spectral window
+                        ms.open(concatvis)
+                        try:
+                            frqs = {spw: ms.cvelfreqs(spwid=[spw], outframe='LSRK') for spw in spws}
+                        except TypeError:
+                            frqs = {spw: ms.cvelfreqs(spwids=[spw], outframe='LSRK') for spw in spws}
+                        ms.close()
+
+                        # calculate the line channels from the contdatfile (which is in LSRK)
+                        # and the frequency arrays
+                        linechannels = contchannels_to_linechannels(cont_freq_selection, frqs)
+
+                        uvcontsub(vis=concatvis,
+                                  fitspw=linechannels,
+                                  excludechans=True, # fit the non-line channels
+                                  combine='none', # DO NOT combine spws for continuum ID (since that implies combining 7m <-> 12m)
+                                  solint='int', # fit each integration (may be noisy?)
+                                  fitorder=1,
+                                  want_cont=False)
 
                 # if do_contsub, we want to use the contsub'd MS
                 concatvis = concatvis + contsub_suffix
 
-            try:
-                # check that autocorrs are flagged out
-                if 'concat' in concatvis:
-                    flagsum = flagdata(vis=concatvis, mode='summary', uvrange='0~1m')
-                    if flagsum is not None and 'flagged' in flagsum and flagsum['flagged'] != flagsum['total']:
-                        # if 'flagged' isn't in flagsum, it's an empty dict
-                        raise ValueError("Found unflagged autocorrelation data (or at least, short baselines) in {0}".format(concatvis))
-
-                    check_channel_flags(concatvis, tolerance=flagging_tolerance, nchan_tolerance=nflag_threshold)
-
-                elif isinstance(concatvis, list):
-                    for vv in concatvis:
-                        flagsum = flagdata(vis=vv, mode='summary', uvrange='0~1m')
+            with tracker.timed('flag_check'):
+                try:
+                    # check that autocorrs are flagged out
+                    if 'concat' in concatvis:
+                        flagsum = flagdata(vis=concatvis, mode='summary', uvrange='0~1m')
                         if flagsum is not None and 'flagged' in flagsum and flagsum['flagged'] != flagsum['total']:
-                            raise ValueError("Found unflagged autocorrelation data (or at least, short baselines) in {vv}".format(vv=vv))
-            except RuntimeError as ex:
-                if "The selected table has zero rows" in str(ex):
-                    # this is OK: there are no autocorrs!
-                    pass
-                else:
-                    raise ex
+                            # if 'flagged' isn't in flagsum, it's an empty dict
+                            raise ValueError("Found unflagged autocorrelation data (or at least, short baselines) in {0}".format(concatvis))
 
+                        check_channel_flags(concatvis, tolerance=flagging_tolerance, nchan_tolerance=nflag_threshold)
 
-            if 'spw' in line_name:
-                if not int(line_name.lstrip('spw')) == int(spw):
-                    raise ValueError("Line name is {0}, which does not match spw number {1}".format(line_name, spw))
-
-            baselineimagename = ("{0}_{1}_spw{2}_{3}_{4}{5}"
-                                 .format(field, band, spw, arrayname,
-                                         line_name, contsub_suffix))
-            lineimagename = os.path.join(imaging_root, baselineimagename)
+                    elif isinstance(concatvis, list):
+                        for vv in concatvis:
+                            flagsum = flagdata(vis=vv, mode='summary', uvrange='0~1m')
+                            if flagsum is not None and 'flagged' in flagsum and flagsum['flagged'] != flagsum['total']:
+                                raise ValueError("Found unflagged autocorrelation data (or at least, short baselines) in {vv}".format(vv=vv))
+                except RuntimeError as ex:
+                    if "The selected table has zero rows" in str(ex):
+                        # this is OK: there are no autocorrs!
+                        pass
+                    else:
+                        raise ex
 
             # STAGING: so you can do the work on a different HD
             if copy_files and not dryrun:
-                # _copy_ the MS file to the working directory
+                with tracker.timed('staging'):
+                    # _copy_ the MS file to the working directory
 
 
-                # first, make sure that we're not copying the MS into itself - that would be bad.
+                    # first, make sure that we're not copying the MS into itself - that would be bad.
 
-                if do_not_concat:
-                    assert os.path.split(concatvis[0])[0] != workdir
-                    newconcatvis = [os.path.join(workdir, os.path.basename(vv))
-                                    for vv in concatvis]
-                    concatvis = [copy_ms(vv, newvv)
-                                 for vv,newvv in zip(concatvis, newconcatvis)]
-                else:
-                    assert os.path.split(concatvis)[0] != workdir
-                    newconcatvis = os.path.join(workdir, os.path.basename(concatvis))
-                    concatvis = copy_ms(concatvis, newconcatvis)
+                    if do_not_concat:
+                        assert os.path.split(concatvis[0])[0] != workdir
+                        newconcatvis = [os.path.join(workdir, os.path.basename(vv))
+                                        for vv in concatvis]
+                    else:
+                        assert os.path.split(concatvis)[0] != workdir
+                        newconcatvis = os.path.join(workdir, os.path.basename(concatvis))
+
+                    # (the shards reuse the copy made by the prepare stage;
+                    # concurrent stagings of the same MS wait for each other)
+                    if do_not_concat:
+                        concatvis = [copy_ms(vv, newvv)
+                                     for vv,newvv in zip(concatvis, newconcatvis)]
+                    else:
+                        concatvis = copy_ms(concatvis, newconcatvis)
 
-                # do a preliminary check: don't copy anything if both src & dest exist;
-                # that indicates a severe problem
-                for suffix in ('.image', '.image.pbcor', '.mask', '.model',
-                               '.pb', '.psf', '.residual', '.sumwt', '.weight',
-                               '.contcube.model',
-                               '.image.fits',
-                               '.image.pbcor.fits',
-                               '.image.mincube.fits',
-                               '.image.pbcor.mincube.fits',
-                              ):
-                    destdir = imaging_root
-                    dest = os.path.join(imaging_root, baselineimagename+suffix)
-                    src = os.path.join(proddir,
-                                       baselineimagename + suffix)
-                    if os.path.exists(dest) and os.path.exists(src):
-                        # if ANY of the target destinations exist, we need to fail
-                        raise ValueError("Target destination {0} exists and we were trying to copy into it from {1}.".format(dest, src))
-
-                # we need to copy the files to our working directory if they exist
-                # (this allows for continuation of partly-completed processes
-                # and reuse of existing startmodels)
-                for suffix in ('.image', '.image.pbcor', '.mask', '.model',
-                               '.pb', '.psf', '.residual', '.sumwt', '.weight',
-                               '.contcube.model', '.image.fits',
-                               '.image.pbcor.fits',
-                              ):
-                    destdir = imaging_root
-                    dest = os.path.join(imaging_root, baselineimagename+suffix)
-                    src = os.path.join(proddir,
-                                       baselineimagename + suffix)
-                    logprint("Planning to move {0}->{1} ({2})".format(src, destdir, dest), origin='almaimf_line_imaging')
-                    if os.path.exists(dest):
-                        logprint("Destination {0} exists".format(dest), origin='almaimf_line_imaging')
-                        if False: #not os.getenv('CONTINUE_IF_MS_EXISTS'):
-                            raise ValueError("Target destination {0} exists and we were trying to copy into it.".format(dest))
-                    elif os.path.exists(src):
-                        logprint("Moving {0}->{1} ({2})".format(src, destdir, dest), origin='almaimf_line_imaging')
-                        shutil.move(src, destdir)
+                    if shard_stage == 'prepare':
+                        logprint("Prepared {0} for sharded imaging".format(concatvis),
+                                 origin='almaimf_line_imaging')
+                        continue
+
+                    # do a preliminary check: don't copy anything if both src & dest exist;
+                    # that indicates a severe problem
+                    for suffix in ('.image', '.image.pbcor', '.mask', '.model',
+                                   '.pb', '.psf', '.residual', '.sumwt', '.weight',
+                                   '.contcube.model',
+                                   '.image.fits',
+                                   '.image.pbcor.fits',
+                                   '.image.mincube.fits',
+                                   '.image.pbcor.mincube.fits',
+                                  ):
+                        destdir = imaging_root
+                        dest = os.path.join(imaging_root, baselineimagename+suffix)
+                        src = os.path.join(proddir,
+                                           baselineimagename + suffix)
+                        if os.path.exists(dest) and os.path.exists(src):
+                            # if ANY of the target destinations exist, we need to fail
+                            raise ValueError("Target destination {0} exists and we were trying to copy into it from {1}.".format(dest, src))
+
+                    # we need to copy the files to our working directory if they exist
+                    # (this allows for continuation of partly-completed processes
+                    # and reuse of existing startmodels)
+                    for suffix in ('.image', '.image.pbcor', '.mask', '.model',
+                                   '.pb', '.psf', '.residual', '.sumwt', '.weight',
+                                   '.contcube.model', '.image.fits',
+                                   '.image.pbcor.fits',
+                                   '.image.mincube.fits',
+                                   '.image.pbcor.mincube.fits',
+                                   '.model.mincube.fits',
+                                   '.residual.mincube.fits',
+                                   '.JvM.image.fits',
+                                   '.JvM.image.pbcor.fits',
+                                  ):
+                        destdir = imaging_root
+                        dest = os.path.join(imaging_root, baselineimagename+suffix)
+                        src = os.path.join(proddir,
+                                           baselineimagename + suffix)
+                        logprint("Planning to move {0}->{1} ({2})".format(src, destdir, dest), origin='almaimf_line_imaging')
+                        if os.path.exists(dest):
+                            logprint("Destination {0} exists".format(dest), origin='almaimf_line_imaging')
+                            if False: #not os.getenv('CONTINUE_IF_MS_EXISTS'):
+                                raise ValueError("Target destination {0} exists and we were trying to copy into it.".format(dest))
+                        elif os.path.exists(src):
+                            logprint("Moving {0}->{1} ({2})".format(src, destdir, dest), origin='almaimf_line_imaging')
+                            shutil.move(src, destdir)
+                    tracker.set_directory(imaging_root)
 
                 # we don't copy or move over the continuum startmodels b/c the  `make_clean` operates inplace
                 contmodel_path = proddir
@@ -605,12 +902,50 @@ for band in band_list:
                 contmodel_path = imaging_root
                 imaging_results_path_for_contmodel = imaging_root
 
+            if shard_stage == 'prepare':
+                logprint("Prepared {0} for sharded imaging".format(concatvis),
+                         origin='almaimf_line_imaging')
+                continue
+
+            if tracker.is_new and not dryrun:
+                # products from a run that predates the stage state files
+                if os.path.exists(lineimagename+".image"):
+                    logprint("Adopting the existing images of {0} as a completed clean"
+                             .format(lineimagename), origin='almaimf_line_imaging')
+                    for stage_name in ('psf', 'dirty', 'noise', 'startmodel',
+                                       'mask', 'clean', 'restore'):
+                        tracker.mark_complete(stage_name)
+                elif os.path.exists(lineimagename+".psf"):
+                    if os.getenv('USE_EXISTING_PSF'):
+                        logprint(f"WARNING: The PSF for {lineimagename} exists, but no image exists.  "
+                                 "USE_EXISTING_PSF was set, though, so imaging will continue.",
+                                 origin='almaimf_line_imaging')
+                        tracker.mark_complete('psf')
+                    else:
+                        logprint("WARNING: The PSF for {0} exists, but no image exists"
+                                 " and there is no stage file {1}."
+                                 "  This likely implies that an ongoing or incomplete "
+                                 "imaging run for this file exists.  It will not be "
+                                 "imaged this time; please check what is happening.  "
+                                 .format(lineimagename, stagefile),
+                                 origin='almaimf_line_imaging',
+                                 priority='WARNING'
+                                 )
+                        continue
+
 
             logprint("Measurement sets are: " + str(concatvis),
                      origin='almaimf_line_imaging')
             check_channel_flags(concatvis, tolerance=flagging_tolerance, nchan_tolerance=nflag_threshold)
+            # read the MS metadata once and share it between the phasecenter
+            # and imsize determination
+            if isinstance(concatvis, list):
+                metadata_snapshot = [MSMetadataSnapshot(vis_) for vis_ in concatvis]
+            else:
+                metadata_snapshot = MSMetadataSnapshot(concatvis)
             coosys, racen, deccen = determine_phasecenter(ms=concatvis,
-                                                          field=field)
+                                                          field=field,
+                                                          snapshot=metadata_snapshot)
             phasecenter = "{0} {1}deg {2}deg".format(coosys, racen, deccen)
             # check_channel_flags(concatvis, tolerance=flagging_tolerance, nchan_tolerance=nflag_threshold)
             (dra, ddec, pixscale) = list(determine_imsize(ms=concatvis,
@@ -622,13 +957,12 @@ for band in band_list:
                                                           exclude_7m=exclude_7m,
                                                           only_7m=only_7m,
                                                           min_pixscale=0.08, # arcsec; dropped 20% on Nov 6, 2020 to handle beam size issues
+                                                          snapshot=metadata_snapshot,
                                                          ))
             imsize = [int(dra), int(ddec)]
             cellsize = ['{0:0.2f}arcsec'.format(pixscale)] * 2
             # check_channel_flags(concatvis, tolerance=flagging_tolerance, nchan_tolerance=nflag_threshold)
 
-            dirty_tclean_made_residual = False
-
 
             # prepare for the imaging parameters
             pars_key = "{0}_{1}_{2}_robust{3}{4}".format(field, band,
@@ -665,466 +999,423 @@ for band in band_list:
             #impars['field'] = [field.encode()]
             impars['field'] = field
 
+            if shard_stage == 'image':
+                # same imsize, cell, and phasecenter as every other shard, and
+                # a slice of the full cube's spectral grid
+                impars, shard_first, shard_last = shard_impars(impars, shard_index, nshards,
+                                                               vis=concatvis, field=field)
+                logprint("Shard {0} of {1} covers channels {2}-{3} of the cube: "
+                         "start={4}, width={5}, nchan={6}"
+                         .format(shard_index, nshards, shard_first, shard_last,
+                                 impars['start'], impars['width'], impars['nchan']),
+                         origin='almaimf_line_imaging')
+
             mask_out_endchannels = False
             if 'mask_out_endchannels' in impars:
                 # remove this parameter
                 mask_out_endchannels = impars.pop('mask_out_endchannels')
 
-            # default Oct 13, 2020: always make dirty image
-            # so we can have a mask to work with
-            make_dirty_image = True
-            if 'threshold' in impars:
-                if 'sigma' in impars['threshold']:
-                    make_dirty_image = True
-            if 'startmodel' in impars:
-                # need the dirty image to populate our model
-                make_dirty_image = True
-
-            logprint("make_dirty_image is set to {0}".format(make_dirty_image))
+            # set by global environmental variable to auto-recognize
+            # when being run from an MPI session.
+            impars['parallel'] = parallel
 
             # start with cube imaging
-            # step 1 is dirty imaging
-
-            if make_dirty_image and not os.path.exists(lineimagename+".image") and not os.path.exists(lineimagename+".residual"):
-                psf_exists = os.path.exists(lineimagename+".psf")
-                if psf_exists:
-                    if os.getenv('USE_EXISTING_PSF'):
-                        logprint(f"WARNING: The PSF for {lineimagename} exists, but no image exists.  "
-                                 "USE_EXISTING_PSF was set, though, so imaging will continue.",
+            # step 1 is dirty imaging, which is always done (since Oct 13,
+            # 2020) so we have a residual to estimate the RMS from and a
+            # mask to work with.  The PSF is made first, on its own, so that
+            # a run interrupted during dirty imaging does not need to
+            # recompute it.
+            impars_dirty = impars.copy()
+            impars_dirty['niter'] = 0
+            if 'startmodel' in impars_dirty:
+                del impars_dirty['startmodel']
+            # use the same mask as specified for the main run
+            # impars_dirty['usemask'] = None
+
+            if not tracker.is_complete('psf'):
+                with tracker.stage('psf'):
+                    logprint("PSF imaging parameters are {0}".format(impars_dirty),
+                             origin='almaimf_line_imaging')
+                    if not dryrun:
+                        tclean(vis=concatvis,
+                               imagename=lineimagename,
+                               restoringbeam='', # do not use restoringbeam='common'
+                               # it results in bad edge channels dominating the beam
+                               calcpsf=True,
+                               calcres=False,
+                               **impars_dirty
+                              )
+
+            if not tracker.is_complete('dirty'):
+                with tracker.stage('dirty'):
+                    logprint("Dirty imaging parameters are {0}".format(impars_dirty),
+                             origin='almaimf_line_imaging')
+                    if not dryrun:
+                        tclean(vis=concatvis,
+                               imagename=lineimagename,
+                               restoringbeam='',
+                               calcpsf=False,
+                               calcres=True,
+                               **impars_dirty
+                              )
+                        sethistory(lineimagename, impars=impars_dirty, suffixes=(".residual",))
+                    for suffix in ("mask", "model", "image"):
+                        # tclean with niter=0 is not supposed to produce a .image file,
+                        # but it appears to have done so on at least one run
+                        bad_fn = lineimagename + "." + suffix
+                        if os.path.exists(bad_fn):
+                            logprint("Removing {0} from dirty clean".format(bad_fn),
+                                     origin='almaimf_line_imaging')
+                            shutil.rmtree(bad_fn)
+
+            if not tracker.is_complete('noise'):
+                with tracker.stage('noise') as results:
+                    if not dryrun:
+                        # the threshold needs to be computed if any imaging is to be done (either contsub or not)
+                        # no .image file is produced, only a residual
+                        logprint("Computing residual image statistics for {0}".format(lineimagename),
                                  origin='almaimf_line_imaging')
-                    else:
-                        logprint("WARNING: The PSF for {0} exists, but no image exists."
-                                 "  This likely implies that an ongoing or incomplete "
-                                 "imaging run for this file exists.  It will not be "
-                                 "imaged this time; please check what is happening.  "
-                                 "(this warning issued /before/ dirty imaging)"
-                                 .format(lineimagename),
-                                 origin='almaimf_line_imaging',
-                                 priority='WARNING'
-                                 )
-                        continue
-                # first iteration makes a dirty image to estimate the RMS
-                impars_dirty = impars.copy()
-                impars_dirty['niter'] = 0
-                if 'startmodel' in impars_dirty:
-                    del impars_dirty['startmodel']
-
-                impars_dirty['parallel'] = parallel
-                # use the same mask as specified for the main run
-                # impars_dirty['usemask'] = None
-
-                logprint("Dirty imaging parameters are {0}".format(impars_dirty),
-                         origin='almaimf_line_imaging')
-                # check_channel_flags(concatvis, tolerance=flagging_tolerance, nchan_tolerance=nflag_threshold)
-                if not dryrun:
-                    tclean(vis=concatvis,
-                           imagename=lineimagename,
-                           restoringbeam='', # do not use restoringbeam='common'
-                           calcpsf=not psf_exists,
-                           # it results in bad edge channels dominating the beam
-                           **impars_dirty
-                          )
-                    sethistory(lineimagename, impars=impars_dirty, suffixes=(".image", ".residual"))
-                # check_channel_flags(concatvis, tolerance=flagging_tolerance, nchan_tolerance=nflag_threshold)
-                for suffix in ("mask", "model"):
-                    bad_fn = lineimagename + "." + suffix
-                    if os.path.exists(bad_fn):
-                        logprint("Removing {0} from dirty clean".format(bad_fn),
+                        # streaming, exact median/MAD: bounded memory and no
+                        # fallback to non-robust statistics
+                        stats = robust_image_statistics(lineimagename+".residual")
+                        rms = stats['rms']
+                        logprint("Residual median={0} MAD={1} rms={2}; per-channel rms "
+                                 "ranges from {3} to {4}"
+                                 .format(stats['median'], stats['mad'], rms,
+                                         np.nanmin(stats['channel_rms']),
+                                         np.nanmax(stats['channel_rms'])),
                                  origin='almaimf_line_imaging')
-                        shutil.rmtree(bad_fn)
 
-                if os.path.exists(lineimagename+".image"):
-                    # tclean with niter=0 is not supposed to produce a .image file,
-                    # but if it does (and it appears to have done so on at
-                    # least one run), we still want to clean the cube
-                    dirty_tclean_made_residual = True
-
-                did_dirty_imaging = True
-            elif make_dirty_image and not os.path.exists(lineimagename+".residual"):
-                raise ValueError("The residual image is required for further imaging.")
-            else:
-                did_dirty_imaging = False
-                if make_dirty_image:
-                    logprint("Found existing files matching {0}".format(lineimagename),
-                             origin='almaimf_line_imaging'
-                            )
-                else:
-                    logprint("Skipped dirty imaging becauase a fixed threshold is used.",
-                             origin='almaimf_line_imaging'
-                            )
-
-            if os.path.exists(lineimagename+".psf") and not os.path.exists(lineimagename+".image"):
-                if os.getenv("USE_EXISTING_PSF") and os.getenv("IGNORE_NOIMAGE"):
-                    logprint(f"The PSF for {lineimagename} exists.  The image does not.  Continuing anyway because IGNORE_NOIMAGE was set")
+                        if rms >= 1:
+                            logprint(str(stats), origin='almaimf_line_imaging_exception')
+                            raise ValueError("RMS was {0} - that's absurd.".format(rms))
+                        if rms > 0.01:
+                            logprint("The RMS found was pretty high: {0}".format(rms),
+                                     origin='almaimf_line_imaging')
+                        results['rms'] = float(rms)
+                        results['max'] = stats['max']
+                        # NaN (channels without data) is not valid JSON
+                        results['channel_rms'] = [None if np.isnan(x) else float(x)
+                                                  for x in stats['channel_rms']]
+
+            rms = tracker.result('noise', 'rms')
+            nsigma = None
+            sigma_threshold = False
+            if 'threshold' in impars and rms is not None:
+                if 'sigma' in impars['threshold']:
+                    sigma_threshold = True
+                    nsigma = int(impars['threshold'].strip('sigma'))
+                    threshold = "{0:0.4f}Jy".format(nsigma*rms) # 3 rms might be OK in practice
+                    logprint("Threshold used = {0} = {2}x{1}".format(threshold, rms, nsigma),
+                             origin='almaimf_line_imaging')
+                    impars['threshold'] = threshold
                 else:
-                    logprint("WARNING: The PSF for {0} exists, but no image exists."
-                            "  This likely implies that an ongoing or incomplete "
-                            "imaging run for this file exists.  It will not be "
-                            "imaged this time; please check what is happening."
-                            "(warning issued /after/ dirty imaging)"
-                            .format(lineimagename),
-                            origin='almaimf_line_imaging',
-                            priority='WARNING'
-                            )
-                    # just skip the rest here
-                    continue
-
-            # if the dirty image was made or exists
-            if make_dirty_image and not dryrun:
-                # the threshold needs to be computed if any imaging is to be done (either contsub or not)
-                # no .image file is produced, only a residual
-                logprint("Computing residual image statistics for {0}".format(lineimagename),
-                         origin='almaimf_line_imaging')
-                ia.open(lineimagename+".residual")
-                try:
-                    stats = ia.statistics(robust=True)
-                    rms = float(stats['medabsdevmed'] * 1.482602218505602)
-                except RuntimeError as ex:
-                    if "Binning accounting error" in str(ex):
-                        logprint("Could not use robust statistics; reverting to non-robust",
-                                 origin="almaimf_line_imaging")
-                        stats = ia.statistics()
-                        rms = stats['rms']
-                    else:
-                        raise ex
-                ia.close()
-
-                if rms >= 1:
-                    logprint(str(stats), origin='almaimf_line_imaging_exception')
-                    raise ValueError("RMS was {0} - that's absurd.".format(rms))
-                if rms > 0.01:
-                    logprint("The RMS found was pretty high: {0}".format(rms),
+                    threshold = impars['threshold']
+                    nsigma = (u.Quantity(threshold) / rms).to(u.Jy).value
+                    logprint("Manual threshold used = {0} = {2}x{1}"
+                             .format(threshold, rms, nsigma),
                              origin='almaimf_line_imaging')
 
-                continue_imaging = False
-                nsigma = None
-                if 'threshold' in impars:
-                    if 'sigma' in impars['threshold']:
-                        nsigma = int(impars['threshold'].strip('sigma'))
-                        threshold = "{0:0.4f}Jy".format(nsigma*rms) # 3 rms might be OK in practice
-                        logprint("Threshold used = {0} = {2}x{1}".format(threshold, rms, nsigma),
-                                 origin='almaimf_line_imaging')
-                        impars['threshold'] = threshold
-                    else:
-                        threshold = impars['threshold']
-                        nsigma = (u.Quantity(threshold) / rms).to(u.Jy).value
-                        logprint("Manual threshold used = {0} = {2}x{1}"
-                                 .format(threshold, rms, nsigma),
-                                 origin='almaimf_line_imaging')
-
-                    if u.Quantity(threshold).to(u.Jy).value < stats['max']:
-                        logprint("Threshold {0} was not reached (peak residual={1}).  "
-                                 "Continuing imaging.".format(threshold, stats['max']),
-                                 origin='almaimf_line_imaging'
-                                )
-                        # if the threshold was not reached, keep cleaning
-                        continue_imaging = True
-
-
-            if 'startmodel' in impars:
-                if do_contsub:
-                    # cannot use a startmodel for do_contsub
-                    logprint("Startmodel is being ignored because MS is continuum subtracted",
+                peak_residual = tracker.result('noise', 'max')
+                if peak_residual is not None and u.Quantity(threshold).to(u.Jy).value >= peak_residual:
+                    logprint("Threshold {0} is above the peak dirty residual={1}."
+                             .format(threshold, peak_residual),
                              origin='almaimf_line_imaging')
-                    del impars['startmodel']
-                else:
-                    make_continuum_startmodel = True
-                    # remove the model image
-                    # (it should be created by dirty imaging above)
-                    if os.path.exists(lineimagename+".model") and impars['startmodel'] == os.path.exists(lineimagename+".model"):
-                        logprint("Startmodel {0} was specifield and exists; we are proceeding assuming "
-                                 "that this is a full-cube startmodel.".format(impars['startmodel']))
-                        make_continuum_startmodel = False
-                    if did_dirty_imaging and os.path.exists(lineimagename+".model"):
-                        logprint("Removing {0}.model because we're using startmodel instead"
-                                 .format(lineimagename),
-                                 origin='almaimf_line_imaging')
-                        shutil.rmtree(lineimagename+".model")
-                    elif (not did_dirty_imaging) and (os.path.exists(lineimagename+".model")):
-                        logprint("Found an existing .model file, but startmodel "
-                                 "was set.  The pipeline will continue "
-                                 "assuming this is a continuation clean, and will "
-                                 "pick up with the existing model rather than "
-                                 "the specified startmodel.",
-                                 origin='almaimf_line_imaging')
-                        del impars['startmodel']
-                        make_continuum_startmodel = False
-                    else:
-                        # lineimagename+".model" does not exist
-                        pass # all is happy
 
-                    # MPI HACK
-                    # MPI appears to make .model files that can't be tracked in the usual fashion
-                    if os.path.exists(lineimagename+".workdirectory"):
-                        logprint("Removing ALL MPI-generated models in {0}.workdirectory".format(lineimagename),
-                                 origin='almaimf_line_imaging')
-                        for fn in glob.glob(lineimagename+".workdirectory/*.model"):
-                            shutil.rmtree(fn)
+            channel_groups = None
+            channel_rms = tracker.result('noise', 'channel_rms')
+            if channel_group_tolerance and sigma_threshold and channel_rms:
+                channel_groups = group_channels_by_noise(channel_rms,
+                                                         tolerance=channel_group_tolerance,
+                                                         min_nchan=channel_group_min_nchan)
+                logprint("Cleaning in {0} channel groups of similar noise: {1}"
+                         .format(len(channel_groups), channel_groups),
+                         origin='almaimf_line_imaging')
+                if len(channel_groups) == 1:
+                    channel_groups = None
 
-                    if make_continuum_startmodel and not dryrun:
-                        contmodel = "{0}/{1}.contcube.model".format(imaging_results_path_for_contmodel,
-                                                                    baselineimagename)
 
-                        if os.path.exists(contmodel):
-                            logprint("Not creating continuum model {0} because it already exists".format(contmodel))
-                        else:
-                            logprint("Creating continuum model {0} from cubeimagename={1}, contimagename={2}, imaging_results_path={3}, contmodel_path={4}"
-                                     .format(contmodel, baselineimagename, impars['startmodel'], imaging_results_path_for_contmodel, contmodel_path))
-                            new_contmodel = create_clean_model(cubeimagename=baselineimagename,
-                                                               contimagename=impars['startmodel'],
-                                                               imaging_results_path=imaging_results_path_for_contmodel,
-                                                               contmodel_path=contmodel_path)
-                            if copy_files:
-                                logprint("Moving contmodel from {0} to {1}".format(new_contmodel, contmodel))
-                                shutil.move(new_contmodel, contmodel)
+            if 'startmodel' in impars and do_contsub:
+                # cannot use a startmodel for do_contsub
+                logprint("Startmodel is being ignored because MS is continuum subtracted",
+                         origin='almaimf_line_imaging')
+                del impars['startmodel']
+
+            if not tracker.is_complete('startmodel'):
+                with tracker.stage('startmodel') as results:
+                    if 'startmodel' in impars:
+                        # remove the model image
+                        # (it should be created by dirty imaging above)
+                        if os.path.exists(lineimagename+".model"):
+                            logprint("Removing {0}.model because we're using startmodel instead"
+                                     .format(lineimagename),
+                                     origin='almaimf_line_imaging')
+                            shutil.rmtree(lineimagename+".model")
+
+                        # MPI HACK
+                        # MPI appears to make .model files that can't be tracked in the usual fashion
+                        if os.path.exists(lineimagename+".workdirectory"):
+                            logprint("Removing ALL MPI-generated models in {0}.workdirectory".format(lineimagename),
+                                     origin='almaimf_line_imaging')
+                            for fn in glob.glob(lineimagename+".workdirectory/*.model"):
+                                shutil.rmtree(fn)
+
+                        if not dryrun:
+                            contmodel = "{0}/{1}.contcube.model".format(imaging_results_path_for_contmodel,
+                                                                        baselineimagename)
+
+                            if os.path.exists(contmodel):
+                                logprint("Not creating continuum model {0} because it already exists".format(contmodel))
                             else:
-                                # if we're not moving these around, they should be the same file
-                                assert contmodel == new_contmodel
-
-                        impars['startmodel'] = contmodel
+                                logprint("Creating continuum model {0} from cubeimagename={1}, contimagename={2}, imaging_results_path={3}, contmodel_path={4}"
+                                         .format(contmodel, baselineimagename, impars['startmodel'], imaging_results_path_for_contmodel, contmodel_path))
+                                new_contmodel = create_clean_model(cubeimagename=baselineimagename,
+                                                                   contimagename=impars['startmodel'],
+                                                                   imaging_results_path=imaging_results_path_for_contmodel,
+                                                                   contmodel_path=contmodel_path)
+                                if copy_files:
+                                    logprint("Moving contmodel from {0} to {1}".format(new_contmodel, contmodel))
+                                    shutil.move(new_contmodel, contmodel)
+                                else:
+                                    # if we're not moving these around, they should be the same file
+                                    assert contmodel == new_contmodel
 
+                            results['startmodel'] = contmodel
 
+            if 'startmodel' in impars and tracker.result('startmodel', 'startmodel'):
+                impars['startmodel'] = tracker.result('startmodel', 'startmodel')
 
-            if continue_imaging or dirty_tclean_made_residual or not os.path.exists(lineimagename+".image"):
-                # continue imaging using a threshold
-                logprint("Imaging parameters are {0}".format(impars),
-                         origin='almaimf_line_imaging')
-                logprint("continue_imaging is set to be {0}".format(continue_imaging),
-                         origin='almaimf_line_imaging')
-                logprint("dirty_tclean_made_residual is set to be {0}".format(dirty_tclean_made_residual),
-                         origin='almaimf_line_imaging')
 
-                # Oct 13, 2020: we'll modify the mask, not remove it
-                # if os.path.exists(lineimagename+".mask") and 'usemask' in impars and impars['usemask'] not in ('', None):
-                #     logprint("using pre-existing mask {0}".format(lineimagename+".mask"),
-                #              origin='almaimf_line_imaging')
-                #     shutil.rmtree(lineimagename+".mask")
-                # elif os.path.exists(lineimagename+".mask"):
-                #     if 'usemask' in impars and impars['usemask'] != 'user':
-                #         raise ValueError("Mask exists but not specified as user.")
-                if ((('mask' not in impars) or ('mask-ranges' in linpars))
-                    and (not os.path.exists(lineimagename+".mask"))):
-                    pblimit = impars['pblimit'] if 'pblimit' in impars else 0.001
-                    logprint("Creating mask from pb with pblimit = {0}"
-                             .format(pblimit), origin='almaimf_line_imaging')
-
-                    #ia.open("{0}.pb".format(lineimagename))
-                    #ia.calcmask(mask="{0}.pb > {1}".format(lineimagename, pblimit),
-                    #            name="pbmask"
-                    #           )
-                    #ia.close()
-                    #makemask(inpimage='{0}.pb'.format(lineimagename),
-                    #         inpmask='{0}.pb:pbmask'.format(lineimagename),
-                    #         output='{0}.mask'.format(lineimagename),
-                    #         mode='copy')
-                    immath(imagename="{0}.pb".format(lineimagename),
-                           outfile="{0}.mask".format(lineimagename),
-                           expr="iif(IM0>{0},1.0,0.0)".format(pblimit))
-                    assert os.path.exists(lineimagename+".mask"), "bug"
-
-                # this if statement is now (almost?) entirely redundant b/c the
-                # previous ensures that a mask exists
-                if os.path.exists(lineimagename+".mask"):
-                    impars['usemask'] = 'user'
-
-                    if 'mask' in impars and impars['mask'] != '':
-                        # this is to handle the case that a user has specified a mask:
-                        # tclean will fail if the imagname.mask exists (and we
-                        # know it does; see check above) but a mask is
-                        # specified
-                        # (This is only needed if dirty imaging is _not_ run)
-                        logprint("Found an existing mask, but a user mask {0} was specified,"
-                                 " so we are overwriting the existing mask.".format(impars['mask']),
+            if not tracker.is_complete('mask'):
+                with tracker.stage('mask'):
+                    if os.path.exists(lineimagename+".mask"):
+                        # left over from an incomplete run: rebuild it
+                        logprint("Removing incomplete mask {0}.mask".format(lineimagename),
                                  origin='almaimf_line_imaging')
                         shutil.rmtree(lineimagename+".mask")
-                        shutil.copytree(impars['mask'], lineimagename+".mask")
-
-                    impars['mask'] = '' # the mask exists, so CASA can't be told to use it
-
-                    if mask_out_endchannels:
-                        # we mask out the end channels because sometimes these
-                        # channels have less coverage, and attempting to clean
-                        # these outer channels frequently causes tclean to
-                        # diverge
-                        logprint("Masking out end channels {0}".format(mask_out_endchannels),
-                                 origin="almaimf_line_imaging")
-                        ia.open(infile=lineimagename+".mask")
-                        lowedge = ia.getchunk(blc=[0,0,0,0],
-                                              trc=[-1,-1,-1,mask_out_endchannels])
-                        lowedge[:] = 0
-                        ia.putchunk(pixels=lowedge, blc=[0,0,0,0],)
-
-                        shape = ia.shape()
-
-                        highedge = ia.getchunk(blc=[0,0,0,shape[3]-1-mask_out_endchannels],
-                                               trc=[-1,-1,-1,-1])
-                        highedge[:] = 0
-                        ia.putchunk(highedge,
-                                    blc=[0,0,0,shape[3]-1-mask_out_endchannels],
-                                    )
-
-                        ia.close()
-                    if ((line_band_name in line_parameters[field]
-                         and 'mask-ranges' in linpars)):
-                        ia.open(infile=lineimagename+".mask")
-                        for maskrange in linpars['mask-ranges']:
-                            logprint("Masking out selected channels {0}".format(maskrange),
-                                     origin="almaimf_line_imaging")
-
-                            veltofreq = u.Quantity(maskrange, u.km/u.s).to(u.GHz, u.doppler_radio(restfreq))
-                            startchan = np.argmin(np.abs(veltofreq[0] - freqs))
-                            endchan = np.argmin(np.abs(veltofreq[1] - freqs))
-                            if endchan < startchan:
-                                startchan, endchan = endchan, startchan
 
-                            logprint("Masking out selected channels {0}-{1}".format(startchan, endchan),
+                    if (('mask' not in impars) or ('mask-ranges' in linpars)) and not dryrun:
+                        pblimit = impars['pblimit'] if 'pblimit' in impars else 0.001
+                        logprint("Creating mask from pb with pblimit = {0}"
+                                 .format(pblimit), origin='almaimf_line_imaging')
+
+                        #ia.open("{0}.pb".format(lineimagename))
+                        #ia.calcmask(mask="{0}.pb > {1}".format(lineimagename, pblimit),
+                        #            name="pbmask"
+                        #           )
+                        #ia.close()
+                        #makemask(inpimage='{0}.pb'.format(lineimagename),
+                        #         inpmask='{0}.pb:pbmask'.format(lineimagename),
+                        #         output='{0}.mask'.format(lineimagename),
+                        #         mode='copy')
+                        immath(imagename="{0}.pb".format(lineimagename),
+                               outfile="{0}.mask".format(lineimagename),
+                               expr="iif(IM0>{0},1.0,0.0)".format(pblimit))
+                        assert os.path.exists(lineimagename+".mask"), "bug"
+
+                    if os.path.exists(lineimagename+".mask"):
+                        if 'mask' in impars and impars['mask'] != '':
+                            # this is to handle the case that a user has specified a mask:
+                            # tclean will fail if the imagname.mask exists (and we
+                            # know it does; see check above) but a mask is
+                            # specified
+                            logprint("Found an existing mask, but a user mask {0} was specified,"
+                                     " so we are overwriting the existing mask.".format(impars['mask']),
+                                     origin='almaimf_line_imaging')
+                            shutil.rmtree(lineimagename+".mask")
+                            shutil.copytree(impars['mask'], lineimagename+".mask")
+
+                        if mask_out_endchannels:
+                            # we mask out the end channels because sometimes these
+                            # channels have less coverage, and attempting to clean
+                            # these outer channels frequently causes tclean to
+                            # diverge
+                            logprint("Masking out end channels {0}".format(mask_out_endchannels),
                                      origin="almaimf_line_imaging")
-                            flagchans = ia.getchunk(blc=[0,0,0, startchan],
-                                                    trc=[-1,-1,-1, endchan])
-                            logprint("Nchan before: included={0} excluded={1}".format(flagchans.sum(), (flagchans==0).sum()),
-                                     origin="almaimf_line_imaging")
-                            flagchans[:] = 0
-                            logprint("Nchan after: included={0} excluded={1}".format(flagchans.sum(), (flagchans==0).sum()),
-                                     origin="almaimf_line_imaging")
-                            ia.putchunk(pixels=flagchans, blc=[0,0,0, startchan],)
-
-                        ia.close()
-                elif ((line_band_name in line_parameters[field]
-                     and 'mask-ranges' in linpars)):
-                    raise ValueError("Mask-ranges was specified but no mask is available - this might "
-                                     "be a corner case that needs to be implemented")
-
-                # SANITY CHECK:
-                if os.path.exists(lineimagename+".model"):
-                    logprint("Model {0}.model exists".format(lineimagename),
+                            ia.open(infile=lineimagename+".mask")
+                            lowedge = ia.getchunk(blc=[0,0,0,0],
+                                                  trc=[-1,-1,-1,mask_out_endchannels])
+                            lowedge[:] = 0
+                            ia.putchunk(pixels=lowedge, blc=[0,0,0,0],)
+
+                            shape = ia.shape()
+
+                            highedge = ia.getchunk(blc=[0,0,0,shape[3]-1-mask_out_endchannels],
+                                                   trc=[-1,-1,-1,-1])
+                            highedge[:] = 0
+                            ia.putchunk(highedge,
+                                        blc=[0,0,0,shape[3]-1-mask_out_endchannels],
+                                        )
+
+                            ia.close()
+                        if ((line_band_name in line_parameters[field]
+                             and 'mask-ranges' in linpars)):
+                            ia.open(infile=lineimagename+".mask")
+                            for maskrange in linpars['mask-ranges']:
+                                logprint("Masking out selected channels {0}".format(maskrange),
+                                         origin="almaimf_line_imaging")
+
+                                veltofreq = u.Quantity(maskrange, u.km/u.s).to(u.GHz, u.doppler_radio(restfreq))
+                                startchan = np.argmin(np.abs(veltofreq[0] - freqs))
+                                endchan = np.argmin(np.abs(veltofreq[1] - freqs))
+                                if endchan < startchan:
+                                    startchan, endchan = endchan, startchan
+
+                                logprint("Masking out selected channels {0}-{1}".format(startchan, endchan),
+                                         origin="almaimf_line_imaging")
+                                flagchans = ia.getchunk(blc=[0,0,0, startchan],
+                                                        trc=[-1,-1,-1, endchan])
+                                logprint("Nchan before: included={0} excluded={1}".format(flagchans.sum(), (flagchans==0).sum()),
+                                         origin="almaimf_line_imaging")
+                                flagchans[:] = 0
+                                logprint("Nchan after: included={0} excluded={1}".format(flagchans.sum(), (flagchans==0).sum()),
+                                         origin="almaimf_line_imaging")
+                                ia.putchunk(pixels=flagchans, blc=[0,0,0, startchan],)
+
+                            ia.close()
+                    elif ((line_band_name in line_parameters[field]
+                         and 'mask-ranges' in linpars)) and not dryrun:
+                        raise ValueError("Mask-ranges was specified but no mask is available - this might "
+                                         "be a corner case that needs to be implemented")
+
+            if os.path.exists(lineimagename+".mask"):
+                impars['usemask'] = 'user'
+                impars['mask'] = '' # the mask exists, so CASA can't be told to use it
+
+
+            if not tracker.is_complete('clean'):
+                # channel groups finished by an interrupted attempt
+                groups_done = tracker.result('clean', 'groups_done') or []
+                with tracker.stage('clean') as results:
+                    logprint("Imaging parameters are {0}".format(impars),
                              origin='almaimf_line_imaging')
-                    if 'startmodel' in impars and impars['startmodel']:
-                        raise ValueError("Startmodel is set to {0} but model {1} exists"
-                                         .format(impars['startmodel'], lineimagename+".model"))
-
-                # set by global environmental variable to auto-recognize
-                # when being run from an MPI session.
-                impars['parallel'] = parallel
-
-                if os.path.exists(lineimagename+".psf"):
-                    psf_exists = True
-                    logprint("Found existing PSF file", origin='almaimf_line_imaging')
-
-                # check_channel_flags(concatvis, tolerance=flagging_tolerance, nchan_tolerance=nflag_threshold)
-                if not dryrun:
-                    logprint("Cleaning with pars {0}".format(impars), origin='almaimf_line_imaging')
-                    tclean(vis=concatvis,
-                           imagename=lineimagename,
-                           restoringbeam='', # do not use restoringbeam='common'
-                           # it results in bad edge channels dominating the beam
-                           calcres=False,
-                           calcpsf=not psf_exists,
-                           **impars
-                          )
-                # check_channel_flags(concatvis, tolerance=flagging_tolerance, nchan_tolerance=nflag_threshold)
-                # re-do the tclean once more, with niter=0, to force recalculation of the residual
-                niter = impars['niter']
-                impars['niter'] = 0
-                if 'startmodel' in impars:
-                    # we definitely have a model now, so we don't want a startmodel
-                    smod = impars['startmodel']
-                    impars['startmodel'] = ''
-                else:
-                    smod = ''
-                if 'mask' in impars:
-                    mask = impars['mask']
-                    impars['mask'] = ''
-                else:
-                    mask = ''
-                # check_channel_flags(concatvis, tolerance=flagging_tolerance, nchan_tolerance=nflag_threshold)
-                if not dryrun:
-                    logprint("Final zero-iter clean to restore residual", origin='almaimf_line_imaging')
-                    tclean(vis=concatvis,
-                           imagename=lineimagename,
-                           restoringbeam='',
-                           calcres=True,
-                           calcpsf=False, # not needed; PSF already exists
-                           **impars
-                          )
-                    impars['niter'] = niter
-                    impars['startmodel'] = smod
-                    impars['mask'] = mask
-                    sethistory(lineimagename, nsigma=nsigma, impars=impars)
-                # check_channel_flags(concatvis, tolerance=flagging_tolerance, nchan_tolerance=nflag_threshold)
-
-                if not dryrun:
-                    logprint("pbcorrecting {0}".format(lineimagename), origin='almaimf_line_imaging')
-                    impbcor(imagename=lineimagename+'.image',
-                            pbimage=lineimagename+'.pb',
-                            outfile=lineimagename+'.image.pbcor',
-                            cutoff=0.2,
-                            overwrite=True)
-
-                    if do_export_fits:
-                        exportfits(lineimagename+".image", lineimagename+".image.fits", overwrite=True)
-                        exportfits(lineimagename+".image.pbcor", lineimagename+".image.pbcor.fits", overwrite=True)
-
-                        cube = SpectralCube.read(lineimagename+".image.fits", use_dask=True)
-                        cutslc = cube.subcube_slices_from_mask(cube.mask)
-                        cube[cutslc].write(lineimagename+".image.mincube.fits", overwrite=True)
-                        del cube
-                        SpectralCube.read(lineimagename+".image.pbcor.fits", use_dask=True)[cutslc].write(lineimagename+".image.pbcor.mincube.fits", overwrite=True)
-                        SpectralCube.read(lineimagename+".model", use_dask=True, format='casa_image')[cutslc].write(lineimagename+".model.mincube.fits", overwrite=True)
-                        SpectralCube.read(lineimagename+".residual", use_dask=True, format='casa_image')[cutslc].write(lineimagename+".residual.mincube.fits", overwrite=True)
-
-                        # write out JvM-corrected cubes
-                        beam_correct_cube(lineimagename)
-
-
-            if copy_files and not dryrun:
-                for suffix in ('.image', '.image.pbcor', '.mask', '.model',
-                               '.pb', '.psf', '.residual', '.sumwt', '.weight',
-                               '.contcube.model',
-                               '.model.mincube.fits',
-                               '.residual.mincube.fits',
-                               '.image.fits',
-                               '.image.mincube.fits',
-                               '.image.pbcor.fits',
-                               '.image.pbcor.mincube.fits',
-                               '.JvM.image.pbcor.fits',
-                               '.JvM.image.fits',
-                               '.flatpb.fits',
-                              ):
-                    src = lineimagename+suffix
-                    dest = proddir
-                    destfile = os.path.join(proddir, os.path.basename(src))
-                    if os.path.exists(src):
-                        if os.path.exists(destfile):
-                            logprint("Destination {0} exists".format(destfile), origin='almaimf_line_imaging')
-                            if not os.getenv('CONTINUE_IF_MS_EXISTS'):
-                                raise ValueError("Target destination {0} exists and we were trying to copy into it.".format(destfile))
-                            else:
-                                logprint("Removing the workingdir file {0}".format(src), origin='almaimf_line_imaging')
-                                if src.endswith('fits'):
-                                    os.remove(src)
-                                else:
-                                    shutil.rmtree(src)
-                        else:
-                            logprint("Moving {0}->{1}".format(src, dest), origin='almaimf_line_imaging')
-                            shutil.move(src, dest)
 
+                    # the startmodel stage removes any model, so an existing
+                    # model comes from an interrupted clean: continue from it,
+                    # recomputing the residual to match
+                    continuation = os.path.exists(lineimagename+".model")
+                    if continuation:
+                        logprint("Model {0}.model exists from an incomplete clean; "
+                                 "continuing from it instead of the startmodel"
+                                 .format(lineimagename),
+                                 origin='almaimf_line_imaging')
+                        impars_clean = impars.copy()
+                        impars_clean.pop('startmodel', None)
+                    else:
+                        impars_clean = impars
+
+                    if not dryrun and channel_groups is None:
+                        logprint("Cleaning with pars {0}".format(impars_clean), origin='almaimf_line_imaging')
+                        tclean(vis=concatvis,
+                               imagename=lineimagename,
+                               restoringbeam='', # do not use restoringbeam='common'
+                               # it results in bad edge channels dominating the beam
+                               calcres=continuation,
+                               calcpsf=False,
+                               **impars_clean
+                              )
+                    elif not dryrun:
+                        # clean each group of channels as its own cube on the
+                        # same spectral grid, reusing the PSF, weights, and
+                        # residual already computed for the full cube
+                        results['groups_done'] = []
+                        group_models = []
+                        for first, last in channel_groups:
+                            groupname = "{0}.chan{1}-{2}".format(lineimagename, first, last)
+                            group_models.append((groupname, first))
+                            if [first, last] in groups_done and os.path.exists(groupname+".model"):
+                                logprint("Channel group {0}-{1} was already cleaned".format(first, last),
+                                         origin='almaimf_line_imaging')
+                                results['groups_done'].append([first, last])
+                                continue
+
+                            make_channel_group_images(lineimagename, groupname, first, last,
+                                                      ('.psf', '.pb', '.sumwt', '.weight',
+                                                       '.residual', '.mask', '.model'))
+
+                            impars_group = impars_clean.copy()
+                            impars_group.pop('chanchunks', None)
+                            freq, width = channel_grid(lineimagename+".residual", first)
+                            impars_group['start'] = '{0!r}Hz'.format(freq)
+                            impars_group['width'] = '{0!r}Hz'.format(width)
+                            impars_group['nchan'] = last - first + 1
+
+                            group_rms = [x for x in channel_rms[first:last+1] if x is not None]
+                            group_rms = max(group_rms) if group_rms else rms
+                            impars_group['threshold'] = "{0:0.4f}Jy".format(nsigma*group_rms)
+
+                            if impars_group.get('startmodel'):
+                                make_channel_group_images(impars_group['startmodel'],
+                                                          groupname+".startmodel", first, last, ('',))
+                                impars_group['startmodel'] = groupname+".startmodel"
+
+                            logprint("Cleaning channels {0}-{1} with threshold {2}"
+                                     .format(first, last, impars_group['threshold']),
+                                     origin='almaimf_line_imaging')
+                            tclean(vis=concatvis,
+                                   imagename=groupname,
+                                   restoringbeam='',
+                                   calcres=continuation,
+                                   calcpsf=False,
+                                   **impars_group
+                                  )
+                            results['groups_done'].append([first, last])
+                            tracker.save()
+
+                        stitch_channel_group_models(lineimagename, group_models)
+                        for groupname, first in group_models:
+                            for fn in glob.glob(groupname+".*"):
+                                shutil.rmtree(fn)
+
+            if not tracker.is_complete('restore'):
+                with tracker.stage('restore'):
+                    # re-do the tclean once more, with niter=0, to force recalculation of the residual
+                    impars_restore = impars.copy()
+                    impars_restore['niter'] = 0
+                    # we definitely have a model now, so we don't want a startmodel
+                    if 'startmodel' in impars_restore:
+                        impars_restore['startmodel'] = ''
+                    if 'mask' in impars_restore:
+                        impars_restore['mask'] = ''
+                    if not dryrun:
+                        logprint("Final zero-iter clean to restore residual", origin='almaimf_line_imaging')
+                        tclean(vis=concatvis,
+                               imagename=lineimagename,
+                               restoringbeam='',
+                               calcres=True,
+                               calcpsf=False, # not needed; PSF already exists
+                               **impars_restore
+                              )
+                        sethistory(lineimagename, nsigma=nsigma, impars=impars)
+
+            if shard_stage != 'image':
+                finish_cube(tracker, lineimagename)
+            finalize_cube(tracker, lineimagename)
+
+            if copy_files and not dryrun and shard_stage != 'image':
+                # the shards share the MS staged by the prepare stage; it is
+                # removed after the merge
                 # use the variable name 'newconcatvis' here since that should
                 # only ever take on the value specified in copy_files; this is
                 # a safety mechanism to make sure we don't accidentally delete
                 # the original file.
+                # (with a staging cache, the copies live in the cache and
+                # are only released here)
                 if do_not_concat:
                     # sanity check: make sure `newconcatvis` was set to be a list
                     assert isinstance(newconcatvis, list)
-                    for newvv in newconcatvis:
+                    for newvv, staged in zip(newconcatvis, concatvis):
+                        assert staged == newvv or staging_cache_directory
                         logprint("Removing MS file {0} from working directory {1}"
-                                 .format(newvv, workdir),
+                                 .format(staged, workdir),
                                  origin='almaimf_line_imaging')
-                        shutil.rmtree(newvv)
+                        release_ms(staged)
                 else:
+                    assert concatvis == newconcatvis or staging_cache_directory
                     logprint("Removing MS file {0} from working directory {1}"
-                             .format(newconcatvis, workdir),
+                             .format(concatvis, workdir),
                              origin='almaimf_line_imaging')
-                    shutil.rmtree(newconcatvis)
+                    release_ms(concatvis)
 
 
             logprint("Completed {0}->{1}".format(vis, concatvis), origin='almaimf_line_imaging')
@@ -0,0 +1,189 @@
+"""
+Worker functions for split_line_windows.py.
+
+They live in an importable module (rather than in the script) so that
+split_line_windows.py can run them concurrently: `run_split_groups` starts
+a separate CASA process for each group of splits, with this file as a script
+and its jobs in a JSON file, so that each process has its own CASA tools.
+"""
+import os
+import sys
+import json
+import time
+import subprocess
+
+try:
+    from taskinit import tbtool
+    from tasks import split, flagdata
+except ImportError:
+    from casatasks import split, flagdata
+    from casatools import table as tbtool
+
+from metadata_tools import check_channel_flags, logprint as logprint_
+
+
+def logprint(string):
+    logprint_(string, origin='split_line_windows')
+
+
+def touch(fname, times=None):
+    with open(fname, 'a'):
+        os.utime(fname, times)
+
+
+def split_line_window(job):
+    """
+    Split one spectral window of one field out of a measurement set.
+
+    Parameters
+    ----------
+    job : dict
+        ``invis``, ``outvis``, ``field``, and ``spw`` (the spw ID in
+        ``invis``)
+
+    Returns
+    -------
+    timing : dict or None
+        Wall-clock times (s) of the flag check and of the split, or None if
+        the split was skipped because it is done or in progress elsewhere
+    """
+    invis, outvis = job['invis'], job['outvis']
+    field, spw = job['field'], job['spw']
+
+    if os.path.exists(outvis):
+        logprint("Skipping {0} because it's done".format(outvis))
+        return None
+    if os.path.exists(outvis+".working"):
+        logprint("Skipping {0} because it's in progress in another process".format(outvis))
+        return None
+
+    logprint("Splitting {0}'s spw {2} to {1}".format(invis, outvis, spw))
+    touch(outvis+".working")
+    t0 = time.time()
+    try:
+        tb = tbtool()
+        tb.open(invis)
+        if 'CORRECTED_DATA' in tb.colnames():
+            datacolumn = 'corrected'
+        else:
+            datacolumn = 'data'
+        tb.close()
+
+        # verify that no channels are flagged in the input data
+        # (no channel-based flagging is performed by the ALMA pipeline or by
+        # the ALMA-IMF pipeline; there is no technical reason channels should
+        # ever be flagged)
+        # I revised this later because it appears that at least one
+        # window legitimately had edge channels flagged out
+        # (check_channel_flags will raise an exception if there is excess flagging)
+        # Also, Luke reported that there are some cases in which chunks were
+        # flagged out because of bad atmospheric absorption lines in part of the band;
+        # we think this only affected 7m data?
+        check_channel_flags(invis, field=field, spw=str(spw), tolerance=0.1)
+        t1 = time.time()
+
+        result = split(vis=invis,
+                       spw=spw,
+                       field=field,
+                       outputvis=outvis,
+                       # there is no corrected_data column because we're
+                       # splitting from split MSes
+                       datacolumn=datacolumn,
+                      )
+        print("Split ended with result={0} in line split".format(result))
+
+        flagdata(vis=outvis, mode='manual', autocorr=True)
+        t2 = time.time()
+    finally:
+        os.remove(outvis+".working")
+
+    logprint("Split {0} in {1:0.1f}s".format(outvis, t2 - t0))
+    return {'started': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(t0)),
+            'flag_check_time': t1 - t0,
+            'split_time': t2 - t1,
+            'wall_time': t2 - t0,
+            'pid': os.getpid(),
+           }
+
+
+def split_line_windows_from(jobs):
+    """
+    Run the splits ``jobs``, which all read the same parent measurement set,
+    one after the other (so the parent is read while it is hot in the page
+    cache).
+
+    Returns
+    -------
+    timings : dict
+        ``{outvis: timing}`` for the splits that were done
+    """
+    timings = {}
+    for job in jobs:
+        timing = split_line_window(job)
+        if timing is not None:
+            timings[job['outvis']] = timing
+    return timings
+
+
+def run_split_groups(groups, nprocs, jobdir='.', poll_interval=5):
+    """
+    Run groups of splits (see `split_line_windows_from`) concurrently, one
+    process per group, with at most ``nprocs`` processes at any time.  This
+    requires CASA 6, in which the python executable can import the CASA
+    tasks.
+
+    Raises an exception naming the failed groups once all have finished.
+
+    Returns
+    -------
+    timings : dict
+        ``{outvis: timing}`` for the splits that were done
+    """
+    pending = []
+    for ii, group in enumerate(groups):
+        jobfile = os.path.join(jobdir, "{0}_{1}.splits.json".format(
+            os.path.basename(os.path.normpath(group[0]['invis'])), ii))
+        with open(jobfile, 'w') as fh:
+            json.dump(group, fh)
+        pending.append(jobfile)
+
+    timings = {}
+    running = {}
+    failed = []
+    while pending or running:
+        while pending and len(running) < nprocs:
+            jobfile = pending.pop(0)
+            logprint("Starting split process for {0}".format(jobfile))
+            logfile = open(jobfile.replace(".splits.json", ".splits.log"), 'w')
+            proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), jobfile],
+                                    stdout=logfile, stderr=subprocess.STDOUT)
+            logfile.close()
+            running[proc] = jobfile
+
+        time.sleep(poll_interval)
+        for proc in [proc for proc in running if proc.poll() is not None]:
+            jobfile = running.pop(proc)
+            timingfile = jobfile.replace(".splits.json", ".timings.json")
+            if proc.returncode != 0:
+                logprint("Split process for {0} failed with exit code {1}"
+                         .format(jobfile, proc.returncode))
+                failed.append(jobfile)
+            else:
+                logprint("Split process for {0} finished".format(jobfile))
+                with open(timingfile, 'r') as fh:
+                    timings.update(json.load(fh))
+                os.remove(jobfile)
+                os.remove(timingfile)
+
+    if failed:
+        raise ValueError("Splitting failed for {0}; see the corresponding .splits.log files"
+                         .format(failed))
+    return timings
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1], 'r') as fh:
+        jobs = json.load(fh)
+    timings = split_line_windows_from(jobs)
+    with open(sys.argv[1].replace(".splits.json", ".timings.json"), 'w') as fh:
+        json.dump(timings, fh)
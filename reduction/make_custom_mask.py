@@ -8,6 +8,8 @@ Requirements installation:
                            'https://github.com/radio-astro-tools/spectral-cube/archive/master.zip'])
 """
 import os
+import json
+import hashlib
 import numpy as np
 
 # non-casa requirements
@@ -15,6 +17,7 @@ import regions
 from spectral_cube import SpectralCube
 from astropy import units as u
 from metadata_tools import logprint
+from imaging_stages import path_digest
 
 try:
     from casatools import image
@@ -23,8 +26,29 @@ except ImportError:
     from taskinit import iatool
     ia = iatool()
 
+def mask_cache_key(regfn, imname):
+    """
+    Key identifying a mask made from region file ``regfn`` and image
+    ``imname``: it changes if the region file's contents or the image change
+    """
+    with open(regfn, 'rb') as fh:
+        region_hash = hashlib.md5(fh.read()).hexdigest()
+    return "{0}:{1}:{2}:{3}".format(os.path.abspath(regfn), region_hash,
+                                    os.path.abspath(imname), path_digest(imname))
+
 def make_custom_mask(fieldname, imname, almaimf_code_path, band_id, rootdir="",
                      suffix="", do_bsens=False):
+    """
+    Make a mask from the ds9 regions in
+    ``clean_regions/<fieldname>_<band_id><suffix>.reg``: within each region,
+    the pixels of ``imname`` brighter than the region's label (a flux
+    density, e.g. "1 mJy") are included.
+
+    The mask is reused without rebuilding it if it was made from the same
+    region file contents and the same, unchanged, image (see
+    `mask_cache_key`); the key is stored next to the mask in
+    ``<maskname>.cache.json``.
+    """
 
     regfn = os.path.join(almaimf_code_path,
                         'clean_regions/{0}_{1}{2}.reg'.format(fieldname,
@@ -42,6 +66,24 @@ def make_custom_mask(fieldname, imname, almaimf_code_path, band_id, rootdir="",
     if not os.path.exists(regfn):
         raise IOError("Region file {0} does not exist".format(regfn))
 
+    maskname = ('{fieldname}_{band_id}{suffix}_mask.mask'
+                .format(fieldname=fieldname, band_id=band_id,
+                        suffix=suffix))
+    # add a root directory if there is one
+    # (if rootdir == "", this just returns maskname)
+    maskname = os.path.join(rootdir, maskname)
+
+    cachefile = maskname + ".cache.json"
+    key = mask_cache_key(regfn, imname)
+    if os.path.exists(maskname) and os.path.exists(cachefile):
+        with open(cachefile, 'r') as fh:
+            cached = json.load(fh)
+        if cached['key'] == key and cached['mask_digest'] == path_digest(maskname):
+            logprint("Reusing mask {0}, made from region file {1} and image {2}"
+                     .format(maskname, regfn, imname),
+                     origin='make_custom_mask')
+            return maskname
+
     regs = regions.read_ds9(regfn)
 
     logprint("Using region file {0} to create mask from image "
@@ -55,6 +97,9 @@ def make_custom_mask(fieldname, imname, almaimf_code_path, band_id, rootdir="",
     else:
         assert image.unit.is_equivalent(u.Jy), "Image must be in Jansky/beam."
 
+    assert hasattr(image, 'unit'), "Image {imname} failed to have units".format(imname=imname)
+    image_jy = u.Quantity(image).to(u.Jy).value
+
     mask_array = np.zeros(image.shape, dtype='bool')
 
     for reg in regs:
@@ -64,15 +109,14 @@ def make_custom_mask(fieldname, imname, almaimf_code_path, band_id, rootdir="",
 
         preg = reg.to_pixel(image.wcs)
         msk = preg.to_mask()
-        assert hasattr(image, 'unit'), "Image {imname} failed to have units".format(imname=imname)
-        mimg = msk.multiply(image)
-        assert mimg is not None
-        assert hasattr(mimg, 'unit'), "Masked Image {imname} failed to have units".format(imname=imname)
-        assert mimg.unit.is_equivalent(u.Jy)
 
-        msk.cutout(mask_array)[:] = (mimg > threshold) | msk.cutout(mask_array)
-        # cutout does some extra check-for-overlap work
-        #mask_array[msk.bbox.slices] = (msk.multiply(image) > threshold) | mask_array[msk.bbox.slices]
+        # only the region's bounding box (clipped to the image) is touched
+        slices_large, slices_small = msk.get_overlap_slices(image.shape)
+        if slices_large is None:
+            # the region does not overlap the image
+            continue
+        inside = msk.data[slices_small] > 0
+        mask_array[slices_large] |= inside & (image_jy[slices_large] > threshold.to(u.Jy).value)
 
 
     # CASA transposes arrays!!!!!
@@ -83,16 +127,12 @@ def make_custom_mask(fieldname, imname, almaimf_code_path, band_id, rootdir="",
     cs = ia.coordsys()
     ia.close()
 
-    maskname = ('{fieldname}_{band_id}{suffix}_mask.mask'
-                .format(fieldname=fieldname, band_id=band_id,
-                        suffix=suffix))
-    # add a root directory if there is one
-    # (if rootdir == "", this just returns maskname)
-    maskname = os.path.join(rootdir, maskname)
-
     assert ia.fromarray(outfile=maskname,
                         pixels=mask_array.astype('float')[:,:,None,None],
                         csys=cs.torecord(), overwrite=True), "FAILURE in final mask creation step"
     ia.close()
 
+    with open(cachefile, 'w') as fh:
+        json.dump({'key': key, 'mask_digest': path_digest(maskname)}, fh)
+
     return maskname
@@ -1,7 +1,10 @@
 import numpy as np
 import os
+import json
+import hashlib
 import astropy.units as u
 from astropy import constants
+from baseline_tools import max_baseline_length
 try:
     from casac import casac
     synthesisutils = casac.synthesisutils
@@ -25,13 +28,97 @@ def logprint(string, origin='almaimf_metadata',
     casalog.post(string, origin=origin, priority=priority)
 
 
-def is_7m(ms):
+class MSMetadataSnapshot(object):
+    """
+    All of the metadata needed by `determine_phasecenter`,
+    `determine_imsize`, and `is_7m`, read from a measurement set once and
+    stored as arrays.  Pass it as ``snapshot=`` to those functions to avoid
+    re-opening the MS and re-querying ``msmd`` for every spectral window.
+
+    Parameters
+    ----------
+    vis : str
+        Measurement set name
+    """
+    def __init__(self, vis):
+        self.vis = vis
+
+        logprint("Reading metadata snapshot of {0}".format(vis))
+
+        msmd.open(vis)
+        self.fieldnames = np.array(msmd.fieldnames())
+        nfields = len(self.fieldnames)
+
+        self.scans_for_field = [np.array(msmd.scansforfield(fid), dtype='int')
+                                for fid in range(nfields)]
+        self.field_has_scans = np.array([len(scans) > 0 for scans in
+                                         self.scans_for_field], dtype='bool')
+
+        # phase centers in radians, NaN for fields without scans
+        self.phasecenter_ra = np.full(nfields, np.nan)
+        self.phasecenter_dec = np.full(nfields, np.nan)
+        self.phasecenter_refer = np.array([''] * nfields, dtype='object')
+        for fid in np.flatnonzero(self.field_has_scans):
+            pc = msmd.phasecenter(fid)
+            self.phasecenter_ra[fid] = zero_to_2pi(pc['m0']['value'])
+            self.phasecenter_dec[fid] = pc['m1']['value']
+            self.phasecenter_refer[fid] = pc['refer']
+
+        allscans = np.unique(np.concatenate(self.scans_for_field + [np.array([], dtype='int')]))
+        self.antennas_for_scan = {scan: np.array(msmd.antennasforscan(scan), dtype='int')
+                                  for scan in allscans}
+
+        self.spw_reffreqs = np.array([msmd.reffreq(spw)['m0']['value']
+                                      for spw in range(msmd.nspw())]) # Hz
+        self.spws_for_field = {name: np.array(msmd.spwsforfield(name))
+                               for name in set(self.fieldnames)}
+        msmd.close()
+
+        tb.open(vis+"/ANTENNA")
+        self.antenna_positions = tb.getcol('POSITION') # (3, nant) in m
+        self.antenna_diameters = tb.getcol('DISH_DIAMETER') # m
+        tb.close()
+
+    def field_ids(self, field):
+        """ Field IDs matching ``field``, regardless of whether they have scans """
+        field_ids, = np.where(self.fieldnames == field)
+        return field_ids
+
+    def first_antenna_for_field(self, field_ids):
+        """
+        The ID of the first antenna in the first scan of each field, or -1 if
+        the field has no scans or the scan has no antennas
+        """
+        first_antid = []
+        for fid in field_ids:
+            scans = self.scans_for_field[fid]
+            ants = self.antennas_for_scan[scans[0]] if len(scans) > 0 else []
+            first_antid.append(ants[0] if len(ants) > 0 else -1)
+        return np.array(first_antid, dtype='int')
+
+
+def get_metadata_snapshot(ms, snapshot=None):
+    """
+    Return ``snapshot`` if it is a snapshot of ``ms``, otherwise create one
+    """
+    if snapshot is not None:
+        if snapshot.vis != ms:
+            raise ValueError("Metadata snapshot of {0} was passed for {1}"
+                             .format(snapshot.vis, ms))
+        return snapshot
+    return MSMetadataSnapshot(ms)
+
+
+def is_7m(ms, snapshot=None):
     """
     Determine if a measurement set includes 7m data
     """
-    msmd.open(ms)
-    diameter = msmd.antennadiameter(0)['value']
-    msmd.close()
+    if snapshot is not None:
+        diameter = get_metadata_snapshot(ms, snapshot).antenna_diameters[0]
+    else:
+        msmd.open(ms)
+        diameter = msmd.antennadiameter(0)['value']
+        msmd.close()
     if diameter == 7.0:
         return True
     else:
@@ -48,48 +135,54 @@ def zero_to_2pi(x):
     return x
 
 
-def get_indiv_phasecenter(ms, field):
+def get_indiv_phasecenter(ms, field, snapshot=None):
     """
     Get the phase center of an individual field in radians
     """
     logprint("Determining phasecenter of individual {0}".format(ms))
 
-    msmd.open(ms)
-    field_matches = np.array([fld == field for fld in msmd.fieldnames()],
-                             dtype=bool)
-    field_ids, = np.where(field_matches)
+    snapshot = get_metadata_snapshot(ms, snapshot)
+    field_ids = snapshot.field_ids(field)
 
     # only use the field IDs that have associated scans
-    field_id_has_scans = np.array([len(msmd.scansforfield(fid)) > 0
-                                   for fid in field_ids], dtype='bool')
-
-    ptgctrs = [msmd.phasecenter(ii) for ii in field_ids[field_id_has_scans]]
+    field_ids = field_ids[snapshot.field_has_scans[field_ids]]
 
-    mean_ra = np.mean([zero_to_2pi(pc['m0']['value']) for pc in ptgctrs])
-    mean_dec = np.mean([pc['m1']['value'] for pc in ptgctrs])
-    csys = ptgctrs[0]['refer']
-    msmd.close()
+    mean_ra = np.mean(snapshot.phasecenter_ra[field_ids])
+    mean_dec = np.mean(snapshot.phasecenter_dec[field_ids])
+    csys = snapshot.phasecenter_refer[field_ids[0]]
 
     logprint("Phasecenter of {0} is {1} {2} {3}".format(ms, mean_ra, mean_dec, csys))
 
     return mean_ra, mean_dec, csys
 
 
-def determine_phasecenter(ms, field, formatted=False):
+def _snapshot_list(ms, snapshot):
+    if snapshot is None:
+        return [None] * len(ms)
+    if len(snapshot) != len(ms):
+        raise ValueError("One metadata snapshot is required for each MS")
+    return snapshot
+
+
+def determine_phasecenter(ms, field, formatted=False, snapshot=None):
     """
     Identify the correct phasecenter for the MS (apparently, if you don't do
     this, the phase center is set to some random pointing in the mosaic)
+
+    ``snapshot`` is an optional `MSMetadataSnapshot` (or list of snapshots if
+    ``ms`` is a list).
     """
     logprint("Determining phasecenter of {0}".format(ms))
 
     if isinstance(ms, list):
-        results = [get_indiv_phasecenter(vis, field) for vis in ms]
+        results = [get_indiv_phasecenter(vis, field, snapshot=snap)
+                   for vis, snap in zip(ms, _snapshot_list(ms, snapshot))]
         csys = results[0][2]
 
         mean_ra = np.mean([ra for ra, dec, csys in results])
         mean_dec = np.mean([dec for ra, dec, csys in results])
     else:
-        mean_ra, mean_dec, csys = get_indiv_phasecenter(ms, field)
+        mean_ra, mean_dec, csys = get_indiv_phasecenter(ms, field, snapshot=snapshot)
 
     logprint("Determined phasecenter is {0} {1}deg {2}deg".format(csys,
                                                                   mean_ra*180/np.pi,
@@ -102,34 +195,44 @@ def determine_phasecenter(ms, field, formatted=False):
     else:
         return (csys, mean_ra*180/np.pi, mean_dec*180/np.pi)
 
-def get_indiv_imsize(ms, field, phasecenter, spw=0, pixfraction_of_fwhm=1/4.,
-                     min_pixscale=0.02, only_7m=False, exclude_7m=False,
-                     makeplot=False, veryverbose=False):
+
+def get_indiv_imsizes(ms, field, phasecenter, spws, pixfraction_of_fwhm=1/4.,
+                      min_pixscale=0.02, only_7m=False, exclude_7m=False,
+                      makeplot=False, veryverbose=False, snapshot=None):
     """
+    Determine the image size and pixel scale of a single MS for each of a list
+    of spectral windows.  All spectral windows are computed at once from one
+    `MSMetadataSnapshot`.
+
     Parameters
     ----------
+    spws : list
+        The spectral windows to determine the size for
     min_pixscale : float
         Minimum allowed pixel scale in arcsec
+
+    Returns
+    -------
+    A list of (imsize_x, imsize_y, pixscale_as) tuples, one per spw
     """
 
-    logprint("Determining imsize of individual ms {0} spw {1}".format(ms, spw))
+    logprint("Determining imsize of individual ms {0} spws {1}".format(ms, spws))
 
     cen_ra, cen_dec = phasecenter
+    spws = np.array(spws, dtype='int').ravel()
 
-    msmd.open(ms)
+    snapshot = get_metadata_snapshot(ms, snapshot)
 
-    field_matches = np.array([fld == field for fld in msmd.fieldnames()], dtype=bool)
-    if not any(field_matches):
+    field_ids = snapshot.field_ids(field)
+    if len(field_ids) == 0:
         raise ValueError("Did not find any matched for field {0}.  "
                          "The valid field names are {1}."
-                         .format(field, msmd.fieldnames()))
-    field_ids, = np.where(field_matches)
+                         .format(field, list(snapshot.fieldnames)))
     logprint("Found field IDs {0} matching field name {1}."
              .format(field_ids, field))
 
     # only use the field IDs that have associated scans
-    field_id_has_scans = np.array([len(msmd.scansforfield(fid)) > 0
-                                   for fid in field_ids], dtype='bool')
+    field_id_has_scans = snapshot.field_has_scans[field_ids]
 
     logprint("Field IDs {0} matching field name {1} have scans."
              .format(field_ids[field_id_has_scans], field))
@@ -139,71 +242,63 @@ def get_indiv_imsize(ms, field, phasecenter, spw=0, pixfraction_of_fwhm=1/4.,
         logprint("Found *scanless* field IDs {0} matching field name {1}."
                  .format(noscans, field))
 
-    first_scan_for_field = [msmd.scansforfield(fid)[0]
-                            for fid,fid_ok in zip(field_ids, field_id_has_scans)
-                            if fid_ok
-                           ]
-    first_antid = [msmd.antennasforscan(scid)[0]
-                   for scid in first_scan_for_field
-                   if len(msmd.antennasforscan(scid)) > 0
-                  ]
+    field_ids = field_ids[field_id_has_scans]
+    first_antid = snapshot.first_antenna_for_field(field_ids)
+    # drop fields whose first scan has no antennas
+    field_ids = field_ids[first_antid >= 0]
+    first_antid = first_antid[first_antid >= 0]
 
     # compute baselines to determine synth beamsize
-    tb.open(ms+"/ANTENNA")
-    positions = tb.getcol('POSITION')
-    diameters = tb.getcol('DISH_DIAMETER')
-    tb.close()
+    positions = snapshot.antenna_positions
+    diameters = snapshot.antenna_diameters
 
-    antsize = np.array([msmd.antennadiameter(antid)['value']
-                        for antid in first_antid]) # m
+    antsize = diameters[first_antid] # m
 
     if exclude_7m:
         assert 12 in antsize, "No 12m antennae found in ms {0}".format(ms)
-        assert len(first_antid) == len(antsize) == len(first_scan_for_field) == len(field_ids[field_id_has_scans]) == (field_id_has_scans).sum()
-        first_antid = [x for x,y in zip(first_antid, antsize) if y > 7]
-        first_scan_for_field = [x for x,y in zip(first_scan_for_field, antsize) if y > 7]
-        field_ids = np.array([x for x,y in zip(field_ids[field_id_has_scans], antsize) if y > 7])
-        # this one is trivial: should be all True
-        field_id_has_scans = np.array([x for x,y in zip(field_id_has_scans[field_id_has_scans], antsize) if y > 7])
-
+        fieldsel = antsize > 7
         bl_sel = diameters != 7
-
-        antsize = np.array([x for x in antsize if x > 7])
         logprint("Determining pixel scale and image size for only 12m data")
     elif only_7m:
         assert 7 in antsize, "No 7m antennae found in ms {0}".format(ms)
-        assert len(first_antid) == len(antsize) == len(first_scan_for_field) == len(field_ids[field_id_has_scans]) == (field_id_has_scans).sum()
-        first_antid = [x for x,y in zip(first_antid, antsize) if y == 7]
-        first_scan_for_field = [x for x,y in zip(first_scan_for_field, antsize) if y == 7]
-        field_ids = np.array([x for x,y in zip(field_ids[field_id_has_scans], antsize) if y == 7])
-        # this one is trivial: should be all True
-        field_id_has_scans = np.array([x for x,y in zip(field_id_has_scans[field_id_has_scans], antsize) if y == 7])
-
+        fieldsel = antsize == 7
         bl_sel = diameters == 7
-
-        antsize = np.array([x for x in antsize if x == 7])
         logprint("Determining pixel scale and image size for only 7m data")
     else:
-        # the shape matters if any are false...
-        field_id_has_scans = field_id_has_scans[field_id_has_scans]
-        bl_sel = slice(None)
+        fieldsel = np.ones(antsize.size, dtype='bool')
+        bl_sel = None
         logprint("Determining pixel scale and image size for all data, both 7m and 12m")
-
-    # note that for concatenated MSes, this includes baselines that don't exist
-    # (i.e., it includes baselines between TM1 and TM2 positions)
-    baseline_lengths = (((positions[None,:,:]-positions.T[:,:,None])**2).sum(axis=1)**0.5)
-    max_baseline = baseline_lengths[bl_sel,:][:,bl_sel].max()
+    field_ids = field_ids[fieldsel]
+    antsize = antsize[fieldsel]
+
+    # only form baselines between antennas that observed together in the
+    # selected fields' scans; for concatenated MSes this excludes baselines
+    # that don't exist (e.g., between TM1 and TM2 positions)
+    scan_antennas = [snapshot.antennas_for_scan[scan]
+                     for fid in field_ids
+                     for scan in snapshot.scans_for_field[fid]]
+    max_baseline = max_baseline_length(positions, antenna_ids=bl_sel,
+                                       antenna_groups=scan_antennas)
     logprint("Maximum baseline length = {0}".format(max_baseline))
+    if max_baseline <= 0:
+        # (the pixel scale would be infinite)
+        raise ValueError("No scan of field {0} (field IDs {1}) in {2} has two or more "
+                         "of the selected antennas ({3}), so there are no baselines "
+                         "to determine the pixel scale from"
+                         .format(field, list(field_ids), ms,
+                                 "12m only" if exclude_7m else
+                                 "7m only" if only_7m else "all"))
 
     # because we're working with line-split data, we assume the reffreq comes
     # from spw 0
-    freq = msmd.reffreq(spw)['m0']['value'] # Hz
+    freq = snapshot.spw_reffreqs[spws] # Hz
     wavelength = 299792458.0/freq # m
     # go a little past the first null in each direction
     # (radians)
     # Note we originally had 1.22 (from the Rayleigh criterion, not well-justified)
     # but empirically found that we need at least 1.26 to avoid wrapping images.
-    primary_beam_fwhm = 1.26 * wavelength / antsize
+    # (nspw, nfield)
+    primary_beam_fwhm = 1.26 * wavelength[:,None] / antsize[None,:]
 
     # synthesized beam minimum size (max_baseline in m)
     synthbeam_minsize_fwhm = 1.26 * wavelength / max_baseline
@@ -211,102 +306,124 @@ def get_indiv_imsize(ms, field, phasecenter, spw=0, pixfraction_of_fwhm=1/4.,
     pixscale = pixfraction_of_fwhm * synthbeam_minsize_fwhm
 
     # round to nearest 0.01"
-    if pixscale > 0.01/206265.:
-        pixscale_as = 180/np.pi * 3600 * pixscale
-        pixscale_as = np.round(pixscale_as, 2)
-        if pixscale_as < min_pixscale:
-            logprint("Pixel scale was = {0} rad = {1} \", but is begin forced to min_pixscale={2} ".format(pixscale, pixscale_as/3600/180*np.pi, min_pixscale))
-            pixscale_as = min_pixscale
-        # re-set pixscale to be radians
-        pixscale = pixscale_as * np.pi / 3600 / 180
-        logprint("Pixel scale = {0} rad = {1} \" ".format(pixscale, pixscale_as))
-    else:
-        raise ValueError("Pixel scale was {0}\", too small".format(pixscale*206265))
-
-    pb_pix = (primary_beam_fwhm / pixscale)[field_id_has_scans]
-
+    if np.any(pixscale <= 0.01/206265.):
+        raise ValueError("Pixel scale was {0}\", too small".format(pixscale.min()*206265))
+    pixscale_as = np.round(180/np.pi * 3600 * pixscale, 2)
+    for spw, pxs, pxs_as in zip(spws, pixscale, pixscale_as):
+        if pxs_as < min_pixscale:
+            logprint("spw {3}: Pixel scale was = {0} rad = {1} \", but is begin forced to min_pixscale={2} ".format(pxs, pxs_as/3600/180*np.pi, min_pixscale, spw))
+    pixscale_as = np.where(pixscale_as < min_pixscale, min_pixscale, pixscale_as)
+    # re-set pixscale to be radians
+    pixscale = pixscale_as * np.pi / 3600 / 180
+    for spw, pxs, pxs_as in zip(spws, pixscale, pixscale_as):
+        logprint("spw {2}: Pixel scale = {0} rad = {1} \" ".format(pxs, pxs_as, spw))
+
+    pb_pix = primary_beam_fwhm / pixscale[:,None]
 
     def r2d(x):
         return x * 180 / np.pi
 
-    ptgctrs = [msmd.phasecenter(ii) for ii in field_ids[field_id_has_scans]]
-
-    ptgctrs_ra_deg, ptgctrs_dec_deg = (np.array([r2d(zero_to_2pi(pc['m0']['value'])) for pc in ptgctrs]),
-                                       np.array([r2d(pc['m1']['value']) for pc in ptgctrs]))
-    pix_centers_ra = (ptgctrs_ra_deg - cen_ra) / r2d(pixscale)
-    pix_centers_dec = (ptgctrs_dec_deg - cen_dec) / r2d(pixscale)
+    ptgctrs_ra_deg = r2d(snapshot.phasecenter_ra[field_ids])
+    ptgctrs_dec_deg = r2d(snapshot.phasecenter_dec[field_ids])
+    pix_centers_ra = (ptgctrs_ra_deg[None,:] - cen_ra) / r2d(pixscale[:,None])
+    pix_centers_dec = (ptgctrs_dec_deg[None,:] - cen_dec) / r2d(pixscale[:,None])
 
-    furthest_ra_pix_plus = (pix_centers_ra+pb_pix).max()
-    furthest_ra_pix_minus = (pix_centers_ra-pb_pix).min()
-    furthest_dec_pix_plus = (pix_centers_dec+pb_pix).max()
-    furthest_dec_pix_minus = (pix_centers_dec-pb_pix).min()
+    furthest_ra_pix_plus = (pix_centers_ra+pb_pix).max(axis=1)
+    furthest_ra_pix_minus = (pix_centers_ra-pb_pix).min(axis=1)
+    furthest_dec_pix_plus = (pix_centers_dec+pb_pix).max(axis=1)
+    furthest_dec_pix_minus = (pix_centers_dec-pb_pix).min(axis=1)
 
     if makeplot:
         import pylab as pl
-        pl.figure(figsize=(10,10)).clf()
-        pl.plot(pix_centers_ra, pix_centers_dec, 'o')
-        circles = [pl.matplotlib.patches.Circle((x,y), radius=rad, facecolor='none', edgecolor='b')
-                   for x,y,rad in zip(pix_centers_ra, pix_centers_dec, pb_pix)]
-        collection = pl.matplotlib.collections.PatchCollection(circles)
-        collection.set_facecolor('none')
-        collection.set_edgecolor('r')
-        pl.gca().add_collection(collection)
-        pl.gca().axis([furthest_ra_pix_minus, furthest_ra_pix_plus,
-                       furthest_dec_pix_minus, furthest_dec_pix_plus])
-
+        for ii in range(len(spws)):
+            pl.figure(figsize=(10,10)).clf()
+            pl.plot(pix_centers_ra[ii], pix_centers_dec[ii], 'o')
+            circles = [pl.matplotlib.patches.Circle((x,y), radius=rad, facecolor='none', edgecolor='b')
+                       for x,y,rad in zip(pix_centers_ra[ii], pix_centers_dec[ii], pb_pix[ii])]
+            collection = pl.matplotlib.collections.PatchCollection(circles)
+            collection.set_facecolor('none')
+            collection.set_edgecolor('r')
+            pl.gca().add_collection(collection)
+            pl.gca().axis([furthest_ra_pix_minus[ii], furthest_ra_pix_plus[ii],
+                           furthest_dec_pix_minus[ii], furthest_dec_pix_plus[ii]])
 
     if veryverbose:
         logprint("RA/Dec degree centers and pixel centers of pointings are \n{0}\nand\n{1}"
                  .format(list(zip(ptgctrs_ra_deg, ptgctrs_dec_deg)),
-                         list(zip(pix_centers_ra, pix_centers_dec))))
+                         [list(zip(ra, dec)) for ra, dec in zip(pix_centers_ra, pix_centers_dec)]))
     logprint("Furthest RA pixels from center are {0},{1}"
              .format(furthest_ra_pix_minus, furthest_ra_pix_plus))
     logprint("Furthest Dec pixels from center are {0},{1}"
              .format(furthest_dec_pix_minus, furthest_dec_pix_plus))
 
-    msmd.close()
-
     dra,ddec = (furthest_ra_pix_plus-furthest_ra_pix_minus,
                 furthest_dec_pix_plus-furthest_dec_pix_minus)
 
-    # go to the next multiple of 20, since it will come up with _something_ when you do 6/5 or 5/4 * n
-    # EDIT: instead, we'll use the st.getOptimumSize tool below
-    #imsize = dra-(dra % 20)+20, ddec-(ddec % 20)+20
-    imsize = int(dra), int(ddec)
+    results = []
+    for spw, dra_, ddec_, pxs_as in zip(spws, dra, ddec, pixscale_as):
+        # go to the next multiple of 20, since it will come up with _something_ when you do 6/5 or 5/4 * n
+        # EDIT: instead, we'll use the st.getOptimumSize tool below
+        #imsize = dra-(dra % 20)+20, ddec-(ddec % 20)+20
+        imsize = int(dra_), int(ddec_)
+
+        logprint("Determined imsize of individual ms {0} spw {3} = {1} at center {2}"
+                 .format(ms, imsize, phasecenter, spw))
 
-    logprint("Determined imsize of individual ms {0} = {1} at center {2}"
-             .format(ms, imsize, phasecenter))
+        imsize_corrected = [st.getOptimumSize(x) for x in imsize]
+        logprint("Optimized imsize is {0}".format(imsize_corrected))
 
-    imsize_corrected = [st.getOptimumSize(x) for x in imsize]
-    logprint("Optimized imsize is {0}".format(imsize_corrected))
+        results.append((imsize_corrected[0], imsize_corrected[1], float(pxs_as)))
 
-    return imsize_corrected[0], imsize_corrected[1], pixscale_as
+    return results
+
+
+def get_indiv_imsize(ms, field, phasecenter, spw=0, pixfraction_of_fwhm=1/4.,
+                     min_pixscale=0.02, only_7m=False, exclude_7m=False,
+                     makeplot=False, veryverbose=False, snapshot=None):
+    """
+    Parameters
+    ----------
+    min_pixscale : float
+        Minimum allowed pixel scale in arcsec
+    snapshot : `MSMetadataSnapshot`
+        Pre-read metadata of ``ms``; one will be created if not given
+    """
+    return get_indiv_imsizes(ms, field, phasecenter, [spw],
+                             pixfraction_of_fwhm=pixfraction_of_fwhm,
+                             min_pixscale=min_pixscale, only_7m=only_7m,
+                             exclude_7m=exclude_7m, makeplot=makeplot,
+                             veryverbose=veryverbose, snapshot=snapshot)[0]
 
 
-def determine_imsize(ms, field, phasecenter, spw=0, pixfraction_of_fwhm=1/4., **kwargs):
+def determine_imsize(ms, field, phasecenter, spw=0, pixfraction_of_fwhm=1/4.,
+                     snapshot=None, **kwargs):
+    """
+    ``snapshot`` is an optional `MSMetadataSnapshot` (or list of snapshots if
+    ``ms`` is a list).
+    """
 
     logprint("Determining imsize of {0}".format(ms))
 
     if isinstance(ms, list):
         # specify spw=0 always for lists, since they should be splitted MSes
         results = [get_indiv_imsize(vis, field, phasecenter, spw=0,
-                                    pixfraction_of_fwhm=pixfraction_of_fwhm, **kwargs)
-                   for vis in ms]
+                                    pixfraction_of_fwhm=pixfraction_of_fwhm,
+                                    snapshot=snap, **kwargs)
+                   for vis, snap in zip(ms, _snapshot_list(ms, snapshot))]
 
         dra = np.max([ra for ra, dec, pixscale in results])
         ddec = np.max([dec for ra, dec, pixscale in results])
         pixscale = np.min([pixscale for ra, dec, pixscale in results])
     else:
+        snapshot = get_metadata_snapshot(ms, snapshot)
 
         if spw=='all':
-            msmd.open(ms)
-            spws = msmd.spwsforfield(field)
-            msmd.close()
+            spws = snapshot.spws_for_field[field]
 
             logprint("Determining imsize of all spectral windows: {0}".format(spws))
-            results = [get_indiv_imsize(ms, field, phasecenter, spw,
-                                        pixfraction_of_fwhm, **kwargs)
-                       for spw in spws]
+            results = get_indiv_imsizes(ms, field, phasecenter, spws,
+                                        pixfraction_of_fwhm, snapshot=snapshot,
+                                        **kwargs)
 
             dra = np.max([ra for ra, dec, pixscale in results])
             ddec = np.max([dec for ra, dec, pixscale in results])
@@ -314,7 +431,8 @@ def determine_imsize(ms, field, phasecenter, spw=0, pixfraction_of_fwhm=1/4., **
 
         else:
             dra,ddec,pixscale = get_indiv_imsize(ms, field, phasecenter, spw,
-                                                 pixfraction_of_fwhm, **kwargs)
+                                                 pixfraction_of_fwhm,
+                                                 snapshot=snapshot, **kwargs)
 
     # if the image is nearly square (to within 10%), make sure it is square.
     if float(np.abs(dra - ddec)) / dra < 0.1:
@@ -337,14 +455,67 @@ def determine_imsizes(mses, field, phasecenter, **kwargs):
 
     return int(dra), int(ddec), pixscale
 
+def model_column_is_populated(msfile, max_visibilities=2**24, rowincr=1):
+    """
+    Check whether the MODEL_DATA column of ``msfile`` holds a model, i.e.
+    has any non-zero phase (a cleared model column is 1+0j everywhere).
+
+    The column is read in row chunks of the first correlation (one data
+    description at a time, since they can have different numbers of
+    channels), and the search stops at the first chunk with a non-zero phase,
+    so the memory used is bounded by ``max_visibilities`` regardless of the
+    size of the MS.
+
+    Parameters
+    ----------
+    msfile : str
+        Measurement set name
+    max_visibilities : int
+        The number of visibilities (rows x channels) read at once
+    rowincr : int
+        Read only every ``rowincr``-th row, for a faster, sampled check
+
+    Returns
+    -------
+    populated : bool
+    """
+    tb.open(msfile)
+    try:
+        if 'MODEL_DATA' not in tb.colnames():
+            logprint("{0} has no MODEL_DATA column".format(msfile))
+            return False
+        ddids = np.unique(tb.getcol('DATA_DESC_ID'))
+    finally:
+        tb.close()
+
+    for ddid in ddids:
+        tb.open(msfile)
+        subtb = tb.query('DATA_DESC_ID=={0}'.format(ddid), columns='MODEL_DATA')
+        tb.close()
+        try:
+            nrows = subtb.nrows()
+            if nrows == 0:
+                continue
+            nchan = subtb.getcell('MODEL_DATA', 0).shape[1]
+            # rows read per chunk; they span chunkrows * rowincr table rows
+            chunkrows = max(1, max_visibilities // nchan)
+            for startrow in range(0, nrows, chunkrows * rowincr):
+                nrow = min(chunkrows, (nrows - startrow - 1) // rowincr + 1)
+                model = subtb.getcolslice('MODEL_DATA', blc=[0, 0],
+                                          trc=[0, nchan-1], incr=[1, 1],
+                                          startrow=startrow, nrow=nrow,
+                                          rowincr=rowincr)
+                if np.any(model.imag != 0):
+                    return True
+        finally:
+            subtb.close()
+
+    return False
+
+
 def check_model_is_populated(msfile):
-    ms.open(msfile)
-    modelphase = ms.getdata(items=['model_phase'])
-    if 'model_phase' not in modelphase:
-        raise ValueError("model_phase not acquired")
-    if modelphase['model_phase'].shape == (0,):
+    if not model_column_is_populated(msfile):
         raise ValueError("Model phase column was not populated")
-    ms.close()
 
 
 
@@ -570,13 +741,126 @@ def sethistory(prefix, selfcalpars=None, impars=None, selfcaliter=None):
             ia.done()
 
 
-def check_channel_flags(vis, tolerance=0, nchan_tolerance=10, **kwargs):
+def ms_modification_key(vis):
+    """
+    Cheap fingerprint of the state of a measurement set's main table.
+
+    ``flagdata`` and ``flagmanager`` rewrite the FLAG column in place, which
+    touches the storage manager files (``table.f*``) at the top level of the
+    MS but not the MS directory itself, so we combine the newest mtime and the
+    total size of the top-level files.  ``table.lock`` is excluded because it
+    is touched by every reader.
+    """
+    mtime = 0
+    size = 0
+    for name in os.listdir(vis):
+        path = os.path.join(vis, name)
+        if os.path.isfile(path) and name != 'table.lock':
+            stat = os.stat(path)
+            mtime = max(mtime, stat.st_mtime)
+            size += stat.st_size
+    return "{0:.6f}_{1}".format(mtime, size)
+
+
+def flag_summary_cache_name(vis, **kwargs):
+    """
+    Name of the flag summary sidecar file for ``vis`` and a given set of
+    ``flagdata`` selection keywords.  The sidecar lives next to the MS, not
+    inside it, so that it does not get copied around with the MS.
+    """
+    selection = json.dumps(sorted((str(key), str(val)) for key, val in kwargs.items()))
+    selhash = hashlib.md5(selection.encode()).hexdigest()[:12]
+    return "{0}.flagsummary_{1}.npz".format(os.path.normpath(vis), selhash)
+
+
+def invalidate_flag_summary_cache(vis):
+    """
+    Remove all flag summary sidecars for ``vis``.  The cache is invalidated
+    automatically when the MS is modified, but this can be used to force a
+    rescan.
+    """
+    # (not glob: MS names may contain glob characters, and glob.escape does
+    # not exist in python 2)
+    dirname, basename = os.path.split(os.path.normpath(vis))
+    for fn in os.listdir(dirname or '.'):
+        if fn.startswith(basename + ".flagsummary_") and fn.endswith(".npz"):
+            os.remove(os.path.join(dirname, fn))
+
+
+def get_channel_flag_summary(vis, use_cache=True, **kwargs):
+    """
+    Return the per-spw, per-channel flag summary of ``vis``, i.e. the
+    ``'spw:channel'`` entry of ``flagdata(mode='summary', spwchan=True)``.
+
+    The result is cached as a compact numpy sidecar next to the MS keyed on
+    the MS path, its modification state (see `ms_modification_key`), and the
+    selection ``kwargs``.  Any modification of the flags (e.g., with
+    ``flagdata`` or ``flagmanager``) changes the key and forces a rescan.
+
+    Parameters
+    ----------
+    vis : str
+        Measurement set name
+    use_cache : bool
+        Read from and write to the sidecar cache?
+    kwargs :
+        Selection parameters passed to ``flagdata``
+
+    Returns
+    -------
+    A dictionary of ``{'spw:chan': {'flagged': N, 'total': M}}``
+    """
+    cachefn = flag_summary_cache_name(vis, **kwargs)
+    key = ms_modification_key(vis)
+
+    if use_cache and os.path.exists(cachefn):
+        try:
+            with np.load(cachefn) as cache:
+                if str(cache['key']) == key:
+                    logprint("Using cached flag summary {0} for {1}".format(cachefn, vis))
+                    return {"{0}:{1}".format(spw, chan): {'flagged': flagged, 'total': total}
+                            for spw, chan, flagged, total in
+                            zip(cache['spw'].tolist(), cache['channel'].tolist(),
+                                cache['flagged'].tolist(), cache['total'].tolist())}
+                logprint("Flag summary cache {0} is stale; rescanning {1}".format(cachefn, vis))
+        except (IOError, OSError, KeyError, ValueError) as ex:
+            logprint("Could not read flag summary cache {0}: {1}".format(cachefn, ex))
+
+    flagsum = flagdata(vis=vis, mode='summary', spwchan=True, **kwargs)['spw:channel']
+
+    if use_cache:
+        spwchan = [list(map(int, spwchan_key.split(":"))) for spwchan_key in flagsum]
+        # flagdata may not change the MS, but check the key again in case
+        # someone else modified it while we were scanning
+        if ms_modification_key(vis) == key:
+            tmpfn = cachefn + ".{0}.tmp".format(os.getpid())
+            try:
+                with open(tmpfn, 'wb') as fh:
+                    np.savez(fh,
+                             key=key,
+                             spw=np.array([x[0] for x in spwchan], dtype='int32'),
+                             channel=np.array([x[1] for x in spwchan], dtype='int32'),
+                             flagged=np.array([flagsum[k]['flagged'] for k in flagsum], dtype='float64'),
+                             total=np.array([flagsum[k]['total'] for k in flagsum], dtype='float64'))
+                # (os.rename is atomic on POSIX; os.replace does not exist in
+                # python 2)
+                os.rename(tmpfn, cachefn)
+            except (IOError, OSError) as ex:
+                logprint("Could not write flag summary cache {0}: {1}".format(cachefn, ex))
+                if os.path.exists(tmpfn):
+                    os.remove(tmpfn)
+
+    return flagsum
+
+
+def check_channel_flags(vis, tolerance=0, nchan_tolerance=10, use_cache=True, **kwargs):
 
     if isinstance(vis, list):
-        return [check_channel_flags(vv, tolerance=tolerance, nchan_tolerance=nchan_tolerance, **kwargs)
+        return [check_channel_flags(vv, tolerance=tolerance, nchan_tolerance=nchan_tolerance,
+                                    use_cache=use_cache, **kwargs)
                 for vv in vis]
 
-    flagsum = flagdata(vis=vis, mode='summary', spwchan=True, **kwargs)
+    flagsum = {'spw:channel': get_channel_flag_summary(vis, use_cache=use_cache, **kwargs)}
     spws = set([int(key.split(":")[0]) for key in flagsum['spw:channel']])
     fractions_of_channels_flagged = {spwn: {int(key.split(":")[1]):
                                             flagsum['spw:channel'][key]['flagged']
@@ -0,0 +1,400 @@
+"""
+Staging of measurement sets to a working directory (see WORK_DIRECTORY in
+line_imaging.py).
+
+A measurement set is a directory of table files.  It is copied file by file
+with a pool of threads into ``<dest>.partial``; a manifest (``<dest>.staging.json``)
+records the size, modification time, and MD5 checksum of each file as it
+completes, and the directory is renamed to ``<dest>`` only once every file has
+been copied.  A killed copy therefore never looks complete, and the next
+attempt resumes from the manifest, re-copying only the files that are missing
+or whose source changed.
+
+An existing ``<dest>`` is reused only if its manifest is complete and still
+matches the source.  Concurrent jobs staging the same MS serialize on a lock
+file, so one copies while the others wait and then reuse the copy.
+
+Optionally, the copy is made into a node-local cache directory instead, so
+that several jobs on the same node share one staged copy of the same MS.  Jobs
+hold a shared lock on the cache entries they use, so they can share a copy;
+an entry is only copied, re-staged, or evicted while no job is using it.  The
+least recently used entries are evicted when the cache exceeds its size
+limit.
+"""
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from metadata_tools import logprint
+
+
+# copy (and checksum) buffer size
+BLOCKSIZE = 16 * 1024**2
+
+# cache entries in use by this process: path -> open lock file
+_cache_locks = {}
+
+
+def manifest_name(dest):
+    return dest + ".staging.json"
+
+
+def source_listing(src):
+    """
+    The files of ``src`` as ``{relative path: (size, mtime_ns)}``.  Lock
+    files, which CASA rewrites whenever a table is opened (even read-only),
+    are not listed (and so not copied).
+    """
+    listing = {}
+    for dirpath, dirnames, filenames in os.walk(src):
+        for fn in filenames:
+            if fn.endswith('.lock'):
+                continue
+            full = os.path.join(dirpath, fn)
+            st = os.stat(full)
+            listing[os.path.relpath(full, src)] = (st.st_size, st.st_mtime_ns)
+    return listing
+
+
+def _load_manifest(dest):
+    if not os.path.exists(manifest_name(dest)):
+        return None
+    with open(manifest_name(dest), 'r') as fh:
+        return json.load(fh)
+
+
+def _save_manifest(dest, manifest):
+    tmpfile = manifest_name(dest) + ".tmp"
+    with open(tmpfile, 'w') as fh:
+        json.dump(manifest, fh, indent=1)
+    os.replace(tmpfile, manifest_name(dest))
+
+
+def _copy_file(src, dest):
+    """
+    Copy one file, returning its MD5 checksum (computed on the fly, so the
+    source is read once)
+    """
+    md5 = hashlib.md5()
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        while True:
+            buf = fsrc.read(BLOCKSIZE)
+            if not buf:
+                break
+            md5.update(buf)
+            fdest.write(buf)
+    shutil.copystat(src, dest)
+    return md5.hexdigest()
+
+
+def file_checksum(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fh:
+        while True:
+            buf = fh.read(BLOCKSIZE)
+            if not buf:
+                break
+            md5.update(buf)
+    return md5.hexdigest()
+
+
+def is_staged(src, dest, verify=False):
+    """
+    Whether ``dest`` is a complete copy of ``src``, according to its manifest
+    (and, if ``verify``, to the checksums of the copied files)
+    """
+    manifest = _load_manifest(dest)
+    if manifest is None or not manifest.get('complete') or not os.path.isdir(dest):
+        return False
+
+    listing = source_listing(src)
+    if set(listing) != set(manifest['files']):
+        return False
+    for relpath, (size, mtime_ns) in listing.items():
+        entry = manifest['files'][relpath]
+        if entry['size'] != size or entry['mtime_ns'] != mtime_ns:
+            return False
+        if verify and file_checksum(os.path.join(dest, relpath)) != entry['md5']:
+            logprint("Checksum mismatch for staged file {0}"
+                     .format(os.path.join(dest, relpath)))
+            return False
+    return True
+
+
+def _lock(path, shared=False, blocking=True):
+    """ Open and flock ``path``; returns the open file, or None if busy """
+    fh = open(path, 'a')
+    flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    if not blocking:
+        flags |= fcntl.LOCK_NB
+    try:
+        fcntl.flock(fh, flags)
+    except (IOError, OSError):
+        fh.close()
+        return None
+    return fh
+
+
+def _stage(src, dest, nthreads=8, verify=False):
+    """
+    Copy ``src`` to ``dest`` through ``dest.partial``; the caller must hold
+    the staging lock
+    """
+    if is_staged(src, dest, verify=verify):
+        logprint("{0} is already a complete copy of {1}".format(dest, src))
+        return dest
+
+    partial = dest + ".partial"
+    listing = source_listing(src)
+
+    manifest = _load_manifest(dest)
+    if manifest is None or manifest.get('source') != os.path.abspath(src):
+        manifest = {'source': os.path.abspath(src), 'complete': False, 'files': {}}
+    elif manifest.get('complete') and os.path.isdir(dest):
+        # a finished copy of an older version of the source: resume from it
+        # (only the changed files will be copied)
+        if os.path.exists(partial):
+            shutil.rmtree(partial)
+        os.rename(dest, partial)
+    manifest['complete'] = False
+
+    if not os.path.isdir(partial):
+        manifest['files'] = {}
+        os.makedirs(partial)
+
+    # drop records of files that changed or no longer exist at the source,
+    # or whose copies are incomplete
+    for relpath in list(manifest['files']):
+        entry = manifest['files'][relpath]
+        copied = os.path.join(partial, relpath)
+        if (relpath not in listing or
+                (entry['size'], entry['mtime_ns']) != tuple(listing[relpath]) or
+                not os.path.exists(copied) or os.path.getsize(copied) != entry['size']):
+            del manifest['files'][relpath]
+            if relpath not in listing and os.path.exists(copied):
+                os.remove(copied)
+
+    todo = sorted((relpath for relpath in listing if relpath not in manifest['files']),
+                  key=lambda relpath: -listing[relpath][0])
+    nbytes = sum(listing[relpath][0] for relpath in todo)
+    logprint("Staging {0} -> {1}: copying {2} of {3} files ({4:0.1f} GB) with {5} threads"
+             .format(src, dest, len(todo), len(listing), nbytes / 1024.**3, nthreads))
+
+    lock = threading.Lock()
+    last_save = [time.time()]
+
+    def copy_one(relpath):
+        target = os.path.join(partial, relpath)
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+        checksum = _copy_file(os.path.join(src, relpath), target)
+        size, mtime_ns = listing[relpath]
+        with lock:
+            manifest['files'][relpath] = {'size': size, 'mtime_ns': mtime_ns,
+                                          'md5': checksum}
+            # the manifest is the resume point; don't rewrite it for every
+            # one of the many small table files
+            if time.time() - last_save[0] > 10:
+                _save_manifest(dest, manifest)
+                last_save[0] = time.time()
+
+    t0 = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            # list() re-raises any exception from the workers
+            list(executor.map(copy_one, todo))
+    finally:
+        # record the progress even if the copy failed, so it can resume
+        _save_manifest(dest, manifest)
+
+    # empty directories are part of the table structure too
+    for dirpath, dirnames, filenames in os.walk(src):
+        for dn in dirnames:
+            target = os.path.join(partial, os.path.relpath(os.path.join(dirpath, dn), src))
+            if not os.path.isdir(target):
+                os.makedirs(target)
+
+    if verify:
+        for relpath, entry in manifest['files'].items():
+            if file_checksum(os.path.join(partial, relpath)) != entry['md5']:
+                raise IOError("Checksum mismatch for staged file {0}"
+                              .format(os.path.join(partial, relpath)))
+
+    os.rename(partial, dest)
+    manifest['complete'] = True
+    manifest['staged'] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    _save_manifest(dest, manifest)
+
+    dt = time.time() - t0
+    logprint("Staged {0} -> {1} in {2:0.1f}s ({3:0.1f} MB/s)"
+             .format(src, dest, dt, nbytes / 1024.**2 / max(dt, 1e-3)))
+    return dest
+
+
+def stage_ms(src, dest, nthreads=8, verify=False):
+    """
+    Make (or resume, or reuse) a checksummed copy of the measurement set
+    ``src`` at ``dest``.
+
+    Parameters
+    ----------
+    src : str
+        The measurement set to copy
+    dest : str
+        Where to copy it to
+    nthreads : int
+        Number of files to copy concurrently
+    verify : bool
+        Re-read the copied files and compare their checksums with those of
+        the source (as read during the copy) before accepting the copy
+
+    Returns
+    -------
+    dest : str
+    """
+    lockfile = _lock(dest + ".staging.lock")
+    try:
+        return _stage(src, dest, nthreads=nthreads, verify=verify)
+    finally:
+        lockfile.close()
+
+
+def _cache_entry(cache_directory, src):
+    key = hashlib.md5(os.path.abspath(src).encode()).hexdigest()[:16]
+    return os.path.join(cache_directory, key), os.path.join(cache_directory, key + ".lock")
+
+
+def _entry_size(entrydir):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(entrydir):
+        size += sum(os.path.getsize(os.path.join(dirpath, fn)) for fn in filenames)
+    return size
+
+
+def evict_cache(cache_directory, max_size_gb, keep=()):
+    """
+    Remove least recently used cache entries that no job is using until the
+    cache takes at most ``max_size_gb``
+    """
+    entries = [os.path.join(cache_directory, fn) for fn in os.listdir(cache_directory)
+               if os.path.isdir(os.path.join(cache_directory, fn))]
+    sizes = {entry: _entry_size(entry) for entry in entries}
+    total = sum(sizes.values())
+
+    # last use is recorded as the entry's modification time
+    for entry in sorted(entries, key=os.path.getmtime):
+        if total <= max_size_gb * 1024**3:
+            break
+        if entry in keep:
+            continue
+        lockfile = _lock(entry + ".lock", blocking=False)
+        if lockfile is None:
+            # in use
+            continue
+        try:
+            logprint("Evicting {0} ({1:0.1f} GB) from the staging cache"
+                     .format(entry, sizes[entry] / 1024.**3))
+            shutil.rmtree(entry)
+            total -= sizes[entry]
+        finally:
+            lockfile.close()
+    if total > max_size_gb * 1024**3:
+        logprint("The staging cache {0} holds {1:0.1f} GB in entries that are in use, "
+                 "more than its limit of {2} GB"
+                 .format(cache_directory, total / 1024.**3, max_size_gb))
+
+
+def stage_ms_cached(src, cache_directory, nthreads=8, verify=False,
+                    max_size_gb=None, poll_interval=10):
+    """
+    Stage ``src`` into a shared cache directory (e.g., node-local scratch)
+    and return the path of the cached copy.
+
+    The calling process holds a shared lock on the cache entry, which keeps
+    it from being evicted, until `release_ms` is called or the process exits.
+    Any number of jobs can use a complete copy at the same time; the copy is
+    only made (or remade, if the source changed) under an exclusive lock,
+    i.e., while no other job is using the entry.
+    """
+    if not os.path.isdir(cache_directory):
+        os.makedirs(cache_directory, exist_ok=True)
+    entrydir, entrylock = _cache_entry(cache_directory, src)
+    dest = os.path.join(entrydir, os.path.basename(os.path.normpath(src)))
+
+    # (a job that is making the copy holds the exclusive lock, so this waits
+    # for it to finish)
+    lockfile = _lock(entrylock, shared=True)
+    waiting = False
+    while not is_staged(src, dest, verify=verify):
+        lockfile.close()
+        lockfile = _lock(entrylock, blocking=False)
+        if lockfile is None:
+            # never replace a copy that other jobs are using
+            if not waiting:
+                logprint("{0} must be re-staged but is in use by other jobs; waiting"
+                         .format(dest))
+                waiting = True
+            time.sleep(poll_interval)
+            lockfile = _lock(entrylock, shared=True)
+            continue
+        try:
+            if not os.path.isdir(entrydir):
+                os.makedirs(entrydir)
+            _stage(src, dest, nthreads=nthreads, verify=verify)
+        except BaseException:
+            lockfile.close()
+            raise
+        # downgrade to a shared lock while the copy is in use
+        fcntl.flock(lockfile, fcntl.LOCK_SH)
+        break
+    _cache_locks[dest] = lockfile
+    # mark as recently used
+    os.utime(entrydir, None)
+
+    if max_size_gb is not None:
+        evict_cache(cache_directory, max_size_gb, keep=(entrydir,))
+
+    return dest
+
+
+def release_ms(path):
+    """
+    Done with a staged MS: release it if it is a cache entry, otherwise
+    remove it (and its manifest)
+    """
+    if path in _cache_locks:
+        logprint("Releasing cached MS {0}".format(path))
+        _cache_locks.pop(path).close()
+        return
+
+    logprint("Removing staged MS {0}".format(path))
+    shutil.rmtree(path)
+    for fn in (manifest_name(path), path + ".staging.lock"):
+        if os.path.exists(fn):
+            os.remove(fn)
+
+
+def release_cached_ms(src, cache_directory):
+    """
+    Done with the cached copy of ``src`` staged by an earlier job (e.g., the
+    prepare stage of a sharded cube): remove it from the cache, unless another
+    job is using it
+    """
+    entrydir, entrylock = _cache_entry(cache_directory, src)
+    if not os.path.isdir(entrydir):
+        return
+    lockfile = _lock(entrylock, blocking=False)
+    if lockfile is None:
+        logprint("Cached copy of {0} is in use; leaving it in the staging cache"
+                 .format(src))
+        return
+    try:
+        logprint("Removing cached copy of {0} from the staging cache".format(src))
+        shutil.rmtree(entrydir)
+    finally:
+        lockfile.close()
@@ -0,0 +1,148 @@
+"""
+Concurrent final imaging of the continuum at several robust values (see
+PARALLEL_ROBUST in continuum_imaging_selfcal.py and
+continuum_imaging_finaliter.py).
+
+The imaging runs are grouped into sequences: the runs in a sequence depend on
+each other (e.g., each starts from the model of the previous one) and are done
+in order, while different sequences are independent.  Each sequence is run in
+its own CASA process, started with this file as a script and given its jobs
+in a JSON file, so the processes share nothing but the (read-only) measurement
+set.  The number of concurrent processes is limited by an estimate of the
+memory each tclean needs, derived from the image size.
+
+Each job produces exactly the files the serial loop would, with the same
+names.  Running the jobs as separate processes requires CASA 6.
+"""
+import os
+import sys
+import json
+import time
+import subprocess
+
+import numpy as np
+
+try:
+    from tasks import tclean, exportfits
+except ImportError:
+    from casatasks import tclean, exportfits
+
+from metadata_tools import logprint, sethistory, test_tclean_success
+
+
+def tclean_memory_estimate(impars, padding=1.2):
+    """
+    Rough estimate, in bytes, of the memory needed by tclean with imaging
+    parameters ``impars``: the image, residual, and model of each Taylor
+    term, the PSFs, and the pb, weight, sumwt, and mask planes in single
+    precision, plus complex gridding buffers on the padded image; CASA's own
+    overheads roughly double that.
+    """
+    imsize = impars['imsize']
+    if np.isscalar(imsize):
+        imsize = [imsize, imsize]
+    npix = int(imsize[0]) * int(imsize[1])
+
+    nterms = impars.get('nterms', 1) if impars.get('deconvolver') == 'mtmfs' else 1
+    nplanes = 3*nterms + (2*nterms - 1) + 4
+    ngrids = 2*nterms
+
+    return 2 * int(npix * (4*nplanes + 8*ngrids*padding**2))
+
+
+def available_memory():
+    """ Memory available to this job, in bytes """
+    if os.getenv('SLURM_MEM_PER_NODE'):
+        return int(os.getenv('SLURM_MEM_PER_NODE')) * 1024**2
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def run_imaging_job(job):
+    """
+    Run one final imaging job: tclean with the keyword arguments
+    ``job['tclean']``, then record the history in the images and export the
+    image and the pb-corrected image to FITS.
+    """
+    imagename = job['tclean']['imagename']
+    t0 = time.time()
+    tclean(**job['tclean'])
+    test_tclean_success()
+    sethistory(imagename, impars=job.get('impars'),
+               selfcalpars=job.get('selfcalpars'),
+               selfcaliter=job.get('selfcaliter'))
+    # overwrite=True because these could already exist
+    exportfits(imagename+".image.tt0", imagename+".image.tt0.fits", overwrite=True)
+    exportfits(imagename+".image.tt0.pbcor", imagename+".image.tt0.pbcor.fits", overwrite=True)
+    logprint("Imaged {0} in {1:0.1f}s".format(imagename, time.time() - t0),
+             origin='parallel_imaging')
+
+
+def _to_json(obj):
+    # CASA 5-style byte strings and numpy scalars from the imaging parameters
+    if isinstance(obj, bytes):
+        return obj.decode()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError("{0!r} is not JSON serializable".format(obj))
+
+
+def run_imaging_sequences(sequences, nprocs, jobdir='.', poll_interval=10):
+    """
+    Run lists of imaging jobs (see `run_imaging_job`) concurrently, one
+    process per list, with at most ``nprocs`` processes whose estimated
+    memory fits in `available_memory` at any time (but always at least one).
+
+    Raises an exception naming the failed sequences once all have finished.
+    """
+    memory = available_memory()
+    pending = []
+    for sequence in sequences:
+        jobfile = os.path.join(jobdir, "{0}.jobs.json".format(
+            os.path.basename(sequence[0]['tclean']['imagename'])))
+        with open(jobfile, 'w') as fh:
+            json.dump(sequence, fh, default=_to_json)
+        estimate = max(tclean_memory_estimate(job['impars']) for job in sequence)
+        pending.append((jobfile, estimate))
+
+    running = {}
+    failed = []
+    while pending or running:
+        in_use = sum(estimate for proc, (jobfile, estimate) in running.items())
+        while (pending and len(running) < nprocs and
+               (not running or in_use + pending[0][1] <= memory)):
+            jobfile, estimate = pending.pop(0)
+            logprint("Starting imaging process for {0} (estimated memory {1:0.1f} GB)"
+                     .format(jobfile, estimate / 1024.**3),
+                     origin='parallel_imaging')
+            logfile = open(jobfile.replace(".jobs.json", ".jobs.log"), 'w')
+            proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), jobfile],
+                                    stdout=logfile, stderr=subprocess.STDOUT)
+            logfile.close()
+            running[proc] = (jobfile, estimate)
+            in_use += estimate
+
+        time.sleep(poll_interval)
+        for proc in [proc for proc in running if proc.poll() is not None]:
+            jobfile, estimate = running.pop(proc)
+            if proc.returncode != 0:
+                logprint("Imaging process for {0} failed with exit code {1}"
+                         .format(jobfile, proc.returncode),
+                         origin='parallel_imaging', priority='SEVERE')
+                failed.append(jobfile)
+            else:
+                logprint("Imaging process for {0} finished".format(jobfile),
+                         origin='parallel_imaging')
+                os.remove(jobfile)
+
+    if failed:
+        raise ValueError("Imaging failed for {0}; see the corresponding .jobs.log files"
+                         .format(failed))
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1], 'r') as fh:
+        jobs = json.load(fh)
+    for job in jobs:
+        run_imaging_job(job)
@@ -1,5 +1,32 @@
+"""
+Finalize (minimize, JvM-correct, and pb-correct; see
+`cube_finalizing.beam_correct_cube`) all of the line cubes in the imaging
+results directory.
+
+The cubes to process are determined up front and run in a pool of processes.
+Each cube's memory use is estimated from its shape, and cubes are only started
+while the sum of the estimates of the running cubes fits within the memory
+budget.  The status, timing, and failure reason of every cube are recorded in
+the JSON ledger ``cube_finalizing_ledger.json`` in the imaging results
+directory, so that reruns only process cubes that failed, whose input images
+changed since they were finalized, or whose outputs are missing or outdated.
+
+Environment variables:
+
+    NPROCS : int
+        The number of cubes processed at once (default 1); the SLURM_NTASKS
+        dask threads are divided among them
+    MEMORY_BUDGET_GB : float
+        The total memory budget for the cubes processed at once; defaults to
+        the SLURM job's memory, or the machine's memory
+"""
 import numpy as np
 import sys
+import json
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 
 from astropy import log
 log.setLevel('INFO')
@@ -25,36 +52,23 @@ import dask
 # if the directory exists but is not writeable or does not exist, it will not be used
 os.environ['TMPDIR'] = '/blue/adamginsburg/adamginsburg/tmp/'
 
+nprocs = int(os.getenv('NPROCS', 1))
+
 print("Checking environment")
-if os.getenv('ENVIRONMENT') == 'BATCH':
-    pbar = False
-else:
-    from dask.diagnostics import ProgressBar
-    pbar = ProgressBar()
-
-print("Checking for images.")
-imlist = glob.glob("*spw[0-7].image")
-imlist += glob.glob("*spw1_12M_sio.image")
-imlist += glob.glob("*spw1_7M12M_sio.image")
-has_model_minimized = [os.path.exists(x.replace(".image",
-                                                ".model.minimized.fits.gz"))
-                       for x in imlist]
-print(f"Found {len(imlist)} images.  Of these, {sum(has_model_minimized)} have minimized models.")
+# progress bars of concurrent cubes would be interleaved
+progressbar = os.getenv('ENVIRONMENT') != 'BATCH' and nprocs == 1
 
 import spectral_cube
 from spectral_cube import SpectralCube
 
-import random
-#random.shuffle(imlist)
-imlist = imlist[::-1] # July 2023: do SiO first
-#imlist.insert(0, 'W51-IRS2_B6_spw1_12M_sio.image')
-
 nthreads = os.getenv('SLURM_NTASKS')
-print(f"Setting nthreads={nthreads}")
 if nthreads is not None:
-    nthreads = int(nthreads)
-    dask.config.set(scheduler='threads')
+    # the NPROCS cubes processed at once share the job's cores
+    nthreads = max(1, int(nthreads) // nprocs)
+    print(f"Setting nthreads={nthreads} per cube")
+    dask.config.set(scheduler='threads', num_workers=nthreads)
 else:
+    print(f"Setting nthreads={nthreads}")
     dask.config.set(scheduler='synchronous')
 
 print("Appended reduction/ path to path")
@@ -65,47 +79,104 @@ import warnings
 warnings.filterwarnings(action='ignore', category=spectral_cube.utils.BeamWarning)
 warnings.filterwarnings(action='ignore', category=spectral_cube.utils.StokesWarning)
 
-for fn in imlist:
+ledgerfile = 'cube_finalizing_ledger.json'
+input_suffixes = ('.image', '.model', '.residual', '.psf', '.pb')
+# the block size of the JvM correction
+max_block_bytes = 2*1024**3
+
+
+def memory_budget():
+    """ Total memory, in bytes, for the cubes processed at once """
+    if os.getenv('MEMORY_BUDGET_GB'):
+        return int(float(os.getenv('MEMORY_BUDGET_GB')) * 1024**3)
+    if os.getenv('SLURM_MEM_PER_NODE'):
+        return int(os.getenv('SLURM_MEM_PER_NODE')) * 1024**2
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def cube_memory_estimate(shape):
+    """
+    Rough estimate, in bytes, of the memory `beam_correct_cube` needs for a
+    cube of ``shape``: the full-cube steps (the mask scan for minimizing, one
+    byte per pixel, and the writes of the minimized model and residual, which
+    hold the cube in double precision) plus one JvM block, with as much again
+    for the convolution temporaries.
+    """
+    npix = int(np.prod(shape))
+    return npix * (1 + 8) + 2 * max_block_bytes
+
+
+def inputs_signature(fn):
+    """
+    The latest modification time and total size of each of the CASA images
+    `beam_correct_cube` reads for ``fn``, ignoring lock files
+    """
+    signature = {}
+    for suffix in input_suffixes:
+        path = fn.replace(".image", suffix)
+        latest, size = 0, 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in filenames:
+                if not name.endswith('.lock'):
+                    st = os.stat(os.path.join(dirpath, name))
+                    latest = max(latest, st.st_mtime)
+                    size += st.st_size
+        signature[suffix] = [latest, size]
+    return signature
+
+
+def read_ledger():
+    if os.path.exists(ledgerfile):
+        with open(ledgerfile, 'r') as fh:
+            return json.load(fh)
+    return {}
+
+
+def write_ledger(ledger):
+    # write a temporary file first so an interrupted write can't corrupt it
+    with open(ledgerfile + '.tmp', 'w') as fh:
+        json.dump(ledger, fh, indent=2, sort_keys=True)
+    os.replace(ledgerfile + '.tmp', ledgerfile)
+
+
+def finalizing_reason(fn, cube, entry):
+    """
+    Why ``fn`` needs to be (re)finalized, or None if it is up to date.
+
+    ``entry`` is the cube's ledger entry, if any: a cube that was finalized
+    with the same inputs is not checked any further, while a cube that failed,
+    was interrupted, or whose inputs changed is always redone.  Cubes that are not in the
+    ledger are checked for their products, and for a JvM beam that is not the
+    common beam of the good channels.
+    """
     jvmfn = fn.replace(".image", ".JvM.image.pbcor.fits")
-    print(f"Filename={fn} JvM filename={jvmfn}")
-    cube = SpectralCube.read(fn)
-    print(cube)
-    sys.stdout.flush()
-    sys.stderr.flush()
-    good_beams = cube.identify_bad_beams(0.1)
+
+    if entry is not None:
+        if entry['status'] == 'failed':
+            return f"the previous run failed ({entry.get('reason')})"
+        if entry['status'] in ('pending', 'running'):
+            # partially-written products can't be trusted
+            return "the previous run was interrupted"
+        if entry['status'] == 'done':
+            if entry.get('inputs') != inputs_signature(fn):
+                return "the input images changed"
+            if not os.path.exists(jvmfn):
+                return "the JvM cube is missing"
+            return None
 
     if os.path.exists(jvmfn):
         if os.path.getsize(jvmfn) == 0:
             print(f"{jvmfn} had size {os.path.getsize(jvmfn)}")
             os.remove(jvmfn)
 
-    if fn.count('spw') == 1: # line cubes, not full cubes
-        use_velocity = True
-    elif fn.count('spw') == 2:
-        use_velocity = False
-    else:
-        raise ValueError(f'{fn} is not a recognized filename type')
-
     if not os.path.exists(fn.replace(".image", ".model.minimized.fits.gz")):
-        print(f"{fn} didn't have gzipped")
-        sys.stdout.flush()
-        sys.stderr.flush()
-        beam_correct_cube(fn.replace(".image",""), pbcor=True,
-                          use_velocity=use_velocity,
-                          write_pbcor=True, pbar=pbar, save_to_tmp_dir=True)
+        return "no gzipped minimized model"
     elif not os.path.exists(jvmfn):
-        print(f"{fn} didn't have JvM")
-        sys.stdout.flush()
-        sys.stderr.flush()
-        beam_correct_cube(fn.replace(".image",""), pbcor=True,
-                          use_velocity=use_velocity,
-                          write_pbcor=True, pbar=pbar, save_to_tmp_dir=True)
+        return "no JvM cube"
 
-    elif os.path.exists(jvmfn) and good_beams.sum() < good_beams.size:
+    good_beams = cube.identify_bad_beams(0.1)
+    if good_beams.sum() < good_beams.size:
         print(f"{fn} had {(~good_beams).sum()} bad beams")
-        sys.stdout.flush()
-        sys.stderr.flush()
-
         try:
             commonbeam = cube.beams[good_beams].common_beam()
         except BeamError:
@@ -115,12 +186,150 @@ for fn in imlist:
 
         if np.abs(jvcube.beam.sr - commonbeam.sr)/commonbeam.sr < 1e-5:
             print(f"Beams are equal: common={commonbeam}, jvbeam={jvcube.beam}")
-            print(f"No actions taken: {fn} was skipped")
         else:
-            print(f"Cube needed beam correction.  Creating common beam cube for {fn}.")
-            beam_correct_cube(fn.replace(".image",""), pbcor=True,
-                              use_velocity=use_velocity,
-                              write_pbcor=True, pbar=pbar, save_to_tmp_dir=True)
+            return f"the JvM beam {jvcube.beam} is not the common beam {commonbeam}"
+
+    return None
+
+
+def finalize_cube(fn, use_velocity, progressbar):
+    """ Run `beam_correct_cube` for ``fn``; returns the time it took """
+    t0 = time.time()
+    if progressbar:
+        from dask.diagnostics import ProgressBar
+        pbar = ProgressBar()
     else:
-        print(f"{fn} was all done - no actions taken!")
+        pbar = False
+    beam_correct_cube(fn.replace(".image",""), pbcor=True,
+                      use_velocity=use_velocity,
+                      write_pbcor=True, pbar=pbar, save_to_tmp_dir=True,
+                      max_block_bytes=max_block_bytes)
+    return time.time() - t0
+
+
+def run_worklist(worklist, ledger, nprocs, budget):
+    """
+    Finalize the cubes of ``worklist``, a list of (filename, use_velocity,
+    memory estimate), in a pool of ``nprocs`` processes, starting cubes (in
+    order, but smaller ones may go ahead of one that does not fit) only while
+    the estimates of the running cubes fit in ``budget``.  One cube is always
+    allowed to run, even if it does not fit.
+    """
+    pending = list(worklist)
+    running = {}
+    pool = ProcessPoolExecutor(max_workers=nprocs)
+    try:
+        while pending or running:
+            in_use = sum(estimate for fn, estimate in running.values())
+            broken = False
+            ii = 0
+            while ii < len(pending) and len(running) < nprocs:
+                fn, use_velocity, estimate = pending[ii]
+                if running and in_use + estimate > budget:
+                    ii += 1
+                    continue
+                try:
+                    future = pool.submit(finalize_cube, fn, use_velocity, progressbar)
+                except BrokenProcessPool:
+                    broken = True
+                    break
+                pending.pop(ii)
+                print(f"Starting {fn} (estimated memory {estimate/1024**3:0.1f} GB)", flush=True)
+                ledger[fn].update({'status': 'running',
+                                   'started': time.strftime('%Y-%m-%d %H:%M:%S'),
+                                   'inputs': inputs_signature(fn)})
+                running[future] = (fn, estimate)
+                in_use += estimate
+            write_ledger(ledger)
+
+            if running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    fn, estimate = running.pop(future)
+                    try:
+                        elapsed = future.result()
+                    except BrokenProcessPool:
+                        broken = True
+                        ledger[fn].update({'status': 'failed',
+                                           'reason': "a worker process died (out of memory?)"})
+                    except Exception as ex:
+                        ledger[fn].update({'status': 'failed',
+                                           'reason': f"{type(ex).__name__}: {ex}",
+                                           'traceback': ''.join(traceback.format_exception(type(ex), ex, ex.__traceback__))})
+                    else:
+                        ledger[fn].update({'status': 'done', 'reason': None,
+                                           'elapsed': elapsed})
+                        ledger[fn].pop('traceback', None)
+                    print(f"{fn}: {ledger[fn]['status']} {ledger[fn].get('reason') or ''}", flush=True)
+
+            if broken:
+                # a dead worker breaks the whole pool, so the cubes that were
+                # running fail too; the rest go to a new pool
+                for future, (fn, estimate) in running.items():
+                    ledger[fn].update({'status': 'failed',
+                                       'reason': "a worker process died (out of memory?)"})
+                    print(f"{fn}: failed", flush=True)
+                running = {}
+                pool.shutdown(wait=False)
+                pool = ProcessPoolExecutor(max_workers=nprocs)
+            write_ledger(ledger)
+    finally:
+        pool.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    print("Checking for images.")
+    imlist = glob.glob("*spw[0-7].image")
+    imlist += glob.glob("*spw1_12M_sio.image")
+    imlist += glob.glob("*spw1_7M12M_sio.image")
+    has_model_minimized = [os.path.exists(x.replace(".image",
+                                                    ".model.minimized.fits.gz"))
+                           for x in imlist]
+    print(f"Found {len(imlist)} images.  Of these, {sum(has_model_minimized)} have minimized models.")
+
+    import random
+    #random.shuffle(imlist)
+    imlist = imlist[::-1] # July 2023: do SiO first
+    #imlist.insert(0, 'W51-IRS2_B6_spw1_12M_sio.image')
+
+    ledger = read_ledger()
+    worklist = []
+    for fn in imlist:
+        print(f"Filename={fn}")
+        cube = SpectralCube.read(fn)
+        print(cube)
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        if fn.count('spw') == 1: # line cubes, not full cubes
+            use_velocity = True
+        elif fn.count('spw') == 2:
+            use_velocity = False
+        else:
+            raise ValueError(f'{fn} is not a recognized filename type')
+
+        reason = finalizing_reason(fn, cube, ledger.get(fn))
+        if reason is None:
+            print(f"{fn} was all done - no actions taken!")
+            if fn not in ledger:
+                ledger[fn] = {'status': 'done', 'reason': None,
+                              'inputs': inputs_signature(fn)}
+            continue
+
+        print(f"{fn} will be finalized: {reason}")
+        estimate = cube_memory_estimate(cube.shape)
+        ledger[fn] = {'status': 'pending', 'reason': reason,
+                      'shape': list(cube.shape), 'memory_estimate': estimate}
+        worklist.append((fn, use_velocity, estimate))
+
+    write_ledger(ledger)
+
+    budget = memory_budget()
+    print(f"Finalizing {len(worklist)} cubes with {nprocs} processes and a "
+          f"memory budget of {budget/1024**3:0.1f} GB")
+    run_worklist(worklist, ledger, nprocs, budget)
 
+    failed = [fn for fn, entry in ledger.items() if entry['status'] == 'failed']
+    if failed:
+        print(f"Finalizing failed for {failed}; see {ledgerfile}")
+        sys.exit(1)
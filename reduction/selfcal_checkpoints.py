@@ -0,0 +1,173 @@
+"""
+Checkpoint manifest for the self-calibration iterations of
+continuum_imaging_selfcal.py.
+
+For each field / band / array, a JSON manifest records, per iteration, the
+caltable and the fields with good solutions, the gain tables and gain fields
+applied before imaging, and digests of the resulting image and model.  It
+also records what the self-calibration MS currently holds: which image the
+MODEL_DATA column was last populated from and which caltables were applied to
+CORRECTED_DATA, together with a digest of the MS at that point.
+
+A rerun skips every iteration whose products are unchanged, and skips
+re-populating the model column or re-applying the caltables when the MS is
+known to hold the right ones already.  Digests are computed from file names,
+sizes, and modification times (see `imaging_stages.path_digest`).
+"""
+import os
+import json
+import time
+
+from imaging_stages import path_digest
+from metadata_tools import logprint
+
+
+class SelfcalCheckpoint(object):
+    """
+    Parameters
+    ----------
+    manifestfile : str
+        The JSON file the checkpoints are stored in
+    selfcal_ms : str
+        The measurement set being self-calibrated
+    enabled : bool
+        If False (e.g., for a dry run), nothing is recorded and nothing is
+        reported as complete
+    """
+    def __init__(self, manifestfile, selfcal_ms, enabled=True):
+        self.manifestfile = manifestfile
+        self.selfcal_ms = selfcal_ms
+        self.enabled = enabled
+
+        if enabled and os.path.exists(manifestfile):
+            with open(manifestfile, 'r') as fh:
+                self.state = json.load(fh)
+            logprint("Loaded self-calibration checkpoints from {0}; completed "
+                     "iterations: {1}".format(manifestfile,
+                                              sorted(self.state['iterations'])),
+                     origin='contim_selfcal')
+        else:
+            self.state = {'selfcal_ms': selfcal_ms,
+                          'iterations': {},
+                          'ms_state': {}}
+
+        # no checkpoint was ever recorded for these data
+        self.is_new = not (self.state['iterations'] or self.state['ms_state'])
+
+    def save(self):
+        if not self.enabled:
+            return
+        tmpfile = self.manifestfile + ".tmp"
+        with open(tmpfile, 'w') as fh:
+            json.dump(self.state, fh, indent=2)
+        # (os.rename is atomic on POSIX; os.replace does not exist in python 2)
+        os.rename(tmpfile, self.manifestfile)
+
+    def _record(self, selfcaliter):
+        return self.state['iterations'].setdefault(str(selfcaliter), {})
+
+    def caltable_complete(self, selfcaliter, caltable):
+        """
+        The caltable of iteration ``selfcaliter`` was completely written and
+        is unchanged
+        """
+        record = self.state['iterations'].get(str(selfcaliter), {})
+        return (self.enabled and record.get('caltable') == caltable and
+                record.get('caltable_digest') == path_digest(caltable))
+
+    def caltable_recorded(self, selfcaliter, caltable):
+        """
+        The caltable of iteration ``selfcaliter`` was completely written
+        (but may have been modified since, e.g., by flagging)
+        """
+        record = self.state['iterations'].get(str(selfcaliter), {})
+        return (self.enabled and record.get('caltable') == caltable and
+                record.get('caltable_digest') is not None)
+
+    def forget_iterations(self, selfcaliter):
+        """
+        Drop the records of iteration ``selfcaliter`` and all later ones,
+        e.g. because its caltable is solved again and everything derived from
+        the old one is out of date, and forget that the MS holds their model
+        or caltables
+        """
+        forgotten = [key for key in self.state['iterations']
+                     if int(key) >= selfcaliter]
+        if not forgotten:
+            return
+        records = [self.state['iterations'].pop(key) for key in forgotten]
+        caltables = [record.get('caltable') for record in records]
+        images = [record.get('image') for record in records]
+
+        ms_state = self.state['ms_state']
+        if ms_state.get('model_column') in images:
+            ms_state['model_column'] = None
+        corrected = ms_state.get('corrected')
+        if corrected and any(cal in corrected['gaintable'] for cal in caltables):
+            ms_state['corrected'] = None
+        logprint("Forgetting the checkpoints of self-calibration iterations {0}"
+                 .format(sorted(forgotten, key=int)), origin='contim_selfcal')
+        self.save()
+
+    def okfields(self, selfcaliter):
+        return self.state['iterations'].get(str(selfcaliter), {}).get('okfields')
+
+    def record_caltable(self, selfcaliter, caltable, okfields=None):
+        record = self._record(selfcaliter)
+        record['caltable'] = caltable
+        record['caltable_digest'] = path_digest(caltable)
+        if okfields is not None:
+            record['okfields'] = okfields
+        self.save()
+
+    def image_complete(self, selfcaliter, imname):
+        """
+        Iteration ``selfcaliter`` was imaged into ``imname`` and its image and
+        model are unchanged
+        """
+        record = self.state['iterations'].get(str(selfcaliter), {})
+        if not self.enabled or record.get('image') != imname:
+            return False
+        return all(record.get('digests', {}).get(suffix) == path_digest(imname+suffix)
+                   for suffix in ('.image.tt0', '.model.tt0', '.model.tt1'))
+
+    def record_image(self, selfcaliter, imname, gaintables=None, gainfields=None):
+        """
+        Record the image of iteration ``selfcaliter`` (also after it was
+        modified, e.g., by a zero-iteration tclean to populate the model)
+        """
+        record = self._record(selfcaliter)
+        record['image'] = imname
+        if gaintables is not None:
+            record['gaintables'] = list(gaintables)
+            record['gainfields'] = list(gainfields)
+        record['digests'] = {suffix: path_digest(imname+suffix)
+                             for suffix in ('.image.tt0', '.model.tt0', '.model.tt1')}
+        record['completed'] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.save()
+
+    def ms_state(self, key):
+        """
+        What the MS holds (``model_column``: the image the model column was
+        populated from; ``corrected``: the caltables applied), or None if
+        unknown or if the MS changed since it was recorded
+        """
+        ms_state = self.state['ms_state']
+        if not self.enabled or ms_state.get(key) is None:
+            return None
+        if ms_state.get('digest') != path_digest(self.selfcal_ms):
+            logprint("{0} changed since its contents were recorded".format(self.selfcal_ms),
+                     origin='contim_selfcal')
+            return None
+        return ms_state[key]
+
+    def record_ms_state(self, model_column=None, corrected=None):
+        """
+        Record what the MS holds after modifying it: the image the model
+        column was populated from and the caltables applied to the corrected
+        column (None if not known, e.g. after a clearcal reset the model)
+        """
+        self.state['ms_state'] = {'model_column': model_column,
+                                  'corrected': corrected,
+                                  'digest': path_digest(self.selfcal_ms)}
+        self.save()
@@ -1,11 +1,56 @@
+import os
+import time
+import shutil
+
 import numpy as np
 try:
     from casatools import table
+    from casatasks import flagmanager
     tb = table()
 except ImportError:
     from taskinit import tbtool
+    from tasks import flagmanager
     tb = tbtool()
 
+from image_statistics import robust_statistics
+
+def field_solution_statistics(solns, snr, fields):
+    """
+    The standard deviation of the solution phases and the mean SNR of each
+    field, over all polarizations, channels, and solutions, computed for all
+    fields at once by grouping on the field index.
+
+    Parameters
+    ----------
+    solns : np.ndarray
+        The CPARAM column of a caltable, shape (npol, nchan, nrow)
+    snr : np.ndarray
+        The SNR column, same shape
+    fields : np.ndarray
+        The FIELD_ID column, shape (nrow,)
+
+    Returns
+    -------
+    ufields : np.ndarray
+        The unique field IDs
+    phase_std, mean_snr : np.ndarray
+        The statistics of each field in ``ufields``
+    """
+    ufields, field_index = np.unique(fields, return_inverse=True)
+    nfields = ufields.size
+    # every polarization and channel of a row belongs to the row's field
+    field_index = np.broadcast_to(field_index, solns.shape).ravel()
+    counts = np.bincount(field_index, minlength=nfields)
+
+    angles = np.angle(solns).ravel()
+    mean_angle = np.bincount(field_index, weights=angles, minlength=nfields) / counts
+    # two passes (rather than <x^2> - <x>^2) to match np.std's precision
+    phase_var = np.bincount(field_index, weights=(angles - mean_angle[field_index])**2,
+                            minlength=nfields) / counts
+    mean_snr = np.bincount(field_index, weights=snr.ravel(), minlength=nfields) / counts
+
+    return ufields, phase_var**0.5, mean_snr
+
 def goodenough_field_solutions(tablename, minsnr=5, maxphasenoise=np.pi/4.,
                                makeplot=False):
     """
@@ -47,20 +92,10 @@ def goodenough_field_solutions(tablename, minsnr=5, maxphasenoise=np.pi/4.,
         ra, dec = tb.getcol('PHASE_DIR')
         tb.close()
 
-    okfields=[]
-    not_ok_fields = []
-
-    ufields = np.unique(fields)
-
-    for field in ufields:
-        sel = fields==field
-        angles = np.angle(solns[:,:,sel])
-        field_ok = ((angles.std() < maxphasenoise) &
-                    (snr[:,:,sel].mean() > minsnr))
-        if field_ok:
-            okfields.append(field)
-        else:
-            not_ok_fields.append(field)
+    ufields, phase_std, mean_snr = field_solution_statistics(solns, snr, fields)
+    field_ok = (phase_std < maxphasenoise) & (mean_snr > minsnr)
+    okfields = list(ufields[field_ok])
+    not_ok_fields = list(ufields[~field_ok])
 
     if makeplot:
         import pylab as pl
@@ -74,7 +109,28 @@ def goodenough_field_solutions(tablename, minsnr=5, maxphasenoise=np.pi/4.,
 
     return okfields, not_ok_fields
 
-def flag_extreme_amplitudes(tablename, maxpctchange=50, pols=[0], channels=[0]):
+def _amplitude_chunks(tablename, pols, channels, chunkrows):
+    """
+    Chunks of the unflagged solution amplitudes of a caltable (flagged ones
+    are NaN), in the form `image_statistics.robust_statistics` takes, with
+    each chunk of rows as one "channel"
+    """
+    def chunks():
+        tb.open(tablename)
+        try:
+            nrows = tb.nrows()
+            for chunk, startrow in enumerate(range(0, nrows, chunkrows)):
+                nrow = min(chunkrows, nrows - startrow)
+                amp = np.abs(tb.getcol('CPARAM', startrow, nrow)[pols, channels])
+                amp[tb.getcol('FLAG', startrow, nrow)[pols, channels]] = np.nan
+                yield chunk, amp.reshape(1, -1)
+        finally:
+            tb.close()
+
+    return chunks
+
+def flag_extreme_amplitudes(tablename, maxpctchange=50, pols=[0], channels=[0],
+                            nsigma=None, chunkrows=100000, backup=True):
     """
     Flag out all gain amplitudes with >``maxpctchange``% change (e.g., for the
     default 50%, flag everything outside the range 0.5 < G < 1.5).  This is a
@@ -86,6 +142,11 @@ def flag_extreme_amplitudes(tablename, maxpctchange=50, pols=[0], channels=[0]):
     set, I discovered that one antenna had high gain corrections even in the
     high SNR regime, which probably indicates a problem with that antenna.
 
+    The table is read and written in chunks of ``chunkrows`` rows, and the
+    flags are saved with flagmanager before any are changed, so they can be
+    restored with ``flagmanager(vis=tablename, mode='restore',
+    versionname=...)``.
+
     Parameters
     ----------
     maxpctchange : float
@@ -94,42 +155,203 @@ def flag_extreme_amplitudes(tablename, maxpctchange=50, pols=[0], channels=[0]):
         The list of polarizations to include in the heuristics
     channels : list
         The list of channels to include in the heuristics
+    nsigma : float or None
+        If set, flag amplitudes more than ``nsigma`` robust standard
+        deviations (from the MAD) from the median amplitude instead, as
+        measured in a first pass over the unflagged solutions
+    chunkrows : int
+        The number of rows read at once
+    backup : bool
+        Save the current flags as a flag version before flagging
 
     Returns
     -------
-    None
+    newly_flagged : dict
+        The number of newly flagged solutions in each spectral window
     """
 
-    tb.open(tablename)
-    solns = tb.getcol('CPARAM')
-    snr = tb.getcol('SNR')
-    # true flag = flagged out, bad data
-    flags = tb.getcol('FLAG')
-    tb.close()
+    if nsigma is not None:
+        stats = robust_statistics(_amplitude_chunks(tablename, pols, channels,
+                                                    chunkrows))
+        lower = stats['median'] - nsigma * stats['rms']
+        upper = stats['median'] + nsigma * stats['rms']
+        print("Amplitude median={0:0.4f}, robust std={1:0.4f}; flagging outside "
+              "{2:0.4f} < G < {3:0.4f}".format(stats['median'], stats['rms'],
+                                               lower, upper))
+    else:
+        maxfrac = maxpctchange / 100.
+        lower, upper = 1 - maxfrac, 1 + maxfrac
 
-    amp = np.abs(solns)
-    maxfrac = maxpctchange / 100.
+    if backup:
+        versionname = 'flag_extreme_amplitudes_{0}'.format(time.strftime("%Y%m%d_%H%M%S"))
+        flagmanager(vis=tablename, mode='save', versionname=versionname,
+                    comment='Flags before flag_extreme_amplitudes')
+        print("Saved the flags of {0} as version {1}".format(tablename, versionname))
 
-    bad = ((amp[pols, channels] > (1+maxfrac)) |
-           (amp[pols, channels] < (1-maxfrac)))
+    nbad = 0
+    bad_snr_sum = 0.
+    nflags_before = 0
+    newly_flagged = {}
 
-    bad_snr = snr[pols, channels, :][bad]
+    tb.open(tablename, nomodify=False)
+    try:
+        nrows = tb.nrows()
+        for startrow in range(0, nrows, chunkrows):
+            nrow = min(chunkrows, nrows - startrow)
+            amp = np.abs(tb.getcol('CPARAM', startrow, nrow))
+            snr = tb.getcol('SNR', startrow, nrow)
+            # true flag = flagged out, bad data
+            flags = tb.getcol('FLAG', startrow, nrow)
+            spws = tb.getcol('SPECTRAL_WINDOW_ID', startrow, nrow)
 
-    print("Found {0} bad amplitudes with mean snr={1}".format(bad.sum(), bad_snr.mean()))
-    print("Total flags in tb.flag: {0}".format(flags.sum()))
+            bad = ((amp[pols, channels] > upper) |
+                   (amp[pols, channels] < lower))
+            nbad += bad.sum()
+            bad_snr_sum += snr[pols, channels, :][bad].sum()
+            nflags_before += flags.sum()
 
-    flags[pols, channels, :] = bad | flags[pols, channels, :]
-    assert all(flags[pols, channels, :][bad]), "Failed to modify array"
+            new = bad & ~flags[pols, channels, :]
+            for spw, count in zip(*np.unique(np.broadcast_to(spws, new.shape)[new],
+                                             return_counts=True)):
+                newly_flagged[int(spw)] = newly_flagged.get(int(spw), 0) + int(count)
 
-    tb.open(tablename, nomodify=False)
-    tb.putcol(columnname='FLAG', value=flags)
-    tb.flush()
-    tb.close()
+            flags[pols, channels, :] = bad | flags[pols, channels, :]
+            assert all(flags[pols, channels, :][bad]), "Failed to modify array"
+            tb.putcol(columnname='FLAG', value=flags, startrow=startrow, nrow=nrow)
+        tb.flush()
+    finally:
+        tb.close()
+
+    print("Found {0} bad amplitudes with mean snr={1}"
+          .format(nbad, bad_snr_sum / nbad if nbad else np.nan))
+    print("Total flags in tb.flag: {0}".format(nflags_before))
+    print("Total flags in tb.flag after: {0}".format(nflags_before + sum(newly_flagged.values())))
+    for spw in sorted(newly_flagged):
+        print("  spw {0}: {1} newly flagged".format(spw, newly_flagged[spw]))
+
+    return newly_flagged
+
+# the columns of a gain table that describe a solution (rather than its value)
+_solution_columns = ('TIME', 'FIELD_ID', 'SPECTRAL_WINDOW_ID', 'ANTENNA1',
+                     'ANTENNA2', 'INTERVAL', 'SCAN_NUMBER', 'OBSERVATION_ID')
+
+def _compose_solutions(tables, gainfields):
+    """
+    The numerical part of `compose_caltables`: ``tables`` are dictionaries of
+    the columns of the gain tables (`_solution_columns` plus CPARAM, PARAMERR,
+    FLAG, and SNR), and the composed table is returned as the same kind of
+    dictionary.
+    """
+    npol, nchan = tables[-1]['CPARAM'].shape[:2]
+    used = []
+    for table, gainfield in zip(tables, gainfields):
+        if table['CPARAM'].shape[:2] != (npol, nchan):
+            raise ValueError("Cannot compose caltables whose solutions have "
+                             "different shapes")
+        if gainfield.strip():
+            keep = np.isin(table['FIELD_ID'], [int(x) for x in gainfield.split(',')])
+        else:
+            keep = np.ones(table['FIELD_ID'].size, dtype='bool')
+        used.append({name: value[..., keep] for name, value in table.items()})
+
+    # one solution per antenna and spectral window at each time at which any
+    # of the tables has one (taking the other columns from the first table
+    # with a solution at that time)
+    combined = {name: np.concatenate([table[name] for table in used], axis=-1)
+                for name in used[0]}
+    if combined['TIME'].size == 0:
+        raise ValueError("None of the caltables has solutions for its gainfields")
+    keys = np.empty(combined['TIME'].size, dtype=[('antenna', 'i4'), ('spw', 'i4'),
+                                                  ('time', 'f8')])
+    keys['antenna'] = combined['ANTENNA1']
+    keys['spw'] = combined['SPECTRAL_WINDOW_ID']
+    keys['time'] = combined['TIME']
+    first = np.unique(keys, return_index=True)[1]
+    composed = {name: value[..., first] for name, value in combined.items()}
+
+    times = composed['TIME']
+    antennas = composed['ANTENNA1']
+    spws = composed['SPECTRAL_WINDOW_ID']
+    gains = np.ones(composed['CPARAM'].shape, dtype=composed['CPARAM'].dtype)
+    anygood = np.zeros(gains.shape, dtype='bool')
 
-    tb.open(tablename, nomodify=True)
-    flags = tb.getcol('FLAG')
-    print("Total flags in tb.flag after: {0}".format(flags.sum()))
+    for antenna, spw in set(zip(antennas, spws)):
+        target = (antennas == antenna) & (spws == spw)
+        for table in used:
+            source = (table['ANTENNA1'] == antenna) & (table['SPECTRAL_WINDOW_ID'] == spw)
+            order = np.argsort(table['TIME'][source])
+            source_times = table['TIME'][source][order]
+            for pol in range(npol):
+                for chan in range(nchan):
+                    good = ~table['FLAG'][pol, chan, source][order]
+                    if not good.any():
+                        continue
+                    solns = table['CPARAM'][pol, chan, source][order][good]
+                    amp = np.interp(times[target], source_times[good],
+                                    np.abs(solns))
+                    phase = np.interp(times[target], source_times[good],
+                                      np.unwrap(np.angle(solns)))
+                    gains[pol, chan, target] *= amp * np.exp(1j*phase)
+                    anygood[pol, chan, target] = True
+
+    composed['CPARAM'] = gains
+    composed['FLAG'] = ~anygood
+    return composed
+
+def compose_caltables(caltables, gainfields, outtable):
+    """
+    Combine a sequence of gain calibration tables into one, so that a single
+    table can be applied instead of all of them.
 
-    assert all(flags[pols, channels, :][bad]), "Failed to modify table"
+    The composed table has a solution for each antenna and spectral window at
+    every time at which any of the tables (restricted to the fields in the
+    matching ``gainfields`` entry) has one.  There, the solutions of each
+    table are interpolated linearly in amplitude and phase, as ``applycal``
+    does with ``interp='linear'``, and multiplied together.  Flagged
+    solutions are not used; where a table has no good solution for an
+    antenna, spectral window, and correlation, it leaves the gains unchanged,
+    as ``applymode='calonly'`` leaves the data uncalibrated.
 
+    Parameters
+    ----------
+    caltables : list
+        The calibration tables, in the order they were derived
+    gainfields : list
+        For each table, a comma-separated string of the field IDs whose
+        solutions are used ('' for all fields)
+    outtable : str
+        The name of the combined table
+
+    Returns
+    -------
+    outtable : str
+    gainfield : str
+        The fields of the combined table's solutions, with which it is to be
+        applied
+    """
+    tables = []
+    for caltable in caltables:
+        tb.open(caltable)
+        tables.append({name: tb.getcol(name) for name in
+                       _solution_columns + ('CPARAM', 'PARAMERR', 'FLAG', 'SNR')})
+        tb.close()
+
+    composed = _compose_solutions(tables, gainfields)
+
+    if os.path.exists(outtable):
+        shutil.rmtree(outtable)
+    # (copied for the subtables and the column descriptions)
+    tb.open(caltables[-1])
+    tb.copy(outtable, deep=True, valuecopy=True)
+    tb.close()
+
+    tb.open(outtable, nomodify=False)
+    tb.removerows(list(range(tb.nrows())))
+    tb.addrows(composed['TIME'].size)
+    for name, value in composed.items():
+        tb.putcol(columnname=name, value=value)
+    tb.flush()
     tb.close()
+
+    gainfield = ",".join(str(x) for x in np.unique(composed['FIELD_ID']))
+    return outtable, gainfield
@@ -149,6 +149,13 @@ if __name__ == "__main__":
 
     verbose = '--verbose' in sys.argv
 
+    # --shard-fullcubes=N: image full-spw cubes in N channel shards (a job
+    # array) between a prepare job and a merge job, unless the parameters
+    # above specify 'nshards'
+    shard_fullcubes = [int(arg.split('=')[1]) for arg in sys.argv
+                       if arg.startswith('--shard-fullcubes=')]
+    shard_fullcubes = shard_fullcubes[0] if shard_fullcubes else 0
+
     with open('/orange/adamginsburg/web/secure/ALMA-IMF/tables/line_completeness_grid.json', 'r') as fh:
         imaging_status = json.load(fh)
 
@@ -301,6 +308,41 @@ if __name__ == "__main__":
         os.environ['LOGFILENAME'] = f"{logpath}/casa_log_line_{jobname}_{now}.log"
 
 
+        nshards = spwpars.get('nshards', shard_fullcubes if fullcube == 'fullcube' else 0)
+        if nshards:
+            # prepare (concat/contsub/staging) -> shard array -> merge chain.
+            # The job environment is captured at submission (--export=ALL),
+            # so SHARD_STAGE can be changed between the submissions.
+            os.environ['NSHARDS'] = str(nshards)
+            os.environ.pop('SHARD_INDEX', None)
+            serial_cmd = f'{scriptpath}/run_line_imaging_slurm.sh'
+            chain = [('prepare', f'{jobname}_prep', '', 1, 4, serial_cmd),
+                     ('image', f'{jobname}_shard', f' --array=0-{nshards-1}', ntasks, cpus_per_task, runcmd),
+                     ('merge', jobname, '', 1, 4, serial_cmd),
+                    ]
+            dependency = ''
+            for stage, stage_jobname, array, stage_ntasks, stage_cpus, stage_cmd in chain:
+                os.environ['SHARD_STAGE'] = stage
+                os.environ['NTASKS'] = os.environ['SLURM_NTASKS'] = str(stage_ntasks)
+                os.environ['CPUS_PER_TASK'] = str(stage_cpus)
+                os.environ['LOGFILENAME'] = f"{logpath}/casa_log_line_{stage_jobname}_{now}.log"
+                logname = f'{stage_jobname}_%A_%a.log' if array else f'{stage_jobname}_%j.log'
+                cmd = (f'sbatch --parsable --ntasks={stage_ntasks} --cpus-per-task={stage_cpus} --mem={mem}{array}{dependency}'
+                       f' {exclusive} {partition} --output={logname} --job-name={stage_jobname} --account={account} --qos={qos} --export=ALL  {stage_cmd}')
+
+                if '--dry-run' in sys.argv:
+                    if verbose:
+                        print(cmd)
+                    jobid = f'<{stage}>'
+                else:
+                    jobid = subprocess.check_output(cmd.split()).decode().strip().split(';')[0]
+                    print(f"Started sbatch job {row} {stage} with jobid={jobid} and parameters {spwpars}")
+                dependency = f' --dependency=afterok:{jobid}'
+            del os.environ['SHARD_STAGE']
+            if '--dry-run' in sys.argv:
+                print()
+            continue
+
         cmd = f'sbatch --ntasks={ntasks} --cpus-per-task={cpus_per_task} --mem={mem} {exclusive} {partition} --output={jobname}_%j.log --job-name={jobname} --account={account} --qos={qos} --export=ALL  {runcmd}'
 
         if '--dry-run' in sys.argv:
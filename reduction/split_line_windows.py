@@ -1,5 +1,6 @@
 import os
 import json
+import time
 
 import sys
 
@@ -32,7 +33,7 @@ if os.getenv('ALMAIMF_ROOTDIR') is None:
 else:
     sys.path.append(os.getenv('ALMAIMF_ROOTDIR'))
 
-from metadata_tools import check_channel_flags
+from line_splitting import split_line_windows_from, run_split_groups
 
 msmd = msmdtool()
 ms = mstool()
@@ -74,6 +75,16 @@ if os.path.exists('to_image.json'):
 else:
     to_image = {}
 
+# number of concurrent split processes (each with its own CASA tools); only
+# used under CASA 6, CASA 5 runs the splits serially
+nprocs = int(os.getenv('SPLIT_NPROCS') or 1)
+if nprocs > 1 and sys.version_info[0] < 3:
+    logprint("SPLIT_NPROCS={0} is not supported under CASA 5; running the splits"
+             " serially".format(nprocs))
+    nprocs = 1
+
+# plan all of the splits first, then run them
+jobs = []
 for band in bands:
     to_image[band] = {}
     for field in all_fields:
@@ -112,46 +123,40 @@ for band in bands:
                              "selected fields (but its metadata is being "
                              "collected in to_image.json)".format(outvis))
                 else:
-                    logprint("Splitting {0}'s spw {2} to {1}".format(vis,
-                                                                     outvis,
-                                                                     spws[newid]),)
-
-                    tb.open(invis)
-                    if 'CORRECTED_DATA' in tb.colnames():
-                        datacolumn = 'corrected'
-                    else:
-                        datacolumn = 'data'
-                    tb.close()
-
-                    # verify that no channels are flagged in the input data
-                    # (no channel-based flagging is performed by the ALMA pipeline or by
-                    # the ALMA-IMF pipeline; there is no technical reason channels should
-                    # ever be flagged)
-                    # I revised this later because it appears that at least one
-                    # window legitimately had edge channels flagged out
-                    # (check_channel_flags will raise an exception if there is excess flagging)
-                    # Also, Luke reported that there are some cases in which chunks were
-                    # flagged out because of bad atmospheric absorption lines in part of the band;
-                    # we think this only affected 7m data?
-                    check_channel_flags(invis, field=field, spw=str(spws[newid]), tolerance=0.1)
-
-                    result = split(vis=invis,
-                                 spw=spws[newid],
-                                 field=field,
-                                 outputvis=outvis,
-                                 # there is no corrected_data column because we're
-                                 # splitting from split MSes
-                                 datacolumn=datacolumn,
-                                )
-                    print("Split ended with result={0} in line split".format(result))
-
-                    flagdata(vis=outvis, mode='manual', autocorr=True)
+                    jobs.append({'invis': invis, 'outvis': outvis,
+                                 'field': field, 'spw': spws[newid]})
 
                 if outvis in to_image[band][field][newid]:
                     raise ValueError()
 
                 to_image[band][field][newid].append(outvis)
 
+# group the splits by the MS they read from: each group is run by one process,
+# so every parent MS is read by one process at a time
+groups = {}
+for job in jobs:
+    groups.setdefault(job['invis'], []).append(job)
+# longest groups first to balance the load
+groups = sorted(groups.values(), key=len, reverse=True)
+
+logprint("Planned {0} splits from {1} measurement sets; running them in {2} process(es)"
+         .format(len(jobs), len(groups), nprocs))
+
+t0 = time.time()
+timings = {}
+if nprocs > 1:
+    # separate CASA processes rather than forks of this one, whose CASA tools
+    # cannot be shared
+    timings.update(run_split_groups(groups, nprocs))
+else:
+    for group in groups:
+        timings.update(split_line_windows_from(group))
+logprint("Completed {0} splits in {1:0.1f}s".format(len(timings), time.time() - t0))
+
+# keep the timing of the earlier runs of the splits that were not redone
+split_timing = to_image.get('split_timing', {})
+split_timing.update(timings)
+to_image['split_timing'] = split_timing
 
 with open('to_image.json', 'w') as fh:
     json.dump(to_image, fh)
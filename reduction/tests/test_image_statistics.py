@@ -0,0 +1,98 @@
+"""
+Tests of the streaming median/MAD estimator in image_statistics.py; they need
+numpy and pytest only.  Run with ``python -m pytest reduction/tests``.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from image_statistics import robust_statistics, array_chunks
+
+
+def _check(data, **kwargs):
+    stats = robust_statistics(array_chunks(data, chans_per_block=3), **kwargs)
+    finite = data[np.isfinite(data)]
+    median = np.median(finite)
+    assert stats['median'] == median
+    assert stats['mad'] == np.median(np.abs(finite - median))
+    assert stats['npts'] == finite.size
+    np.testing.assert_array_equal(stats['channel_median'],
+                                  np.nanmedian(data.reshape(len(data), -1), axis=1))
+
+
+# small nbins/max_exact force several refinement passes
+@pytest.mark.parametrize('kwargs', [{}, {'nbins': 16, 'max_exact': 50},
+                                    {'nbins': 4, 'max_exact': 1}])
+@pytest.mark.parametrize('name', ['single_even', 'single_odd', 'duplicated',
+                                  'half_zeros', 'integers', 'constant',
+                                  'with_nans', 'several', 'mostly_zeros', 'ulps'])
+def test_robust_statistics(name, kwargs):
+    rng = np.random.RandomState(42)
+    data = {'single_even': rng.normal(size=(1, 64, 64)),
+            'single_odd': rng.normal(size=(1, 5, 13)),
+            'duplicated': np.repeat(rng.normal(size=(1, 32, 32)), 4, axis=0),
+            'half_zeros': np.concatenate([np.zeros((4, 32, 32)),
+                                          rng.normal(size=(4, 32, 32))]),
+            'integers': rng.randint(0, 5, size=(7, 33, 31)).astype('float'),
+            'constant': np.ones((2, 4, 4)),
+            'with_nans': np.where(rng.uniform(size=(5, 20, 20)) > 0.3,
+                                  rng.normal(size=(5, 20, 20)), np.nan),
+            'several': rng.normal(size=(10, 17, 16)) * np.arange(1, 11)[:, None, None],
+            # e.g., a clean model: a few sources on an empty sky
+            'mostly_zeros': np.where(rng.uniform(size=(6, 32, 32)) > 0.9,
+                                     rng.exponential(size=(6, 32, 32)), 0),
+            # distinct values too close together to bin
+            'ulps': 1 + np.spacing(1) * rng.randint(0, 8, size=(3, 16, 16)),
+           }[name]
+    _check(data, **kwargs)
+
+
+def test_no_valid_data():
+    with pytest.raises(ValueError):
+        robust_statistics(array_chunks(np.full((2, 4, 4), np.nan)))
+
+
+def test_caltable_sized_single_chunk():
+    # selfcal_heuristics.flag_extreme_amplitudes(nsigma=...) passes a caltable
+    # with fewer than chunkrows rows as one "channel" of amplitudes, with the
+    # flagged solutions set to NaN (see selfcal_heuristics._amplitude_chunks)
+    rng = np.random.RandomState(42)
+    nant, nsolint = 45, 40
+    amp = np.abs(1 + 0.05*rng.normal(size=nant*nsolint) + 0.05j*rng.normal(size=nant*nsolint))
+    amp[rng.uniform(size=amp.size) < 0.05] = np.nan
+    amp[:20] = 3.0
+
+    def chunks():
+        yield 0, amp.reshape(1, -1)
+
+    stats = robust_statistics(chunks)
+    finite = amp[np.isfinite(amp)]
+    assert finite.size % 2 == 0
+    assert stats['median'] == np.median(finite)
+    assert stats['mad'] == np.median(np.abs(finite - np.median(finite)))
+    upper = stats['median'] + 5 * stats['rms']
+    assert np.all(finite[:20] > upper)
+
+
+def test_ties_are_not_collected(monkeypatch):
+    # the ties of, e.g., a mostly empty model must be counted rather than
+    # collected and sorted, however many there are
+    rng = np.random.RandomState(42)
+    # (the lower median is 0 and the upper median is 1)
+    data = rng.permutation(np.concatenate([np.zeros(8000), np.ones(8000),
+                                           rng.uniform(-2, -1, 192),
+                                           rng.uniform(2, 3, 192)])).reshape(16, 32, 32)
+    sorted_sizes = []
+    sort = np.sort
+
+    def recording_sort(values, *args, **kwargs):
+        sorted_sizes.append(np.size(values))
+        return sort(values, *args, **kwargs)
+
+    monkeypatch.setattr(np, 'sort', recording_sort)
+    _check(data, nbins=16, max_exact=100)
+    assert max(sorted_sizes + [0]) <= 100